@@ -0,0 +1,103 @@
+# Copyright (c) 2024, ALYF GmbH and contributors
+# For license information, please see license.txt
+import json
+
+import click
+import frappe
+from frappe.commands import get_site, pass_context
+
+
+@click.command("banking-benchmark-sync")
+@click.option("--company", required=True, help="Company to create the fake accounts for")
+@click.option("--accounts", default=1, help="Number of Bank Accounts to sync")
+@click.option("--transactions", default=1000, help="Transactions per Bank Account")
+@click.option("--page-size", default=500, help="Transactions per page")
+@click.option("--latency", default=0.0, help="Response time of the admin app in seconds")
+@click.option("--error-rate", default=0.0, help="Share of requests failing with a 502")
+@click.option("--rate-limit-rate", default=0.0, help="Share of requests failing with a 429")
+@click.option("--keep-data", is_flag=True, default=False, help="Keep the synced transactions")
+@pass_context
+def benchmark_sync(
+	context,
+	company,
+	accounts,
+	transactions,
+	page_size,
+	latency,
+	error_rate,
+	rate_limit_rate,
+	keep_data,
+):
+	"""Measure the Kosma transaction sync against a local fake admin app (test sites only)."""
+	from banking.demo_responses.benchmark_sync import benchmark_consent_sync
+	from banking.demo_responses.fake_admin_server import FakeAdminConfig
+
+	config = FakeAdminConfig(
+		transactions_per_account=transactions,
+		page_size=page_size,
+		latency=latency,
+		error_rate=error_rate,
+		rate_limit_rate=rate_limit_rate,
+	)
+
+	frappe.init(site=get_site(context))
+	frappe.connect()
+	try:
+		result = benchmark_consent_sync(config, company, accounts, cleanup=not keep_data)
+		click.echo(json.dumps(result, indent=2))
+	finally:
+		frappe.destroy()
+
+
+@click.command("banking-rebuild-reconciliation-summary")
+@click.option("--bank-account", help="Only rebuild the summary of this Bank Account")
+@pass_context
+def rebuild_reconciliation_summary(context, bank_account=None):
+	"""Recompute the Bank Reconciliation Summary from the Bank Transactions."""
+	from banking.klarna_kosma_integration.doctype.bank_reconciliation_summary.bank_reconciliation_summary import (
+		rebuild_summary,
+	)
+
+	frappe.init(site=get_site(context))
+	frappe.connect()
+	try:
+		rows = rebuild_summary(bank_account)
+		frappe.db.commit()
+		click.echo(f"Rebuilt {rows} summary rows")
+	finally:
+		frappe.destroy()
+
+
+@click.command("banking-explain-matching")
+@click.option("--bank-transaction", help="Bank Transaction to match (default: latest unreconciled)")
+@pass_context
+def explain_matching(context, bank_transaction=None):
+	"""EXPLAIN the matching queries of a Bank Transaction and report full table scans."""
+	from banking.klarna_kosma_integration.doctype.bank_reconciliation_tool_beta.bank_reconciliation_tool_beta import (
+		explain_matching_queries,
+	)
+
+	frappe.init(site=get_site(context))
+	frappe.connect()
+	try:
+		bank_transaction = bank_transaction or frappe.db.get_value(
+			"Bank Transaction",
+			{"docstatus": 1, "unallocated_amount": (">", 0)},
+			order_by="date desc",
+		)
+		if not bank_transaction:
+			click.echo("No unreconciled Bank Transaction found")
+			return
+
+		full_scans = 0
+		for row in explain_matching_queries(bank_transaction):
+			full_scans += row["full_scan"]
+			marker = "FULL SCAN" if row["full_scan"] else "ok"
+			click.echo(f"{marker:<10}{row['query']:<35}{row['table']:<30}{row['access']}")
+
+		click.echo(f"{full_scans} full table scan(s) for {bank_transaction}")
+	finally:
+		frappe.destroy()
+
+
+commands = [benchmark_sync, rebuild_reconciliation_summary, explain_matching]
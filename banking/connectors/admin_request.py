@@ -2,7 +2,8 @@
 # For license information, please see license.txt
 import json
 from typing import Dict, Optional
-import requests
+
+from banking.connectors.retry import send_with_retry
 
 
 class AdminRequest:
@@ -26,6 +27,16 @@ class AdminRequest:
 	def headers(self):
 		return {"Alyf-Banking-Authorization": f"Token {self.api_token}"}
 
+	def post(self, method: str, idempotent: bool = False, **kwargs):
+		return send_with_retry(
+			"POST",
+			url=self.url + method,
+			endpoint=method,
+			idempotent=idempotent,
+			headers=self.headers,
+			**kwargs,
+		)
+
 	@property
 	def data(self):
 		return {
@@ -55,18 +66,14 @@ class AdminRequest:
 		)
 
 		method = "banking_admin.api.get_client_token"
-		return requests.post(
-			url=self.url + method, headers=self.headers, data=json.dumps(data)
-		)
+		return self.post(method, data=json.dumps(data))
 
 	def flow_accounts(self, session_id: str, flow_id: str):
 		data = self.data
 		data.update({"session_id": session_id, "flow_id": flow_id})
 
 		method = "banking_admin.api.fetch_accounts_and_bank"
-		return requests.post(
-			url=self.url + method, headers=self.headers, data=json.dumps(data)
-		)
+		return self.post(method, idempotent=True, data=json.dumps(data))
 
 	def flow_transactions(
 		self,
@@ -81,25 +88,23 @@ class AdminRequest:
 		)
 
 		method = "banking_admin.api.fetch_flow_transactions"
-		return requests.post(
-			url=self.url + method, headers=self.headers, data=json.dumps(data)
-		)
+		return self.post(method, idempotent=True, data=json.dumps(data))
 
 	def end_session(self, session_id: str):
 		data = self.data
 		data.update({"session_id": session_id})
 
 		method = "banking_admin.api.end_session"
-		requests.post(url=self.url + method, headers=self.headers, data=json.dumps(data))
+		self.post(method, data=json.dumps(data))
 
 	def consent_accounts(self, consent_id: str, consent_token: str):
 		data = self.data
 		data.update({"consent_id": consent_id, "consent_token": consent_token})
 
+		# A retry sends the last accepted token again. If the backend rotated it
+		# before the gateway error, the retry is rejected instead of processed twice.
 		method = "banking_admin.api.fetch_consent_accounts"
-		return requests.post(
-			url=self.url + method, headers=self.headers, data=json.dumps(data)
-		)
+		return self.post(method, idempotent=True, data=json.dumps(data))
 
 	def consent_transactions(
 		self,
@@ -122,43 +127,35 @@ class AdminRequest:
 			}
 		)
 
+		# A retry requests the same page (`url`, `offset`) with the last accepted
+		# token. If the backend rotated it before the gateway error, the retry is
+		# rejected instead of processed twice. A page that arrives twice is
+		# filtered by the duplicate check of the importer.
 		method = "banking_admin.api.fetch_consent_transactions"
-		return requests.post(
-			url=self.url + method, headers=self.headers, data=json.dumps(data)
-		)
+		return self.post(method, idempotent=True, data=json.dumps(data))
 
 	def fetch_subscription(self):
 		method = "banking_admin.api.fetch_subscription_details"
-		return requests.post(
-			url=self.url + method, headers=self.headers, data=json.dumps(self.data)
-		)
+		return self.post(method, idempotent=True, data=json.dumps(self.data))
 
 	def get_customer_portal(self):
 		method = "banking_admin.api.get_customer_portal"
-		return requests.get(url=self.url + method)
+		return send_with_retry(
+			"GET", url=self.url + method, endpoint=method, idempotent=True
+		)
 
 	def get_fintech_license(self):
 		method = "banking_admin.ebics_api.get_fintech_license"
-		return requests.post(
-			url=self.url + method, headers=self.headers, json=self.data.copy()
-		)
+		return self.post(method, idempotent=True, json=self.data.copy())
 
 	def register_ebics_user(self, host_id: str, partner_id: str, user_id: str):
 		data = self.data
 		data.update({"host_id": host_id, "partner_id": partner_id, "user_id": user_id})
 		method = "banking_admin.ebics_api.register_ebics_user"
-		return requests.post(
-			url=self.url + method,
-			headers=self.headers,
-			json=data,
-		)
+		return self.post(method, json=data)
 
 	def remove_ebics_user(self, host_id: str, partner_id: str, user_id: str):
 		data = self.data
 		data.update({"host_id": host_id, "partner_id": partner_id, "user_id": user_id})
 		method = "banking_admin.ebics_api.remove_ebics_user"
-		return requests.post(
-			url=self.url + method,
-			headers=self.headers,
-			json=data,
-		)
+		return self.post(method, idempotent=True, json=data)
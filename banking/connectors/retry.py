@@ -0,0 +1,149 @@
+# Copyright (c) 2024, ALYF GmbH and contributors
+# For license information, please see license.txt
+import random
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+import frappe
+import requests
+from frappe import _
+
+# Rate limited or temporarily unavailable. The request can be sent again.
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+MAX_RETRIES = 4
+BACKOFF_BASE = 1  # seconds
+BACKOFF_MAX = 30  # seconds
+REQUEST_TIMEOUT = 120  # seconds
+
+# Default number of requests per admin endpoint that may run at the same time,
+# across all workers of a site. Can be changed via `banking_admin_concurrency` in site config.
+ENDPOINT_CONCURRENCY = 4
+SLOT_WAIT_TIMEOUT = 300  # seconds
+SLOT_TTL = REQUEST_TIMEOUT * (MAX_RETRIES + 1)
+
+
+def send_with_retry(
+	http_method: str,
+	url: str,
+	endpoint: str,
+	idempotent: bool = False,
+	**kwargs,
+) -> requests.Response:
+	"""Send a request to the admin backend, retrying transient failures.
+
+	Rejected requests (429) are always retried, since they were not processed.
+	Gateway errors and connection problems are only retried for `idempotent`
+	requests, e.g. reads and pagination requests. The payload is serialized by the
+	caller, so a retry replays exactly the same `url`/`offset`.
+
+	:param endpoint: The admin API method, used for the concurrency budget.
+	"""
+	kwargs.setdefault("timeout", REQUEST_TIMEOUT)
+	attempt = 0
+
+	while True:
+		try:
+			with endpoint_slot(endpoint):
+				response = requests.request(http_method, url, **kwargs)
+		except (requests.ConnectionError, requests.Timeout):
+			if not idempotent or attempt >= MAX_RETRIES:
+				raise
+
+			delay = get_backoff(attempt)
+		else:
+			if not should_retry(response, idempotent) or attempt >= MAX_RETRIES:
+				return response
+
+			delay = get_retry_after(response) or get_backoff(attempt)
+
+		time.sleep(delay)
+		attempt += 1
+
+
+def should_retry(response: requests.Response, idempotent: bool) -> bool:
+	if response.status_code == 429:
+		return True
+
+	return idempotent and response.status_code in RETRY_STATUS_CODES
+
+
+def get_backoff(attempt: int) -> float:
+	"""Exponential backoff with full jitter."""
+	return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+
+
+def get_retry_after(response: requests.Response) -> Optional[float]:
+	"""Return the delay requested by the `Retry-After` header in seconds, if any.
+
+	The header contains either a number of seconds or an HTTP date.
+	"""
+	retry_after = response.headers.get("Retry-After")
+	if not retry_after:
+		return None
+
+	try:
+		delay = float(retry_after)
+	except ValueError:
+		try:
+			retry_at = parsedate_to_datetime(retry_after)
+		except (TypeError, ValueError):
+			return None
+
+		delay = retry_at.timestamp() - time.time()
+
+	return min(max(delay, 0), BACKOFF_MAX)
+
+
+# Take a slot. The TTL is only set when the counter is created, so that slots
+# leaked by a dead worker expire even if other workers keep using the endpoint.
+ACQUIRE_SLOT = """
+local in_use = redis.call("INCR", KEYS[1])
+if in_use == 1 then
+	redis.call("EXPIRE", KEYS[1], ARGV[1])
+end
+return in_use
+"""
+
+# Release a slot. The counter may have expired in the meantime, never let it go below 0.
+RELEASE_SLOT = """
+local in_use = redis.call("DECR", KEYS[1])
+if in_use <= 0 then
+	redis.call("DEL", KEYS[1])
+end
+return in_use
+"""
+
+
+@contextmanager
+def endpoint_slot(endpoint: str):
+	"""Wait for a free slot in the concurrency budget of an admin endpoint.
+
+	The budget is a counter in Redis, shared by all workers of the site. It
+	expires on its own, in case a worker dies while holding a slot.
+	"""
+	limit = frappe.conf.get("banking_admin_concurrency") or ENDPOINT_CONCURRENCY
+	key = frappe.cache.make_key(f"banking_admin_slots::{endpoint}")
+	waited = 0.0
+
+	while True:
+		in_use = frappe.cache.eval(ACQUIRE_SLOT, 1, key, SLOT_TTL)
+		if in_use <= limit:
+			break
+
+		frappe.cache.eval(RELEASE_SLOT, 1, key)
+		if waited >= SLOT_WAIT_TIMEOUT:
+			frappe.throw(
+				_("Too many concurrent requests to {0}, please try again later.").format(endpoint),
+				title=_("Banking Error"),
+			)
+
+		delay = random.uniform(0.1, 0.5)
+		time.sleep(delay)
+		waited += delay
+
+	try:
+		yield
+	finally:
+		frappe.cache.eval(RELEASE_SLOT, 1, key)
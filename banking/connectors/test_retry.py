@@ -0,0 +1,70 @@
+# Copyright (c) 2024, ALYF GmbH and Contributors
+# See license.txt
+import json
+from unittest.mock import MagicMock, patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from banking.connectors.admin_request import AdminRequest
+from banking.connectors.retry import endpoint_slot, get_retry_after, send_with_retry
+
+
+def make_response(status_code: int, headers: dict = None):
+	response = MagicMock()
+	response.status_code = status_code
+	response.headers = headers or {}
+	return response
+
+
+@patch("banking.connectors.retry.time.sleep")
+class TestRetry(FrappeTestCase):
+	def test_retry_after_header(self, sleep):
+		self.assertEqual(get_retry_after(make_response(429, {"Retry-After": "3"})), 3)
+		self.assertIsNone(get_retry_after(make_response(429)))
+		self.assertIsNone(get_retry_after(make_response(429, {"Retry-After": "soon"})))
+
+	def test_retry_transient_errors(self, sleep):
+		responses = [make_response(502), make_response(429), make_response(200)]
+		with patch("banking.connectors.retry.requests.request", side_effect=responses) as request:
+			response = send_with_retry("POST", "http://x/api", "api", idempotent=True)
+
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(request.call_count, 3)
+		self.assertEqual(sleep.call_count, 2)
+
+	def test_no_retry_for_non_idempotent_requests(self, sleep):
+		with patch(
+			"banking.connectors.retry.requests.request", return_value=make_response(502)
+		) as request:
+			response = send_with_retry("POST", "http://x/api", "api")
+
+		self.assertEqual(response.status_code, 502)
+		self.assertEqual(request.call_count, 1)
+		sleep.assert_not_called()
+
+	def test_retry_transaction_page(self, sleep):
+		request = AdminRequest("127.0.0.1", None, "token", "http://x/api/method/", "CUST", True)
+		responses = [make_response(502), make_response(200)]
+		with patch("banking.connectors.retry.requests.request", side_effect=responses) as send:
+			response = request.consent_transactions(
+				"account", "2024-01-01", "consent", "consent-token", "http://x/next", "page-2"
+			)
+
+		self.assertEqual(response.status_code, 200)
+		# the retry requests the same page with the same token
+		first, retry = send.call_args_list
+		self.assertEqual(first.kwargs["data"], retry.kwargs["data"])
+		self.assertEqual(json.loads(retry.kwargs["data"])["offset"], "page-2")
+		self.assertEqual(json.loads(retry.kwargs["data"])["consent_token"], "consent-token")
+
+	def test_slot_counter(self, sleep):
+		key = frappe.cache.make_key("banking_admin_slots::test_slot")
+		with endpoint_slot("test_slot"):
+			self.assertEqual(int(frappe.cache.get(key)), 1)
+			self.assertGreater(frappe.cache.ttl(key), 0)
+			# the counter expired while the slot was in use
+			frappe.cache.delete(key)
+
+		# releasing the slot did not leave a negative counter behind
+		self.assertIsNone(frappe.cache.get(key))
@@ -0,0 +1,140 @@
+# Copyright (c) 2024, ALYF GmbH and contributors
+# For license information, please see license.txt
+"""Measure the end-to-end Kosma transaction sync against the fake admin app.
+
+Creates a Bank, Bank Consent and Bank Accounts for the fake admin app and syncs
+all of their transactions. Only run this on a test or development site.
+"""
+import time
+
+import frappe
+from frappe.utils import add_days, get_datetime, getdate
+
+from banking.demo_responses.fake_admin_server import FakeAdminConfig, FakeAdminServer
+from banking.klarna_kosma_integration.admin import Admin
+
+FAKE_BANK = "Fake Admin Bank"
+FAKE_CONSENT_ID = "fake-consent"
+
+
+def benchmark_consent_sync(
+	config: FakeAdminConfig,
+	company: str,
+	accounts: int = 1,
+	cleanup: bool = True,
+	commit: bool = True,
+) -> dict:
+	"""Sync all transactions of `accounts` fake Bank Accounts and return throughput numbers.
+
+	:param commit: Commit the fake records and the synced transactions. Tests pass
+		False and roll back instead.
+	"""
+	bank_accounts = setup_fake_bank_accounts(company, accounts, commit)
+	start_date = add_days(getdate(), -366).isoformat()
+	count_before = count_transactions(bank_accounts)
+
+	with FakeAdminServer(config) as server:
+		admin = Admin(get_fake_settings(server.url))
+
+		start = time.monotonic()
+		for bank_account in bank_accounts:
+			admin.consent_transactions(bank_account, start_date)
+		if commit:
+			frappe.db.commit()
+		elapsed = time.monotonic() - start
+
+		stats = server.stats
+
+	inserted = count_transactions(bank_accounts) - count_before
+	if cleanup:
+		frappe.db.delete("Bank Transaction", {"bank_account": ("in", bank_accounts)})
+		frappe.db.set_value(
+			"Bank Account", {"name": ("in", bank_accounts)}, "last_integration_date", None
+		)
+		if commit:
+			frappe.db.commit()
+
+	return {
+		"accounts": len(bank_accounts),
+		"seconds": round(elapsed, 2),
+		"transactions_fetched": stats["transactions"],
+		"transactions_inserted": inserted,
+		"transactions_per_second": round(inserted / elapsed, 1) if elapsed else 0,
+		"requests": stats["requests"],
+		"injected_errors": stats["errors"],
+		"injected_rate_limits": stats["rate_limited"],
+	}
+
+
+def get_fake_settings(admin_endpoint: str):
+	"""Return Banking Settings pointing to the fake admin app, without saving them."""
+	settings = frappe.get_single("Banking Settings")
+	settings.admin_endpoint = admin_endpoint
+	settings.api_token = "fake-api-token"
+	settings.customer_id = "FAKE"
+	return settings
+
+
+def count_transactions(bank_accounts: list) -> int:
+	return frappe.db.count("Bank Transaction", {"bank_account": ("in", bank_accounts)})
+
+
+def setup_fake_bank_accounts(company: str, accounts: int, commit: bool = True) -> list:
+	if not frappe.db.exists("Bank", FAKE_BANK):
+		frappe.get_doc({"doctype": "Bank", "bank_name": FAKE_BANK}).insert()
+
+	consent_name = frappe.db.exists("Bank Consent", {"bank": FAKE_BANK, "company": company})
+	consent = (
+		frappe.get_doc("Bank Consent", consent_name)
+		if consent_name
+		else frappe.get_doc({"doctype": "Bank Consent", "bank": FAKE_BANK, "company": company})
+	)
+	consent.consent_id = FAKE_CONSENT_ID
+	consent.consent_token = "fake-consent-token"
+	consent.consent_expiry = add_days(get_datetime(), 1)
+	consent.save()
+
+	parent_account = frappe.db.get_value(
+		"Account", {"company": company, "account_type": "Bank", "is_group": 1}
+	)
+	bank_accounts = []
+	for i in range(accounts):
+		account_name = f"Fake Account {i}"
+		gl_account = frappe.db.get_value(
+			"Account", {"account_name": account_name, "company": company}
+		) or (
+			frappe.get_doc(
+				{
+					"doctype": "Account",
+					"account_name": account_name,
+					"company": company,
+					"parent_account": parent_account,
+					"account_type": "Bank",
+				}
+			)
+			.insert()
+			.name
+		)
+
+		bank_account = frappe.db.get_value("Bank Account", {"account": gl_account}) or (
+			frappe.get_doc(
+				{
+					"doctype": "Bank Account",
+					"account_name": account_name,
+					"bank": FAKE_BANK,
+					"account": gl_account,
+					"company": company,
+					"is_company_account": 1,
+				}
+			)
+			.insert()
+			.name
+		)
+		frappe.db.set_value(
+			"Bank Account", bank_account, "kosma_account_id", f"{FAKE_CONSENT_ID}-acc-{i}"
+		)
+		bank_accounts.append(bank_account)
+
+	if commit:
+		frappe.db.commit()
+	return bank_accounts
@@ -0,0 +1,337 @@
+# Copyright (c) 2024, ALYF GmbH and contributors
+# For license information, please see license.txt
+"""A local stand-in for the Banking Admin App, for load and latency testing.
+
+It implements the endpoints used by the transaction sync and generates paginated,
+synthetic transactions. Latency, error rates, page size and token rotation can be
+configured. It only depends on the standard library and can be started with:
+
+	python -m banking.demo_responses.fake_admin_server --port 8000
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+METHOD_PREFIX = "/api/method/"
+
+
+class FakeAdminConfig:
+	def __init__(
+		self,
+		transactions_per_account: int = 1000,
+		accounts_per_consent: int = 3,
+		page_size: int = 500,
+		latency: float = 0.0,
+		latency_jitter: float = 0.0,
+		error_rate: float = 0.0,
+		rate_limit_rate: float = 0.0,
+		rotate_tokens: bool = True,
+		validate_tokens: bool = False,
+		seed: int = 42,
+	) -> None:
+		"""
+		:param latency: Base response time in seconds.
+		:param latency_jitter: Random extra response time in seconds (0 .. jitter).
+		:param error_rate: Share of requests answered with a 502 gateway error.
+		:param rate_limit_rate: Share of requests answered with a 429 and `Retry-After`.
+		:param rotate_tokens: Return a new consent token with every consent response.
+		:param validate_tokens: Reject requests that don't use the latest consent token.
+		"""
+		self.transactions_per_account = transactions_per_account
+		self.accounts_per_consent = accounts_per_consent
+		self.page_size = page_size
+		self.latency = latency
+		self.latency_jitter = latency_jitter
+		self.error_rate = error_rate
+		self.rate_limit_rate = rate_limit_rate
+		self.rotate_tokens = rotate_tokens
+		self.validate_tokens = validate_tokens
+		self.seed = seed
+
+
+class FakeAdminState:
+	"""Issued consent tokens and request statistics, shared by all handler threads."""
+
+	def __init__(self, config: FakeAdminConfig) -> None:
+		self.config = config
+		self.lock = threading.Lock()
+		self.tokens = {}
+		self.stats = {"requests": 0, "errors": 0, "rate_limited": 0, "transactions": 0}
+		self.random = random.Random(config.seed)
+
+	def count(self, key: str, value: int = 1) -> None:
+		with self.lock:
+			self.stats[key] += value
+
+	def roll(self, rate: float) -> bool:
+		with self.lock:
+			return self.random.random() < rate
+
+	def check_token(self, consent_id: str, token: str) -> bool:
+		if not self.config.validate_tokens:
+			return True
+
+		with self.lock:
+			return self.tokens.get(consent_id, token) == token
+
+	def next_token(self, consent_id: str) -> Optional[str]:
+		if not self.config.rotate_tokens:
+			return None
+
+		new_token = uuid.uuid4().hex
+		with self.lock:
+			self.tokens[consent_id] = new_token
+
+		return new_token
+
+
+def get_transactions(account_id: str, config: FakeAdminConfig) -> list:
+	"""Return the synthetic transactions of an account, newest first (like Kosma)."""
+	rng = random.Random(f"{config.seed}:{account_id}")
+	today = date.today()
+	transactions = []
+
+	for i in range(config.transactions_per_account):
+		booking_date = today - timedelta(days=i * 365 // max(config.transactions_per_account, 1))
+		is_credit = rng.random() < 0.4
+		invoice_no = f"ACC-SINV-{today.year}-{rng.randint(1, 99999):05d}"
+		transactions.append(
+			{
+				"transaction_id": f"{account_id}-{i:08d}",
+				"reference": f"Payment {invoice_no} Customer {rng.randint(1, 5000)}",
+				"bank_references": {"end_to_end": f"E2E-{account_id}-{i}"},
+				"counter_party": {
+					"iban": f"DE{rng.randint(10, 99)}{rng.randint(10**17, 10**18 - 1)}",
+					"holder_name": f"Party {rng.randint(1, 5000)} GmbH",
+				},
+				"date": booking_date.isoformat(),
+				"value_date": (booking_date + timedelta(days=rng.randint(0, 3))).isoformat(),
+				"booking_date": booking_date.isoformat(),
+				"state": "PROCESSED",
+				"type": "CREDIT" if is_credit else "DEBIT",
+				"amount": {"amount": rng.randint(100, 500000), "currency": "EUR"},
+			}
+		)
+
+	return transactions
+
+
+def get_accounts(consent_id: str, config: FakeAdminConfig) -> list:
+	rng = random.Random(f"{config.seed}:{consent_id}")
+	return [
+		{
+			"id": f"{consent_id}-acc-{i}",
+			"alias": f"Fake Account {i}",
+			"account_number": f"{rng.randint(10**9, 10**10 - 1)}",
+			"iban": f"DE{rng.randint(10, 99)}{rng.randint(10**17, 10**18 - 1)}",
+			"holder_name": "Fake Holder",
+		}
+		for i in range(config.accounts_per_consent)
+	]
+
+
+def get_transactions_page(account_id: str, offset: Optional[str], config: FakeAdminConfig):
+	transactions = get_transactions(account_id, config)
+	start = int(offset or 0)
+	end = start + config.page_size
+
+	pagination = {}
+	if end < len(transactions):
+		pagination = {
+			"url": f"https://fake-admin.local/transactions/{account_id}",
+			"next": {"offset": str(end)},
+		}
+
+	return {"transactions": transactions[start:end], "pagination": pagination}
+
+
+class FakeAdminHandler(BaseHTTPRequestHandler):
+	state: FakeAdminState = None
+
+	def log_message(self, format, *args):
+		pass
+
+	def do_GET(self):
+		self.handle_method(payload={})
+
+	def do_POST(self):
+		length = int(self.headers.get("Content-Length") or 0)
+		body = self.rfile.read(length) if length else b"{}"
+		try:
+			payload = json.loads(body or b"{}")
+		except ValueError:
+			payload = {}
+
+		self.handle_method(payload)
+
+	def handle_method(self, payload: dict):
+		state, config = self.state, self.state.config
+		state.count("requests")
+
+		latency = config.latency + random.uniform(0, config.latency_jitter)
+		if latency:
+			time.sleep(latency)
+
+		if state.roll(config.rate_limit_rate):
+			state.count("rate_limited")
+			return self.send(429, {"message": "Too Many Requests"}, {"Retry-After": "1"})
+
+		if state.roll(config.error_rate):
+			state.count("errors")
+			return self.send_html(502, "<html><body>Bad Gateway</body></html>")
+
+		method = self.path.split("?")[0][len(METHOD_PREFIX) :]
+		handler = getattr(self, "api_" + method.rsplit(".", 1)[-1], None)
+		if not self.path.startswith(METHOD_PREFIX) or not handler:
+			return self.send(404, {"exc_type": "DoesNotExistError"})
+
+		handler(payload)
+
+	def api_fetch_consent_accounts(self, payload: dict):
+		consent_id = payload.get("consent_id")
+		if not self.state.check_token(consent_id, payload.get("consent_token")):
+			return self.send_invalid_token()
+
+		self.send(
+			200,
+			{
+				"message": {
+					"result": {"accounts": get_accounts(consent_id, self.state.config)},
+					"consent_token": self.state.next_token(consent_id),
+				}
+			},
+		)
+
+	def api_fetch_consent_transactions(self, payload: dict):
+		consent_id = payload.get("consent_id")
+		if not self.state.check_token(consent_id, payload.get("consent_token")):
+			return self.send_invalid_token()
+
+		result = get_transactions_page(
+			payload.get("account_id"), payload.get("offset"), self.state.config
+		)
+		self.state.count("transactions", len(result["transactions"]))
+		self.send(
+			200,
+			{
+				"message": {
+					"result": result,
+					"consent_token": self.state.next_token(consent_id),
+				}
+			},
+		)
+
+	def api_fetch_flow_transactions(self, payload: dict):
+		result = get_transactions_page(
+			payload.get("flow_id"), payload.get("offset"), self.state.config
+		)
+		self.state.count("transactions", len(result["transactions"]))
+		self.send(200, {"message": {"result": result, "state": "FINISHED"}})
+
+	def api_fetch_subscription_details(self, payload: dict):
+		self.send(200, {"message": [{"full_name": "Fake Subscriber"}]})
+
+	def api_get_fintech_license(self, payload: dict):
+		self.send(
+			200, {"message": {"licensee_name": "Fake Licensee", "license_key": "FAKE-LICENSE"}}
+		)
+
+	def api_register_ebics_user(self, payload: dict):
+		self.send(200, {"message": "OK"})
+
+	def api_remove_ebics_user(self, payload: dict):
+		self.send(200, {"message": "OK"})
+
+	def send_invalid_token(self):
+		self.send(401, {"message": {"error": {"message": "Invalid consent token"}}})
+
+	def send(self, status: int, data: dict, headers: Optional[dict] = None):
+		body = json.dumps(data).encode()
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		for key, value in (headers or {}).items():
+			self.send_header(key, value)
+		self.end_headers()
+		self.wfile.write(body)
+
+	def send_html(self, status: int, html: str):
+		body = html.encode()
+		self.send_response(status)
+		self.send_header("Content-Type", "text/html")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+
+class FakeAdminServer:
+	"""Run the fake admin app in a background thread.
+
+	>>> with FakeAdminServer(FakeAdminConfig(page_size=100)) as server:
+	...     settings.admin_endpoint = server.url
+	"""
+
+	def __init__(self, config: Optional[FakeAdminConfig] = None, port: int = 0) -> None:
+		self.state = FakeAdminState(config or FakeAdminConfig())
+		handler = type("Handler", (FakeAdminHandler,), {"state": self.state})
+		self.httpd = ThreadingHTTPServer(("127.0.0.1", port), handler)
+		self.thread = None
+
+	@property
+	def url(self) -> str:
+		host, port = self.httpd.server_address[:2]
+		return f"http://{host}:{port}"
+
+	@property
+	def stats(self) -> dict:
+		return dict(self.state.stats)
+
+	def start(self) -> "FakeAdminServer":
+		self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+		self.thread.start()
+		return self
+
+	def stop(self) -> None:
+		self.httpd.shutdown()
+		self.httpd.server_close()
+
+	def __enter__(self) -> "FakeAdminServer":
+		return self.start()
+
+	def __exit__(self, *args) -> None:
+		self.stop()
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Fake Banking Admin App")
+	parser.add_argument("--port", type=int, default=8000)
+	parser.add_argument("--transactions", type=int, default=1000)
+	parser.add_argument("--page-size", type=int, default=500)
+	parser.add_argument("--latency", type=float, default=0.0)
+	parser.add_argument("--error-rate", type=float, default=0.0)
+	parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+	args = parser.parse_args()
+
+	config = FakeAdminConfig(
+		transactions_per_account=args.transactions,
+		page_size=args.page_size,
+		latency=args.latency,
+		error_rate=args.error_rate,
+		rate_limit_rate=args.rate_limit_rate,
+	)
+	server = FakeAdminServer(config, port=args.port)
+	print(f"Fake Banking Admin App listening on {server.url}")
+	try:
+		server.httpd.serve_forever()
+	except KeyboardInterrupt:
+		server.stop()
+
+
+if __name__ == "__main__":
+	main()
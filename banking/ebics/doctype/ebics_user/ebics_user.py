@@ -7,7 +7,8 @@ from frappe import _
 from frappe.model.document import Document
 from frappe.utils import get_link_to_form
 
-from banking.ebics.utils import get_ebics_manager, sync_ebics_transactions
+from banking.ebics.utils import get_ebics_manager
+from banking.jobs import enqueue_sync
 from banking.klarna_kosma_integration.admin import Admin
 from requests import HTTPError
 
@@ -166,10 +167,20 @@ def download_bank_statements(
 	user = frappe.get_doc("EBICS User", ebics_user)
 	user.check_permission("read")
 
-	frappe.enqueue(
-		sync_ebics_transactions,
+	enqueued = enqueue_sync(
+		"banking.ebics.utils.sync_ebics_transactions",
+		"EBICS User",
+		ebics_user,
 		ebics_user=ebics_user,
 		start_date=from_date,
 		end_date=to_date,
 		passphrase=passphrase,
 	)
+	if not enqueued:
+		frappe.msgprint(
+			_("A Transaction Sync for EBICS User {0} is already queued or running.").format(
+				frappe.bold(ebics_user)
+			),
+			alert=True,
+			indicator="orange",
+		)
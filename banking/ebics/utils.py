@@ -5,9 +5,11 @@ import frappe
 from frappe import _
 
 from banking.ebics.manager import EBICSManager
+from banking.fingerprint import DuplicateFilter, get_transaction_fingerprint
+from banking.party_index import set_party
 
 if TYPE_CHECKING:
-	from datetime import date
+	from frappe.model.document import Document
 	from .types import SEPATransaction
 	from banking.ebics.doctype.ebics_user.ebics_user import EBICSUser
 
@@ -72,6 +74,7 @@ def sync_ebics_transactions(
 			)
 			continue
 
+		bank_transactions = []
 		for transaction in camt_document:
 			if transaction.status != "BOOK":
 				# Skip PDNG and INFO transactions
@@ -81,21 +84,35 @@ def sync_ebics_transactions(
 				# Split batch transactions into sub-transactions, based on info
 				# from camt.054 that is sometimes available.
 				# If that's not possible, create a single transaction
-				for sub_transaction in transaction:
-					_create_bank_transaction(
-						bank_account, user.company, sub_transaction, user.start_date
-					)
+				sepa_transactions = list(transaction)
 			else:
-				_create_bank_transaction(bank_account, user.company, transaction, user.start_date)
+				sepa_transactions = [transaction]
 
+			for sepa_transaction in sepa_transactions:
+				if user.start_date and sepa_transaction.date < user.start_date:
+					continue
 
-def _create_bank_transaction(
+				bank_transactions.append(
+					_make_bank_transaction(bank_account, user.company, sepa_transaction)
+				)
+
+		duplicates = DuplicateFilter(bank_account, bank_transactions)
+		for bank_transaction in bank_transactions:
+			if duplicates.is_duplicate(bank_transaction):
+				continue
+
+			set_party(bank_transaction)
+			with contextlib.suppress(frappe.exceptions.UniqueValidationError):
+				bank_transaction.insert()
+				bank_transaction.submit()
+
+
+def _make_bank_transaction(
 	bank_account: str,
 	company: str,
 	sepa_transaction: "SEPATransaction",
-	start_date: "date" = None,
-):
-	"""Create an ERPNext Bank Transaction from a given fintech.sepa.SEPATransaction.
+) -> "Document":
+	"""Return a new, unsaved ERPNext Bank Transaction for a given fintech.sepa.SEPATransaction.
 
 	https://www.joonis.de/en/fintech/doc/sepa/#fintech.sepa.SEPATransaction
 	"""
@@ -105,16 +122,6 @@ def _create_bank_transaction(
 		sepa_transaction.bank_reference or sepa_transaction._xmlobj.Refs.TxId.text
 	)
 
-	# NOTE: This does not work for old data, this ID is different from Kosma's
-	if transaction_id and frappe.db.exists(
-		"Bank Transaction",
-		{"transaction_id": transaction_id, "bank_account": bank_account},
-	):
-		return
-
-	if start_date and sepa_transaction.date < start_date:
-		return
-
 	bt = frappe.new_doc("Bank Transaction")
 	bt.date = sepa_transaction.date
 	bt.bank_account = bank_account
@@ -130,7 +137,7 @@ def _create_bank_transaction(
 	bt.transaction_id = transaction_id
 	bt.bank_party_iban = sepa_transaction.iban
 	bt.bank_party_name = sepa_transaction.name
+	# The transaction ID differs from Kosma's, the fingerprint doesn't
+	bt.fingerprint = get_transaction_fingerprint(bt)
 
-	with contextlib.suppress(frappe.exceptions.UniqueValidationError):
-		bt.insert()
-		bt.submit()
+	return bt
@@ -0,0 +1,124 @@
+# Copyright (c) 2024, ALYF GmbH and contributors
+# For license information, please see license.txt
+"""Per-day exchange rates for a date window, loaded with a single query.
+
+Matching compares amounts of vouchers in other currencies with the bank
+transaction. Instead of looking up a rate per voucher, the Currency Exchange
+records of the window are loaded once per request and searched in memory.
+"""
+import datetime
+from bisect import bisect_right
+
+import frappe
+from frappe.utils import add_days, flt, getdate
+
+from erpnext.setup.utils import get_exchange_rate
+
+# Use rates up to this many days older than the window, e.g. over weekends
+RATE_LOOKBACK_DAYS = 7
+
+
+class ExchangeRateTable:
+	"""Exchange rates of several currencies to one currency, by day."""
+
+	def __init__(self, to_currency: str) -> None:
+		self.to_currency = to_currency
+		self.dates = {}  # {from_currency: [date, ...]}, sorted
+		self.rates = {}  # {from_currency: [rate, ...]}
+		self.fallback = {}  # {(from_currency, date): rate}
+
+	def add(self, from_currency: str, date: datetime.date, rate: float) -> None:
+		"""Add a rate. Rates must be added in ascending order of date."""
+		self.dates.setdefault(from_currency, []).append(date)
+		self.rates.setdefault(from_currency, []).append(rate)
+
+	def get_rate(self, from_currency: str, date: str | datetime.date) -> float | None:
+		"""Return the latest rate on or before `date`.
+
+		If the window has no such rate, fall back to ERPNext's rate for the day.
+		"""
+		if from_currency == self.to_currency:
+			return 1.0
+
+		date = getdate(date)
+		dates = self.dates.get(from_currency)
+		if dates:
+			idx = bisect_right(dates, date)
+			if idx:
+				return self.rates[from_currency][idx - 1]
+
+		key = (from_currency, date)
+		if key not in self.fallback:
+			self.fallback[key] = get_exchange_rate(from_currency, self.to_currency, str(date))
+
+		return self.fallback[key]
+
+
+def get_exchange_rate_table(
+	to_currency: str,
+	from_currencies: set,
+	from_date: str | datetime.date,
+	to_date: str | datetime.date,
+) -> ExchangeRateTable:
+	"""Return the rates of `from_currencies` to `to_currency` between two dates."""
+	from_currencies = frozenset(from_currencies) - {to_currency}
+	from_date, to_date = getdate(from_date), getdate(to_date)
+	if not hasattr(frappe.local, "banking_exchange_rates"):
+		frappe.local.banking_exchange_rates = {}
+
+	key = (to_currency, from_currencies, from_date, to_date)
+	if key not in frappe.local.banking_exchange_rates:
+		frappe.local.banking_exchange_rates[key] = load_exchange_rates(
+			to_currency, from_currencies, from_date, to_date
+		)
+
+	return frappe.local.banking_exchange_rates[key]
+
+
+def load_exchange_rates(
+	to_currency: str,
+	from_currencies: frozenset,
+	from_date: datetime.date,
+	to_date: datetime.date,
+) -> ExchangeRateTable:
+	table = ExchangeRateTable(to_currency)
+	if not from_currencies:
+		return table
+
+	exchange = frappe.qb.DocType("Currency Exchange")
+	rows = (
+		frappe.qb.from_(exchange)
+		.select(
+			exchange.date,
+			exchange.from_currency,
+			exchange.to_currency,
+			exchange.exchange_rate,
+		)
+		.where(
+			(
+				exchange.from_currency.isin(list(from_currencies))
+				& (exchange.to_currency == to_currency)
+			)
+			| (
+				(exchange.from_currency == to_currency)
+				& exchange.to_currency.isin(list(from_currencies))
+			)
+		)
+		.where(exchange.date.between(add_days(from_date, -RATE_LOOKBACK_DAYS), to_date))
+		.where(exchange.exchange_rate > 0)
+		.orderby(exchange.date)
+		.run()
+	)
+
+	rates = {}
+	for date, from_currency, rate_to_currency, rate in rows:
+		if rate_to_currency == to_currency:
+			rates[(from_currency, date)] = flt(rate)
+		else:
+			# inverse rate, only used if there is no direct one for the day
+			rates.setdefault((rate_to_currency, date), 1 / flt(rate))
+
+	for (from_currency, date), rate in sorted(rates.items(), key=lambda item: item[0][1]):
+		table.add(from_currency, date, rate)
+
+	return table
@@ -0,0 +1,126 @@
+# Copyright (c) 2024, ALYF GmbH and contributors
+# For license information, please see license.txt
+"""Provider independent fingerprints of Bank Transactions.
+
+Every provider has its own transaction IDs: EBICS uses the bank reference,
+Kosma an ID of its own. After switching the provider of a Bank Account, the
+same transactions would be imported a second time. The fingerprint is a hash
+of the values all providers agree on: bank account, date, signed amount,
+counterparty IBAN and end-to-end reference. It is always computed from the
+stored Bank Transaction (see `get_transaction_fingerprint`), so that imported,
+manually created and backfilled transactions use the same date.
+
+Identical payments on the same day, e.g. two card payments at the same shop,
+have the same fingerprint. A transaction is therefore only a duplicate if the
+fingerprint has been imported more often than it occurs in the batch so far.
+"""
+import hashlib
+from collections import Counter
+
+import frappe
+from frappe.utils import flt, getdate
+
+from banking.party_index import normalize_iban
+
+# Placeholder for a missing end-to-end reference in SEPA messages
+NOT_PROVIDED = "NOTPROVIDED"
+
+
+def get_fingerprint(
+	bank_account: str,
+	date,
+	amount: float,
+	counterparty_iban: str | None = None,
+	end_to_end_reference: str | None = None,
+) -> str:
+	"""Return the fingerprint of a transaction. `amount` is negative for withdrawals."""
+	reference = (end_to_end_reference or "").strip().upper()
+	if reference == NOT_PROVIDED:
+		reference = ""
+
+	key = "\0".join(
+		(
+			bank_account,
+			getdate(date).isoformat(),
+			f"{flt(amount, 2):.2f}",
+			normalize_iban(counterparty_iban) or "",
+			reference,
+		)
+	)
+	return hashlib.sha1(key.encode()).hexdigest()
+
+
+def get_transaction_fingerprint(doc) -> str:
+	"""Return the fingerprint of a Bank Transaction, used by all importers."""
+	return get_fingerprint(
+		doc.bank_account,
+		doc.date,
+		flt(doc.deposit) - flt(doc.withdrawal),
+		doc.bank_party_iban,
+		doc.reference_number,
+	)
+
+
+def set_fingerprint(doc, method=None) -> None:
+	"""Set the fingerprint of Bank Transactions that were not created by an importer."""
+	if not doc.fingerprint and doc.bank_account and doc.date:
+		doc.fingerprint = get_transaction_fingerprint(doc)
+
+
+class DuplicateFilter:
+	"""Tell which transactions of a batch have been imported before, using a single query.
+
+	The transactions must have their fingerprint set.
+	"""
+
+	def __init__(self, bank_account: str, transactions: list) -> None:
+		self.transaction_ids = set()
+		self.fingerprints = Counter()
+
+		fingerprints = {doc.fingerprint for doc in transactions if doc.fingerprint}
+		transaction_ids = {doc.transaction_id for doc in transactions if doc.transaction_id}
+		if not fingerprints and not transaction_ids:
+			return
+
+		bt = frappe.qb.DocType("Bank Transaction")
+		condition = None
+		if fingerprints:
+			condition = bt.fingerprint.isin(list(fingerprints))
+		if transaction_ids:
+			id_condition = bt.transaction_id.isin(list(transaction_ids))
+			condition = id_condition if condition is None else condition | id_condition
+
+		for fingerprint, transaction_id in (
+			frappe.qb.from_(bt)
+			.select(bt.fingerprint, bt.transaction_id)
+			.where(bt.bank_account == bank_account)
+			.where(condition)
+			.run()
+		):
+			if transaction_id:
+				self.transaction_ids.add(transaction_id)
+			if fingerprint:
+				self.fingerprints[fingerprint] += 1
+
+	def is_duplicate(self, doc) -> bool:
+		"""Return True if `doc` has been imported before. Otherwise, remember it as imported."""
+		if doc.transaction_id in self.transaction_ids:
+			# imported by the same provider, its fingerprint is used up
+			self.use_fingerprint(doc.fingerprint)
+			return True
+
+		if self.use_fingerprint(doc.fingerprint):
+			# imported by another provider
+			return True
+
+		if doc.transaction_id:
+			self.transaction_ids.add(doc.transaction_id)
+
+		return False
+
+	def use_fingerprint(self, fingerprint: str | None) -> bool:
+		if not self.fingerprints[fingerprint]:
+			return False
+
+		self.fingerprints[fingerprint] -= 1
+		return True
@@ -66,6 +66,7 @@ app_include_css = "bank_reconciliation_beta.bundle.css"
 
 # before_install = "banking.install.before_install"
 after_install = "banking.install.after_install"
+after_migrate = "banking.install.add_indexes"
 
 # Uninstallation
 # ------------
@@ -105,8 +106,36 @@ override_doctype_class = {
 
 doc_events = {
 	"Bank Transaction": {
-		"on_update_after_submit": "banking.overrides.bank_transaction.on_update_after_submit",
-	}
+		"validate": "banking.fingerprint.set_fingerprint",
+		"on_submit": "banking.klarna_kosma_integration.doctype.bank_reconciliation_summary.bank_reconciliation_summary.on_submit",
+		"on_update_after_submit": [
+			"banking.overrides.bank_transaction.on_update_after_submit",
+			"banking.klarna_kosma_integration.doctype.bank_reconciliation_summary.bank_reconciliation_summary.on_update_after_submit",
+			"banking.party_index.learn_party",
+		],
+		"on_cancel": "banking.klarna_kosma_integration.doctype.bank_reconciliation_summary.bank_reconciliation_summary.on_cancel",
+	},
+	("Bank Account", "Account", "Currency"): {
+		"on_update": "banking.metadata_cache.clear_cache",
+		"on_trash": "banking.metadata_cache.clear_cache",
+	},
+	"Bank Account": {
+		"on_update": "banking.party_index.clear_party_index",
+		"on_trash": "banking.party_index.clear_party_index",
+	},
+	("Customer", "Supplier", "Employee"): {
+		"on_update": "banking.party_name_index.on_update",
+		"after_rename": "banking.party_name_index.after_rename",
+		"on_trash": "banking.party_name_index.on_trash",
+	},
+	"Period Closing Voucher": {
+		"on_submit": "banking.metadata_cache.clear_cache",
+		"on_cancel": "banking.metadata_cache.clear_cache",
+	},
+	("Custom Field", "DocType"): {
+		"on_update": "banking.klarna_kosma_integration.doctype.bank_reconciliation_tool_beta.utils.clear_reference_field_map",
+		"on_trash": "banking.klarna_kosma_integration.doctype.bank_reconciliation_tool_beta.utils.clear_reference_field_map",
+	},
 }
 
 # Scheduled Tasks
@@ -183,7 +212,57 @@ kosma_custom_fields = {
 			insert_after="mask",
 			read_only=1,
 			translatable=0,
-		)
+		),
+		dict(
+			fieldname="amount_tolerance_section",
+			label="Amount Tolerance",
+			fieldtype="Section Break",
+			insert_after="kosma_account_id",
+			collapsible=1,
+			depends_on="is_company_account",
+		),
+		dict(
+			fieldname="amount_tolerance_type",
+			label="Amount Tolerance Type",
+			fieldtype="Select",
+			options="Absolute\nPercentage",
+			default="Absolute",
+			insert_after="amount_tolerance_section",
+		),
+		dict(
+			fieldname="amount_tolerance",
+			label="Amount Tolerance",
+			fieldtype="Float",
+			insert_after="amount_tolerance_type",
+			non_negative=1,
+			description="Match vouchers whose amount differs from the bank transaction by up to this amount or percentage, e.g. because of bank fees or early payment discounts",
+		),
+		dict(
+			fieldname="column_break_amount_tolerance",
+			fieldtype="Column Break",
+			insert_after="amount_tolerance",
+		),
+		dict(
+			fieldname="write_off_account",
+			label="Write Off Account",
+			fieldtype="Link",
+			options="Account",
+			insert_after="column_break_amount_tolerance",
+			depends_on="amount_tolerance",
+			description="Propose to write off differences within the tolerance to this account when reconciling unpaid invoices",
+		),
+	],
+	"Bank Transaction": [
+		dict(
+			fieldname="fingerprint",
+			label="Fingerprint",
+			fieldtype="Data",
+			insert_after="transaction_id",
+			read_only=1,
+			hidden=1,
+			no_copy=1,
+			translatable=0,
+		),
 	],
 	"Bank": [
 		dict(
@@ -227,4 +306,19 @@ kosma_property_setters = {
 	]
 }
 
+# Composite indexes for the matching and ingestion queries
+banking_indexes = {
+	"Payment Entry": [
+		["paid_to", "docstatus", "clearance_date", "posting_date"],
+		["paid_from", "docstatus", "clearance_date", "posting_date"],
+	],
+	"Journal Entry Account": [["account", "parent"]],
+	"Journal Entry": [["clearance_date", "docstatus", "posting_date"]],
+	"Bank Transaction": [
+		["bank_account", "docstatus", "unallocated_amount", "date"],
+		["bank_account", "transaction_id"],
+		["bank_account", "fingerprint"],
+	],
+}
+
 get_matching_queries = "banking.klarna_kosma_integration.doctype.bank_reconciliation_tool_beta.bank_reconciliation_tool_beta.get_matching_queries"
@@ -9,6 +9,14 @@ def after_install():
 
 	create_custom_fields(frappe.get_hooks("kosma_custom_fields"))
 	make_property_setters()
+	add_indexes()
+
+
+def add_indexes():
+	"""Add the composite indexes declared in `banking_indexes`, if missing."""
+	for doctype, indexes in frappe.get_hooks("banking_indexes", {}).items():
+		for fields in indexes:
+			frappe.db.add_index(doctype, fields)
 
 
 def make_property_setters():
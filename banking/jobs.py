@@ -0,0 +1,87 @@
+# Copyright (c) 2024, ALYF GmbH and contributors
+# For license information, please see license.txt
+"""Keyed background jobs for bank transaction syncs.
+
+Every sync job gets a job ID derived from the synced record, e.g.
+`banking-sync::bank_account::Girokonto - Testbank`. A job for a key is only
+enqueued if no job with the same key is queued or running, so that two workers
+never sync the same account at the same time.
+"""
+from typing import Optional
+
+import frappe
+from frappe.utils import now_datetime
+from frappe.utils.background_jobs import get_job_status, is_job_enqueued
+
+SYNC_STATUS_CACHE_KEY = "banking_sync_status"
+
+
+def get_sync_job_id(doctype: str, name: str) -> str:
+	return f"banking-sync::{frappe.scrub(doctype)}::{name}"
+
+
+def enqueue_sync(method: str, doctype: str, name: str, now: bool = False, **kwargs) -> bool:
+	"""Enqueue `method` as the sync job for the given record.
+
+	Returns False if a sync job for this record is already queued or running.
+	Pass `now` to run the sync in the current process instead.
+	"""
+	job_id = get_sync_job_id(doctype, name)
+	if is_job_enqueued(job_id):
+		return False
+
+	frappe.enqueue(
+		"banking.jobs.run_sync_job",
+		queue="long",
+		job_id=job_id,
+		deduplicate=True,
+		now=now,
+		sync_method=method,
+		doctype=doctype,
+		name=name,
+		**kwargs,
+	)
+	return True
+
+
+def run_sync_job(sync_method: str, doctype: str, name: str, **kwargs) -> None:
+	"""Run the sync and record when it finished."""
+	status = "Failed"
+	try:
+		frappe.get_attr(sync_method)(**kwargs)
+		status = "Finished"
+	finally:
+		set_last_sync(doctype, name, status)
+
+
+def set_last_sync(doctype: str, name: str, status: str) -> None:
+	frappe.cache.hset(
+		SYNC_STATUS_CACHE_KEY,
+		get_sync_job_id(doctype, name),
+		{"status": status, "finished_at": now_datetime()},
+	)
+
+
+def get_last_sync(doctype: str, name: str) -> Optional[dict]:
+	return frappe.cache.hget(SYNC_STATUS_CACHE_KEY, get_sync_job_id(doctype, name))
+
+
+def get_sync_state(doctype: str, name: str) -> dict:
+	"""Return the current job state and the last finished sync of a record."""
+	job_status = get_job_status(get_sync_job_id(doctype, name))
+	last_sync = get_last_sync(doctype, name) or {}
+
+	if job_status and job_status.value == "queued":
+		state = "Queued"
+	elif job_status and job_status.value == "started":
+		state = "Running"
+	else:
+		state = "Idle"
+
+	return {
+		"doctype": doctype,
+		"name": name,
+		"state": state,
+		"last_status": last_sync.get("status"),
+		"last_finished": last_sync.get("finished_at"),
+	}
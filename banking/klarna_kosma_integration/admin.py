@@ -20,6 +20,7 @@ from banking.klarna_kosma_integration.utils import (
 	get_current_ip,
 	get_from_to_date,
 	get_session_flow_ids,
+	persist_consent_token,
 	set_session_state,
 	to_json,
 )
@@ -136,21 +137,27 @@ class Admin:
 			set_session_state(session_id_short, transactions_value)
 
 	def consent_accounts(self, bank: str, company: str):
+		new_consent_token = None
 		try:
 			consent_id, consent_token = get_consent_data(bank, company)
 
 			accounts_response = self.request.consent_accounts(consent_id, consent_token)
 			accounts_response_value = to_json(accounts_response).get("message", {})
 
-			exchange_consent_token(accounts_response_value, bank, company)
+			new_consent_token = exchange_consent_token(accounts_response_value)
 			accounts_response.raise_for_status()
 
+			persist_consent_token(bank, company, new_consent_token)
+			frappe.db.commit()
+
 			return accounts_response_value.get("result", {}).get("accounts", [])
 		except Exception as exc:
+			save_rotated_token(bank, company, new_consent_token)
 			ExceptionHandler(exc)
 
 	def consent_transactions(self, account: str, start_date: str):
 		next_page, url, offset = True, None, None
+		new_consent_token = None
 		try:
 			account_id, bank, company = frappe.db.get_value(
 				"Bank Account", account, ["kosma_account_id", "bank", "company"]
@@ -162,7 +169,8 @@ class Admin:
 				)
 				transactions_value = to_json(response).get("message", {})
 
-				new_consent_token = exchange_consent_token(transactions_value, bank, company)
+				# Hold the rotated token in memory until the page is written
+				new_consent_token = exchange_consent_token(transactions_value)
 				response.raise_for_status()
 
 				# Process Request Response
@@ -170,11 +178,17 @@ class Admin:
 				next_page = transaction.is_next_page()
 				if next_page:
 					url, offset = transaction.next_page_request()
-					consent_token = new_consent_token
 
 				if transaction.transaction_list:
 					create_bank_transactions(account, transaction.transaction_list)
+
+				# Commit the page's transactions together with the token for the next page
+				if new_consent_token:
+					persist_consent_token(bank, company, new_consent_token)
+					consent_token, new_consent_token = new_consent_token, None
+				frappe.db.commit()
 		except Exception as exc:
+			save_rotated_token(bank, company, new_consent_token)
 			ExceptionHandler(exc)
 
 	def end_session(self, session_id: str, session_id_short: str) -> None:
@@ -229,3 +243,16 @@ def sync_kosma_transactions(account: str, session_id_short: Optional[str] = None
 	else:
 		start_date = account_last_sync_date(account)
 		Admin().consent_transactions(account, start_date)
+
+
+def save_rotated_token(bank: str, company: str, consent_token: Optional[str]) -> None:
+	"""Keep a token that was rotated by a failed request, without the failed page's data.
+
+	The admin backend may already have invalidated the previous token.
+	"""
+	if not consent_token:
+		return
+
+	frappe.db.rollback()
+	persist_consent_token(bank, company, consent_token)
+	frappe.db.commit()
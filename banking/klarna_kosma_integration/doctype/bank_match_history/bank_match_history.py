@@ -0,0 +1,239 @@
+# Copyright (c) 2024, ALYF GmbH and contributors
+# For license information, please see license.txt
+import hashlib
+
+import frappe
+from frappe.model.document import Document
+from frappe.query_builder.functions import Sum
+from frappe.utils import getdate, now_datetime
+from pypika import Order
+
+from banking.metadata_cache import get_cached_values
+from banking.party_index import normalize_iban
+from banking.party_name_index import normalize_name
+
+# Words that differ between otherwise identical recurring payments
+VOLATILE_WORDS = {
+	"jan",
+	"januar",
+	"january",
+	"feb",
+	"februar",
+	"february",
+	"mar",
+	"marz",
+	"march",
+	"apr",
+	"april",
+	"mai",
+	"may",
+	"jun",
+	"juni",
+	"june",
+	"jul",
+	"juli",
+	"july",
+	"aug",
+	"august",
+	"sep",
+	"sept",
+	"september",
+	"okt",
+	"oct",
+	"oktober",
+	"october",
+	"nov",
+	"november",
+	"dez",
+	"dec",
+	"dezember",
+	"december",
+}
+MAX_DESCRIPTION_WORDS = 10
+
+
+class BankMatchHistory(Document):
+	def autoname(self):
+		self.name = get_history_name(
+			self.key_type,
+			self.match_key,
+			self.company,
+			self.payment_document,
+			self.party_type,
+			self.party,
+			self.account,
+		)
+
+
+def on_doctype_update():
+	frappe.db.add_index("Bank Match History", ["key_type", "match_key"])
+
+
+def get_history_name(*values) -> str:
+	key = "\0".join(str(value or "") for value in values)
+	return hashlib.sha1(key.encode()).hexdigest()[:20]
+
+
+def get_description_key(description: str | None) -> str | None:
+	"""Return the sorted, distinct words of a description, without numbers and months."""
+	words = {
+		word
+		for word in normalize_name(description).split()
+		if len(word) > 2
+		and not any(char.isdigit() for char in word)
+		and word not in VOLATILE_WORDS
+	}
+	return " ".join(sorted(words)[:MAX_DESCRIPTION_WORDS])[:140] or None
+
+
+def get_history_keys(transaction) -> list[tuple[str, str]]:
+	"""Return the (key_type, key) pairs a Bank Transaction's history is recorded under."""
+	keys = []
+	if iban := normalize_iban(transaction.bank_party_iban):
+		keys.append(("IBAN", iban))
+	if description_key := get_description_key(transaction.description):
+		keys.append(("Description", description_key))
+
+	return keys
+
+
+def get_match_history(transaction, limit: int = 10) -> list[dict]:
+	"""Return the parties and accounts matched to similar Bank Transactions, most frequent first."""
+	keys = get_history_keys(transaction)
+	if not keys:
+		return []
+
+	history = frappe.qb.DocType("Bank Match History")
+	key_condition = None
+	for key_type, key in keys:
+		condition = (history.key_type == key_type) & (history.match_key == key)
+		key_condition = condition if key_condition is None else key_condition | condition
+
+	match_count = Sum(history.match_count)
+	return (
+		frappe.qb.from_(history)
+		.select(
+			history.payment_document,
+			history.party_type,
+			history.party,
+			history.account,
+			match_count.as_("match_count"),
+		)
+		.where(key_condition)
+		.where(history.company == transaction.company)
+		.groupby(history.payment_document, history.party_type, history.party, history.account)
+		.orderby(match_count, order=Order.desc)
+		.limit(limit)
+		.run(as_dict=True)
+	)
+
+
+def get_matched_parties(transaction) -> set[tuple[str, str]]:
+	"""Return the (party_type, party) historically matched to similar Bank Transactions."""
+	return {
+		(row.party_type, row.party)
+		for row in get_match_history(transaction)
+		if row.party_type and row.party
+	}
+
+
+def record_matches(transaction) -> None:
+	"""Add the vouchers newly allocated to a Bank Transaction to the match history."""
+	keys = get_history_keys(transaction)
+	if not keys:
+		return
+
+	doc_before_save = transaction.get_doc_before_save()
+	before = (
+		{(row.payment_document, row.payment_entry) for row in doc_before_save.payment_entries}
+		if doc_before_save
+		else set()
+	)
+	vouchers = {}
+	for row in transaction.payment_entries:
+		if (row.payment_document, row.payment_entry) not in before:
+			vouchers.setdefault(row.payment_document, []).append(row.payment_entry)
+
+	if not vouchers:
+		return
+
+	bank_gl_account = get_cached_values("Bank Account", transaction.bank_account).account
+	matches = set()
+	if payment_entries := vouchers.get("Payment Entry"):
+		for payment_type, party_type, party, paid_from, paid_to in frappe.get_all(
+			"Payment Entry",
+			filters={"name": ("in", payment_entries)},
+			fields=["payment_type", "party_type", "party", "paid_from", "paid_to"],
+			as_list=True,
+		):
+			account = paid_from if payment_type == "Receive" else paid_to
+			matches.add(("Payment Entry", party_type, party, account))
+
+	if journal_entries := vouchers.get("Journal Entry"):
+		for party_type, party, account in frappe.get_all(
+			"Journal Entry Account",
+			filters={"parent": ("in", journal_entries), "account": ("!=", bank_gl_account)},
+			fields=["party_type", "party", "account"],
+			as_list=True,
+		):
+			matches.add(("Journal Entry", party_type, party, account))
+
+	for key_type, key in keys:
+		for payment_document, party_type, party, account in matches:
+			add_match(
+				frappe._dict(
+					key_type=key_type,
+					match_key=key,
+					company=transaction.company,
+					payment_document=payment_document,
+					party_type=party_type or None,
+					party=party or None,
+					account=account,
+				)
+			)
+
+
+def add_match(match: frappe._dict) -> None:
+	name = get_history_name(
+		match.key_type,
+		match.match_key,
+		match.company,
+		match.payment_document,
+		match.party_type,
+		match.party,
+		match.account,
+	)
+	today = getdate()
+	if not frappe.db.exists("Bank Match History", name):
+		frappe.db.savepoint("bank_match_history")
+		try:
+			frappe.get_doc(
+				{
+					"doctype": "Bank Match History",
+					**match,
+					"match_count": 1,
+					"last_matched_on": today,
+				}
+			).insert(ignore_permissions=True)
+			return
+		except frappe.DuplicateEntryError:
+			# inserted by a concurrent request, count it below
+			frappe.db.rollback(save_point="bank_match_history")
+
+	history = frappe.qb.DocType("Bank Match History")
+	(
+		frappe.qb.update(history)
+		.set(history.match_count, history.match_count + 1)
+		.set(history.last_matched_on, today)
+		.set(history.modified, now_datetime())
+		.where(history.name == name)
+	).run()
+
+
+@frappe.whitelist()
+def get_match_suggestions(bank_transaction_name: str) -> list[dict]:
+	"""Return what similar Bank Transactions were reconciled with, most frequent first."""
+	transaction = frappe.get_doc("Bank Transaction", bank_transaction_name)
+	transaction.check_permission("read")
+
+	return get_match_history(transaction)
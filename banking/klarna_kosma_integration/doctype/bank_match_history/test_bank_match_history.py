@@ -0,0 +1,83 @@
+# Copyright (c) 2024, ALYF GmbH and Contributors
+# See license.txt
+import json
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from erpnext.accounts.doctype.bank_transaction.test_bank_transaction import (
+	create_gl_account,
+)
+from erpnext.accounts.doctype.payment_entry.test_payment_entry import (
+	create_payment_entry,
+)
+
+from banking.klarna_kosma_integration.doctype.bank_match_history.bank_match_history import (
+	get_description_key,
+	get_match_history,
+)
+from banking.klarna_kosma_integration.doctype.bank_reconciliation_tool_beta.bank_reconciliation_tool_beta import (
+	bulk_reconcile_vouchers,
+)
+from banking.klarna_kosma_integration.doctype.bank_reconciliation_tool_beta.test_bank_reconciliation_tool_beta import (
+	create_bank,
+	create_bank_account,
+	create_bank_transaction,
+	create_customer,
+)
+
+
+class TestBankMatchHistory(FrappeTestCase):
+	@classmethod
+	def setUpClass(cls) -> None:
+		super().setUpClass()
+		create_bank()
+		cls.gl_account = create_gl_account("_Test Bank Match History")
+		cls.bank_account = create_bank_account(
+			gl_account=cls.gl_account, bank_account_name="Match History Account"
+		)
+		cls.customer = create_customer(customer_name="ABC Inc.")
+
+	def setUp(self) -> None:
+		frappe.db.savepoint(save_point="bank_match_history_before_tests")
+
+	def tearDown(self) -> None:
+		frappe.db.rollback(save_point="bank_match_history_before_tests")
+
+	def test_description_key(self):
+		self.assertEqual(
+			get_description_key("Office Rent March 2024, Contract 4711"),
+			get_description_key("OFFICE RENT APRIL 2024 CONTRACT 4711"),
+		)
+		self.assertEqual(get_description_key("Office Rent March 2024"), "office rent")
+		self.assertIsNone(get_description_key("12.03.2024 4711"))
+
+	def test_history_is_recorded(self):
+		bt = create_bank_transaction(
+			deposit=300, bank_account=self.bank_account, description="Office rent March 2024"
+		)
+		pe = create_payment_entry(
+			payment_type="Receive",
+			party_type="Customer",
+			party=self.customer,
+			paid_from="Debtors - _TC",
+			paid_to=self.gl_account,
+			paid_amount=300,
+			save=1,
+			submit=1,
+		)
+		bulk_reconcile_vouchers(
+			bt.name,
+			json.dumps([{"payment_doctype": "Payment Entry", "payment_name": pe.name}]),
+		)
+
+		next_bt = create_bank_transaction(
+			deposit=300, bank_account=self.bank_account, description="Office rent April 2024"
+		)
+		history = get_match_history(next_bt)
+		self.assertEqual(len(history), 1)
+		self.assertEqual(history[0].payment_document, "Payment Entry")
+		self.assertEqual(history[0].party_type, "Customer")
+		self.assertEqual(history[0].party, self.customer)
+		self.assertEqual(history[0].account, "Debtors - _TC")
+		self.assertEqual(history[0].match_count, 1)
@@ -0,0 +1,8 @@
+// Copyright (c) 2024, ALYF GmbH and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('Bank Reconciliation Summary', {
+	// refresh: function(frm) {
+
+	// }
+});
@@ -0,0 +1,238 @@
+# Copyright (c) 2024, ALYF GmbH and contributors
+# For license information, please see license.txt
+import datetime
+
+import frappe
+from frappe.model.document import Document
+from frappe.query_builder.functions import Count, Sum
+from frappe.utils import add_days, flt, getdate, now_datetime
+from pypika import Order
+
+SUMMARY_FIELDS = (
+	"deposit",
+	"withdrawal",
+	"allocated_amount",
+	"unallocated_amount",
+	"transaction_count",
+	"unreconciled_count",
+)
+# Totals of all days up to and including a row's day
+RUNNING_FIELDS = {fieldname: f"running_{fieldname}" for fieldname in SUMMARY_FIELDS}
+
+
+class BankReconciliationSummary(Document):
+	def autoname(self):
+		self.name = get_summary_name(self.bank_account, self.date)
+
+
+def on_doctype_update():
+	frappe.db.add_index("Bank Reconciliation Summary", ["bank_account", "date"])
+
+
+def get_summary_name(bank_account: str, date: str | datetime.date) -> str:
+	return f"{bank_account}::{getdate(date).isoformat()}"
+
+
+def get_contribution(doc: Document, sign: int = 1) -> dict:
+	"""Return what a submitted Bank Transaction adds to its day's summary."""
+	unallocated_amount = flt(doc.unallocated_amount)
+	return {
+		"deposit": sign * flt(doc.deposit),
+		"withdrawal": sign * flt(doc.withdrawal),
+		"allocated_amount": sign * flt(doc.allocated_amount),
+		"unallocated_amount": sign * unallocated_amount,
+		"transaction_count": sign,
+		"unreconciled_count": sign if unallocated_amount > 0.001 else 0,
+	}
+
+
+def add_to_summary(doc: Document, delta: dict) -> None:
+	"""Add `delta` to the summary of the Bank Transaction's account and day.
+
+	The running totals of this and all later days of the account change, too.
+	Most changes concern recent days, so only a few rows are updated.
+	"""
+	if not doc.bank_account or not any(delta.values()):
+		return
+
+	date = getdate(doc.date)
+	name = get_summary_name(doc.bank_account, date)
+	if not frappe.db.exists("Bank Reconciliation Summary", name):
+		# start from the running totals of the previous day
+		previous = get_running_totals(doc.bank_account, add_days(date, -1))
+		frappe.db.savepoint("bank_reconciliation_summary")
+		try:
+			frappe.get_doc(
+				{
+					"doctype": "Bank Reconciliation Summary",
+					"bank_account": doc.bank_account,
+					"date": date,
+					"company": doc.company,
+					"currency": doc.currency,
+					**dict.fromkeys(SUMMARY_FIELDS, 0),
+					**{RUNNING_FIELDS[fieldname]: value for fieldname, value in previous.items()},
+				}
+			).insert(ignore_permissions=True)
+		except frappe.DuplicateEntryError:
+			# inserted by a concurrent request, add to it below
+			frappe.db.rollback(save_point="bank_reconciliation_summary")
+
+	summary = frappe.qb.DocType("Bank Reconciliation Summary")
+	day_query = (
+		frappe.qb.update(summary)
+		.set(summary.modified, now_datetime())
+		.where(summary.name == name)
+	)
+	running_query = (
+		frappe.qb.update(summary)
+		.where(summary.bank_account == doc.bank_account)
+		.where(summary.date >= date)
+	)
+	for fieldname, value in delta.items():
+		day_query = day_query.set(summary[fieldname], summary[fieldname] + value)
+		running_field = summary[RUNNING_FIELDS[fieldname]]
+		running_query = running_query.set(running_field, running_field + value)
+
+	day_query.run()
+	running_query.run()
+
+
+def get_running_totals(bank_account: str, date: str | datetime.date | None = None) -> dict:
+	"""Return the totals of all days up to and including `date`, from a single row."""
+	summary = frappe.qb.DocType("Bank Reconciliation Summary")
+	query = (
+		frappe.qb.from_(summary)
+		.select(
+			*(
+				summary[running_field].as_(fieldname)
+				for fieldname, running_field in RUNNING_FIELDS.items()
+			)
+		)
+		.where(summary.bank_account == bank_account)
+		.orderby(summary.date, order=Order.desc)
+		.limit(1)
+	)
+	if date:
+		query = query.where(summary.date <= date)
+
+	row = query.run(as_dict=True)
+	return {fieldname: flt(row[0][fieldname]) if row else 0.0 for fieldname in SUMMARY_FIELDS}
+
+
+def on_submit(doc, event):
+	add_to_summary(doc, get_contribution(doc))
+
+
+def on_cancel(doc, event):
+	add_to_summary(doc, get_contribution(doc, sign=-1))
+
+
+def on_update_after_submit(doc, event):
+	"""Move the Bank Transaction's contribution from its previous to its current state."""
+	doc_before_save = doc.get_doc_before_save()
+	if not doc_before_save:
+		return
+
+	before = get_contribution(doc_before_save, sign=-1)
+	after = get_contribution(doc)
+	if (doc_before_save.bank_account, getdate(doc_before_save.date)) == (
+		doc.bank_account,
+		getdate(doc.date),
+	):
+		add_to_summary(doc, {key: after[key] + before[key] for key in SUMMARY_FIELDS})
+	else:
+		add_to_summary(doc_before_save, before)
+		add_to_summary(doc, after)
+
+
+@frappe.whitelist()
+def get_summary(
+	bank_account: str,
+	from_date: str | datetime.date = None,
+	to_date: str | datetime.date = None,
+) -> dict:
+	"""
+	Return the totals of the submitted Bank Transactions of a Bank Account
+	between two dates, and the account's balance as per the statement before
+	`from_date` and at `to_date`.
+
+	Answered from the running totals of two rows, independent of the history's length.
+	"""
+	frappe.has_permission("Bank Account", doc=bank_account, throw=True)
+
+	closing = get_running_totals(bank_account, to_date)
+	opening = (
+		get_running_totals(bank_account, add_days(from_date, -1))
+		if from_date
+		else dict.fromkeys(SUMMARY_FIELDS, 0.0)
+	)
+
+	return frappe._dict(
+		{fieldname: flt(closing[fieldname] - opening[fieldname]) for fieldname in SUMMARY_FIELDS},
+		opening_balance=flt(opening["deposit"] - opening["withdrawal"]),
+		statement_balance=flt(closing["deposit"] - closing["withdrawal"]),
+	)
+
+
+def rebuild_summary(bank_account: str | None = None) -> int:
+	"""Recompute the summary from the Bank Transactions. Returns the number of rows."""
+	bt = frappe.qb.DocType("Bank Transaction")
+	query = (
+		frappe.qb.from_(bt)
+		.select(
+			bt.bank_account,
+			bt.date,
+			bt.company,
+			bt.currency,
+			Sum(bt.deposit),
+			Sum(bt.withdrawal),
+			Sum(bt.allocated_amount),
+			Sum(bt.unallocated_amount),
+			Count(bt.name),
+			Sum(frappe.qb.terms.Case().when(bt.unallocated_amount > 0.001, 1).else_(0)),
+		)
+		.where(bt.docstatus == 1)
+		.where(bt.bank_account.isnotnull())
+		.groupby(bt.bank_account, bt.date, bt.company, bt.currency)
+		.orderby(bt.bank_account)
+		.orderby(bt.date)
+	)
+	if bank_account:
+		query = query.where(bt.bank_account == bank_account)
+
+	rows = []
+	running_totals, previous_account = None, None
+	for row in query.run():
+		if row[0] != previous_account:
+			running_totals, previous_account = [0] * len(SUMMARY_FIELDS), row[0]
+
+		running_totals = [total + flt(value) for total, value in zip(running_totals, row[4:])]
+		rows.append((*row, *running_totals))
+
+	now, user = now_datetime(), frappe.session.user
+
+	frappe.db.delete(
+		"Bank Reconciliation Summary",
+		{"bank_account": bank_account} if bank_account else None,
+	)
+	frappe.db.bulk_insert(
+		"Bank Reconciliation Summary",
+		fields=[
+			"name",
+			"creation",
+			"modified",
+			"owner",
+			"modified_by",
+			"bank_account",
+			"date",
+			"company",
+			"currency",
+			*SUMMARY_FIELDS,
+			*RUNNING_FIELDS.values(),
+		],
+		values=[
+			(get_summary_name(row[0], row[1]), now, now, user, user, *row) for row in rows
+		],
+	)
+
+	return len(rows)
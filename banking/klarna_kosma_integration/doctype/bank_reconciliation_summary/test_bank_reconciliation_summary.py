@@ -0,0 +1,98 @@
+# Copyright (c) 2024, ALYF GmbH and Contributors
+# See license.txt
+import json
+
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_days, getdate
+
+from erpnext.accounts.doctype.bank_transaction.test_bank_transaction import (
+	create_gl_account,
+)
+from erpnext.accounts.doctype.payment_entry.test_payment_entry import (
+	create_payment_entry,
+)
+
+from banking.klarna_kosma_integration.doctype.bank_reconciliation_summary.bank_reconciliation_summary import (
+	get_summary,
+	rebuild_summary,
+)
+from banking.klarna_kosma_integration.doctype.bank_reconciliation_tool_beta.bank_reconciliation_tool_beta import (
+	bulk_reconcile_vouchers,
+)
+from banking.klarna_kosma_integration.doctype.bank_reconciliation_tool_beta.test_bank_reconciliation_tool_beta import (
+	create_bank,
+	create_bank_account,
+	create_bank_transaction,
+	create_customer,
+)
+
+
+class TestBankReconciliationSummary(FrappeTestCase):
+	@classmethod
+	def setUpClass(cls) -> None:
+		super().setUpClass()
+		create_bank()
+		cls.gl_account = create_gl_account("_Test Bank Reco Summary")
+		cls.bank_account = create_bank_account(
+			gl_account=cls.gl_account, bank_account_name="Summary Account"
+		)
+		cls.customer = create_customer(customer_name="ABC Inc.")
+
+	def test_summary_is_maintained(self):
+		yesterday = add_days(getdate(), -1)
+		create_bank_transaction(
+			date=yesterday, deposit=100, bank_account=self.bank_account
+		)
+		bt = create_bank_transaction(deposit=300, bank_account=self.bank_account)
+		create_bank_transaction(withdrawal=50, bank_account=self.bank_account)
+
+		summary = get_summary(self.bank_account)
+		self.assertEqual(summary.transaction_count, 3)
+		self.assertEqual(summary.unreconciled_count, 3)
+		self.assertEqual(summary.deposit, 400)
+		self.assertEqual(summary.withdrawal, 50)
+		self.assertEqual(summary.unallocated_amount, 450)
+		self.assertEqual(summary.statement_balance, 350)
+
+		pe = create_payment_entry(
+			payment_type="Receive",
+			party_type="Customer",
+			party=self.customer,
+			paid_from="Debtors - _TC",
+			paid_to=self.gl_account,
+			paid_amount=300,
+			save=1,
+			submit=1,
+		)
+		bulk_reconcile_vouchers(
+			bt.name,
+			json.dumps([{"payment_doctype": "Payment Entry", "payment_name": pe.name}]),
+		)
+
+		summary = get_summary(self.bank_account, from_date=getdate(), to_date=getdate())
+		self.assertEqual(summary.opening_balance, 100)
+		self.assertEqual(summary.transaction_count, 2)
+		self.assertEqual(summary.unreconciled_count, 1)
+		self.assertEqual(summary.allocated_amount, 300)
+		self.assertEqual(summary.unallocated_amount, 50)
+		self.assertEqual(summary.statement_balance, 350)
+
+		summary = get_summary(self.bank_account, to_date=yesterday)
+		self.assertEqual(summary.transaction_count, 1)
+		self.assertEqual(summary.statement_balance, 100)
+
+		bt.reload()
+		bt.cancel()
+		self.assertEqual(get_summary(self.bank_account).transaction_count, 2)
+
+		# a transaction on an earlier day changes the running totals of the later days
+		create_bank_transaction(
+			date=add_days(getdate(), -2), withdrawal=30, bank_account=self.bank_account
+		)
+		summary = get_summary(self.bank_account, to_date=yesterday)
+		self.assertEqual(summary.transaction_count, 2)
+		self.assertEqual(summary.statement_balance, 70)
+
+		incremental = get_summary(self.bank_account)
+		rebuild_summary(self.bank_account)
+		self.assertEqual(get_summary(self.bank_account), incremental)
@@ -43,6 +43,7 @@ frappe.ui.form.on('Bank Reconciliation Tool Beta', {
 
 		frm.page.add_action_icon("refresh", () => {
 			frm.events.get_bank_transactions(frm);
+			frm.events.get_summary(frm);
 		});
 		frm.change_custom_button_type(__("Get Bank Transactions"), null, "primary");
 
@@ -53,7 +54,7 @@ frappe.ui.form.on('Bank Reconciliation Tool Beta', {
 				),
 				() => {
 					frappe.call({
-						method: "banking.klarna_kosma_integration.doctype.bank_reconciliation_tool_beta.bank_reconciliation_tool_beta.auto_reconcile_vouchers",
+						method: "banking.klarna_kosma_integration.doctype.bank_reconciliation_tool_beta.bank_reconciliation_tool_beta.start_auto_reconcile",
 						args: {
 							bank_account: frm.doc.bank_account,
 							from_date: frm.doc.bank_statement_from_date,
@@ -63,11 +64,18 @@ frappe.ui.form.on('Bank Reconciliation Tool Beta', {
 							from_reference_date: frm.doc.from_reference_date,
 							to_reference_date: frm.doc.to_reference_date,
 						},
-						freeze: true,
-						freeze_message: __("Auto Reconciling ..."),
 						callback: (r) => {
-							if (!r.exc) {
-								frm.refresh();
+							if (r.exc) return;
+
+							if (r.message) {
+								frm.dashboard.show_progress(
+									__("Auto Reconciliation"), 0, __("Auto Reconciling ...")
+								);
+							} else {
+								frappe.show_alert({
+									message: __("Auto Reconciliation is already running for this Bank Account"),
+									indicator: "orange",
+								});
 							}
 						},
 					});
@@ -75,6 +83,26 @@ frappe.ui.form.on('Bank Reconciliation Tool Beta', {
 			);
 		});
 
+		frm.page.add_menu_item(__("Cancel Auto Reconciliation"), function () {
+			frappe.call({
+				method: "banking.klarna_kosma_integration.doctype.bank_reconciliation_tool_beta.bank_reconciliation_tool_beta.cancel_auto_reconcile",
+				args: { bank_account: frm.doc.bank_account },
+				callback: (r) => {
+					if (!r.exc) {
+						frappe.show_alert({
+							message: __("Auto Reconciliation will stop after the current chunk"),
+							indicator: "blue",
+						});
+					}
+				},
+			});
+		});
+
+		frappe.realtime.off("banking_auto_reconcile_progress");
+		frappe.realtime.on("banking_auto_reconcile_progress", (data) => {
+			frm.events.show_auto_reconcile_progress(frm, data);
+		});
+
 		frm.page.add_menu_item(
 			__("Upload a Bank Statement"),
 			() => frm.events.route_to_bank_statement_import(frm),
@@ -86,6 +114,34 @@ frappe.ui.form.on('Bank Reconciliation Tool Beta', {
 		frm.events.build_reconciliation_area(frm);
 	},
 
+	show_auto_reconcile_progress: function(frm, data) {
+		if (data.bank_account !== frm.doc.bank_account) return;
+
+		if (data.status === "Running") {
+			frm.dashboard.show_progress(
+				__("Auto Reconciliation"),
+				data.total ? (data.processed / data.total) * 100 : 100,
+				__("{0} of {1} transactions processed", [data.processed, data.total])
+			);
+			return;
+		}
+
+		frm.dashboard.hide_progress(__("Auto Reconciliation"));
+		if (data.status === "Cancelled") {
+			frappe.show_alert({
+				message: __("Auto Reconciliation Cancelled"),
+				indicator: "orange",
+			});
+		} else {
+			frappe.msgprint({
+				title: __("Auto Reconciliation Complete"),
+				message: data.message,
+				indicator: data.indicator,
+			});
+		}
+		frm.refresh();
+	},
+
 	get_bank_transactions: function(frm) {
 		if (!frm.doc.bank_account) {
 			frappe.throw(
@@ -141,8 +197,7 @@ frappe.ui.form.on('Bank Reconciliation Tool Beta', {
 						(r) => {
 							frm.doc.account_currency = r.account_currency;
 							frm.trigger("get_account_opening_balance");
-							frm.trigger("get_account_closing_balance");
-							frm.trigger("render_summary");
+							frm.trigger("get_summary");
 						}
 					);
 				}
@@ -156,12 +211,12 @@ frappe.ui.form.on('Bank Reconciliation Tool Beta', {
 
 	bank_statement_from_date: function (frm) {
 		frm.trigger("get_account_opening_balance");
+		frm.trigger("get_summary");
 		frm.trigger("get_bank_transactions");
 	},
 
 	bank_statement_to_date: function (frm) {
-		frm.trigger("get_account_closing_balance");
-		frm.trigger("render_summary");
+		frm.trigger("get_summary");
 		frm.trigger("get_bank_transactions");
 	},
 
@@ -186,6 +241,7 @@ frappe.ui.form.on('Bank Reconciliation Tool Beta', {
 	},
 
 	get_account_closing_balance(frm) {
+		frm.cleared_balance = null;
 		if (frm.doc.bank_account && frm.doc.bank_statement_to_date) {
 			return frappe.call({
 				method:
@@ -201,6 +257,28 @@ frappe.ui.form.on('Bank Reconciliation Tool Beta', {
 		}
 	},
 
+	get_summary(frm) {
+		if (!frm.doc.bank_account) return;
+
+		// The balance is the one in the books. The Bank Reconciliation Summary only
+		// provides the counts and totals of the period's Bank Transactions.
+		return Promise.all([
+			frm.events.get_account_closing_balance(frm),
+			frappe.call({
+				method:
+					"banking.klarna_kosma_integration.doctype.bank_reconciliation_summary.bank_reconciliation_summary.get_summary",
+				args: {
+					bank_account: frm.doc.bank_account,
+					from_date: frm.doc.bank_statement_from_date,
+					to_date: frm.doc.bank_statement_to_date,
+				},
+				callback: (response) => {
+					frm.summary = response.message;
+				},
+			}),
+		]).then(() => frm.trigger("render_summary"));
+	},
+
 	setup_empty_state: function(frm) {
 		frm.$reconciliation_area.empty();
 		frm.$reconciliation_area.append(`
@@ -213,22 +291,29 @@ frappe.ui.form.on('Bank Reconciliation Tool Beta', {
 	},
 
 	render_summary: function(frm) {
-		// frm.get_field("reconciliation_tool_cards").$wrapper.empty();
-
-		// frappe.require("bank_reconciliation_beta.bundle.js", () => {
-		// 	let difference = flt(frm.doc.bank_statement_closing_balance) - flt(frm.cleared_balance);
-		// 	let difference_color = difference >= 0 ?  "text-success" : "text-danger";
-
-		// 	frm.summary_card = new erpnext.accounts.bank_reconciliation.SummaryCard({
-		// 		$wrapper: frm.get_field("reconciliation_tool_cards").$wrapper,
-		// 		values: {
-		// 			"Bank Closing Balance": [frm.doc.bank_statement_closing_balance],
-		// 			"ERP Closing Balance": [frm.cleared_balance],
-		// 			"Difference": [difference, difference_color]
-		// 		},
-		// 		currency: frm.doc.account_currency,
-		// 	})
-		// });
+		const $wrapper = frm.get_field("reconciliation_tool_cards").$wrapper;
+		$wrapper.empty();
+		if (!frm.summary) return;
+
+		frappe.require("bank_reconciliation_beta.bundle.js", () => {
+			const summary = frm.summary;
+			const difference = flt(frm.doc.bank_statement_closing_balance) - flt(frm.cleared_balance);
+			const values = {
+				"Bank Closing Balance": [frm.doc.bank_statement_closing_balance],
+				"ERP Closing Balance": [frm.cleared_balance],
+				"Difference": [difference, difference ? "text-danger" : "text-success"],
+				[__("Unreconciled ({0})", [summary.unreconciled_count])]: [
+					summary.unallocated_amount,
+					summary.unreconciled_count ? "text-warning" : "text-success",
+				],
+			};
+
+			frm.summary_card = new erpnext.accounts.bank_reconciliation.SummaryCard({
+				$wrapper: $wrapper,
+				values: values,
+				currency: frm.doc.account_currency,
+			});
+		});
 	},
 
 	build_reconciliation_area: function(frm) {
@@ -2,13 +2,16 @@
 # For license information, please see license.txt
 import json
 import datetime
+from contextlib import contextmanager
+from itertools import chain
 from typing import Union
 
 import frappe
 from frappe import _
 from frappe.model.document import Document
 from frappe.query_builder.custom import ConstantColumn
-from frappe.utils import cint, flt, sbool
+from frappe.utils import add_months, cint, flt, getdate, sbool
+from frappe.utils.background_jobs import is_job_enqueued
 from frappe.query_builder.functions import Cast, Coalesce
 
 from erpnext import get_company_currency, get_default_cost_center
@@ -16,17 +19,43 @@ from erpnext.accounts.doctype.bank_transaction.bank_transaction import (
 	BankTransaction,
 	get_total_allocated_amount,
 )
-from erpnext.accounts.utils import get_account_currency
+from banking.metadata_cache import get_cached_values
+from banking.klarna_kosma_integration.doctype.bank_match_history.bank_match_history import (
+	get_matched_parties,
+	record_matches,
+)
+from banking.party_index import resolve_party
+from banking.profiling import profile, run_query, set_account
+from banking.party_name_index import find_party
+from banking.klarna_kosma_integration.doctype.bank_reconciliation_tool_beta.scoring import (
+	MatchScorer,
+	get_rank_weights,
+	get_ranked_page,
+)
 from banking.klarna_kosma_integration.doctype.bank_reconciliation_tool_beta.utils import (
+	CompiledQuery,
+	add_business_days,
+	add_converted_amounts,
+	add_date_proximity,
+	amount_match_condition,
 	amount_rank_condition,
+	compile_query,
+	get_amount_tolerance,
+	get_date_tolerance,
 	get_description_match_condition,
+	get_exchange_rate_tolerance,
+	get_query_parameter,
 	get_reference_field_map,
+	is_reference_provided,
 	ref_equality_condition,
 )
 
 from pypika import Order
 
 MAX_QUERY_RESULTS = 150
+AUTO_RECONCILE_CHUNK_SIZE = 50
+# Longer than the timeout of the long queue, in case a worker dies while holding the lock
+AUTO_RECONCILE_LOCK_TTL = 3600  # seconds
 
 
 class BankReconciliationToolBeta(Document):
@@ -111,15 +140,17 @@ def create_journal_entry_bts(
 		bank_transaction.unallocated_amount if bank_transaction.withdrawal > 0.0 else 0.0
 	)
 
-	company_account = frappe.get_value(
-		"Bank Account", bank_transaction.bank_account, "account"
-	)
-	company, company_currency = frappe.get_value(
-		"Account", company_account, ["company", "account_currency"]
+	company_account = get_cached_values("Bank Account", bank_transaction.bank_account).account
+	company_account_data = get_cached_values("Account", company_account)
+	company, company_currency = (
+		company_account_data.company,
+		company_account_data.account_currency,
 	)
 
-	second_account_type, second_account_currency = frappe.db.get_value(
-		"Account", second_account, ["account_type", "account_currency"]
+	second_account_data = get_cached_values("Account", second_account)
+	second_account_type, second_account_currency = (
+		second_account_data.account_type,
+		second_account_data.account_currency,
 	)
 	if second_account_type in ["Receivable", "Payable"] and not (party_type and party):
 		frappe.throw(
@@ -207,10 +238,8 @@ def create_payment_entry_bts(
 	paid_amount = bank_transaction.unallocated_amount
 	payment_type = "Receive" if bank_transaction.deposit > 0.0 else "Pay"
 
-	company_account = frappe.get_value(
-		"Bank Account", bank_transaction.bank_account, "account"
-	)
-	company = frappe.get_value("Account", company_account, "company")
+	company_account = get_cached_values("Bank Account", bank_transaction.bank_account).account
+	company = get_cached_values("Account", company_account).company
 	payment_entry_dict = {
 		"company": company,
 		"payment_type": payment_type,
@@ -251,29 +280,126 @@ def create_payment_entry_bts(
 
 
 @frappe.whitelist()
+@profile("bulk_reconcile_vouchers")
 def bulk_reconcile_vouchers(
 	bank_transaction_name: str,
 	vouchers: str | list[dict],
 	reconcile_multi_party: bool = False,
+	write_off_difference: bool = False,
 ) -> "BankTransaction":
 	"""
 	Reconcile multiple vouchers with a bank transaction.
 
 	:param vouchers: JSON string of vouchers to reconcile
 	structure: List(Dict(payment_doctype, payment_name, amount, party))
+	:param write_off_difference: write off the difference to unpaid invoices,
+	see `get_write_off_proposal`
+	"""
+	if isinstance(vouchers, str):
+		vouchers = json.loads(vouchers)
+
+	return reconcile_transaction(
+		bank_transaction_name,
+		vouchers,
+		sbool(reconcile_multi_party),
+		sbool(write_off_difference),
+	)
+
+
+@frappe.whitelist()
+def get_write_off_proposal(bank_transaction_name: str, vouchers: str | list[dict]) -> dict | None:
+	"""
+	Return the difference between the selected unpaid invoices and the bank
+	transaction if it is within the amount tolerance of the Bank Account, e.g.
+	bank fees or an early payment discount, and the account to write it off to.
 	"""
 	if isinstance(vouchers, str):
 		vouchers = json.loads(vouchers)
 
+	transaction = frappe.get_doc("Bank Transaction", bank_transaction_name)
+	transaction.check_permission("read")
+	for voucher in vouchers:
+		frappe.has_permission(
+			voucher["payment_doctype"], "read", voucher["payment_name"], throw=True
+		)
+
+	return transaction.get_write_off(vouchers)
+
+
+@frappe.whitelist()
+def bulk_reconcile_transactions(
+	transactions: str | list[dict],
+	reconcile_multi_party: bool = False,
+	chunk_size: int = 100,
+) -> dict:
+	"""
+	Reconcile vouchers with many bank transactions, committing every `chunk_size` transactions.
+
+	:param transactions: JSON string of transactions to reconcile
+	structure: List(Dict(bank_transaction_name, vouchers))
+	A failing transaction is rolled back and reported, the others are reconciled.
+	"""
+	if isinstance(transactions, str):
+		transactions = json.loads(transactions)
+
 	reconcile_multi_party = sbool(reconcile_multi_party)
+	chunk_size = max(cint(chunk_size), 1)
+	result = {"reconciled": [], "partially_reconciled": [], "errors": []}
+	unallocated_before = dict(
+		frappe.get_all(
+			"Bank Transaction",
+			filters={"name": ("in", [row.get("bank_transaction_name") for row in transactions])},
+			fields=["name", "unallocated_amount"],
+			as_list=True,
+		)
+	)
+
+	for idx, row in enumerate(transactions, start=1):
+		bank_transaction_name = row.get("bank_transaction_name")
+		frappe.db.savepoint("bulk_reconcile_transaction")
+		try:
+			transaction = reconcile_transaction(
+				bank_transaction_name, row.get("vouchers") or [], reconcile_multi_party
+			)
+		except Exception as e:
+			frappe.db.rollback(save_point="bulk_reconcile_transaction")
+			frappe.clear_last_message()
+			result["errors"].append(
+				{"bank_transaction_name": bank_transaction_name, "error": str(e)}
+			)
+		else:
+			if transaction.status == "Reconciled":
+				result["reconciled"].append(bank_transaction_name)
+			elif flt(unallocated_before.get(bank_transaction_name)) != flt(
+				transaction.unallocated_amount
+			):
+				result["partially_reconciled"].append(bank_transaction_name)
+
+			# the transaction may appear again further down
+			unallocated_before[bank_transaction_name] = transaction.unallocated_amount
+
+		if idx % chunk_size == 0:
+			frappe.db.commit()
+
+	return result
 
+
+def reconcile_transaction(
+	bank_transaction_name: str,
+	vouchers: list[dict],
+	reconcile_multi_party: bool = False,
+	write_off_difference: bool = False,
+) -> "BankTransaction":
+	"""Add and allocate the vouchers, then save the bank transaction once."""
 	transaction = frappe.get_doc("Bank Transaction", bank_transaction_name)
-	transaction.add_payment_entries(vouchers, reconcile_multi_party)
+	write_off = transaction.get_write_off(vouchers) if write_off_difference else None
+	transaction.add_payment_entries(vouchers, reconcile_multi_party, write_off)
 	transaction.validate_duplicate_references()
 	transaction.allocate_payment_entries()
 	transaction.update_allocated_amount()
 	transaction.set_status()
 	transaction.save()
+	record_matches(transaction)
 
 	return transaction
 
@@ -323,6 +449,78 @@ def upload_bank_statement(**args):
 	return bsi  # Return saved document
 
 
+@frappe.whitelist()
+def start_auto_reconcile(
+	bank_account: str,
+	from_date: str | datetime.date = None,
+	to_date: str | datetime.date = None,
+	filter_by_reference_date: str | bool = False,
+	from_reference_date: str | datetime.date = None,
+	to_reference_date: str | datetime.date = None,
+) -> bool:
+	"""Run auto reconciliation in a background job. Returns False if it is already running."""
+	frappe.has_permission("Bank Transaction", "write", throw=True)
+
+	job_id = get_auto_reconcile_job_id(bank_account)
+	if is_job_enqueued(job_id) or frappe.cache.exists(get_auto_reconcile_lock_key(bank_account)):
+		return False
+
+	frappe.cache.delete_value(get_auto_reconcile_cache_key(bank_account, "cancel"))
+	frappe.enqueue(
+		"banking.klarna_kosma_integration.doctype.bank_reconciliation_tool_beta.bank_reconciliation_tool_beta.run_auto_reconcile",
+		queue="long",
+		job_id=job_id,
+		deduplicate=True,
+		bank_account=bank_account,
+		from_date=from_date,
+		to_date=to_date,
+		filter_by_reference_date=filter_by_reference_date,
+		from_reference_date=from_reference_date,
+		to_reference_date=to_reference_date,
+	)
+	return True
+
+
+@frappe.whitelist()
+def cancel_auto_reconcile(bank_account: str) -> None:
+	"""Stop the auto reconciliation job after its current chunk."""
+	frappe.has_permission("Bank Transaction", "write", throw=True)
+	frappe.cache.set_value(
+		get_auto_reconcile_cache_key(bank_account, "cancel"), 1, expires_in_sec=86400
+	)
+
+
+def get_auto_reconcile_job_id(bank_account: str) -> str:
+	return f"banking-auto-reconcile::{bank_account}"
+
+
+def get_auto_reconcile_cache_key(bank_account: str, key: str) -> str:
+	return f"banking_auto_reconcile_{key}::{bank_account}"
+
+
+def get_auto_reconcile_lock_key(bank_account: str) -> str:
+	return frappe.cache.make_key(get_auto_reconcile_cache_key(bank_account, "lock"))
+
+
+@contextmanager
+def auto_reconcile_lock(bank_account: str):
+	"""Allow one auto reconciliation per Bank Account, be it in a request or a background job.
+
+	They share the progress and the position to resume from.
+	"""
+	key = get_auto_reconcile_lock_key(bank_account)
+	if not frappe.cache.set(key, 1, nx=True, ex=AUTO_RECONCILE_LOCK_TTL):
+		frappe.throw(
+			_("Auto Reconciliation is already running for this Bank Account"),
+			title=_("Auto Reconciliation"),
+		)
+
+	try:
+		yield
+	finally:
+		frappe.cache.delete(key)
+
+
 @frappe.whitelist()
 def auto_reconcile_vouchers(
 	bank_account: str,
@@ -332,52 +530,209 @@ def auto_reconcile_vouchers(
 	from_reference_date: str | datetime.date = None,
 	to_reference_date: str | datetime.date = None,
 ):
-	# Auto reconcile vouchers with matching reference numbers
-	frappe.flags.auto_reconcile_vouchers = True
-	reconciled, partially_reconciled = set(), set()
-
-	bank_transactions = get_bank_transactions(bank_account, from_date, to_date)
-	for transaction in bank_transactions:
-		linked_payments = get_linked_payments(
-			transaction.name,
-			["payment_entry", "journal_entry"],
-			from_date,
-			to_date,
-			filter_by_reference_date,
-			from_reference_date,
-			to_reference_date,
-		)
+	"""Auto reconcile vouchers with matching reference numbers, in this request.
+
+	Prefer `start_auto_reconcile` for many transactions.
+	"""
+	reconciled, partially_reconciled = run_auto_reconcile(
+		bank_account,
+		from_date,
+		to_date,
+		filter_by_reference_date,
+		from_reference_date,
+		to_reference_date,
+	)
+	alert_message, indicator = get_auto_reconcile_message(
+		len(reconciled), len(partially_reconciled)
+	)
+	frappe.msgprint(
+		title=_("Auto Reconciliation Complete"), msg=alert_message, indicator=indicator
+	)
+	return reconciled, partially_reconciled
+
 
-		if not linked_payments:
-			continue
-
-		vouchers = list(
-			map(
-				lambda entry: {
-					"payment_doctype": entry.get("doctype"),
-					"payment_name": entry.get("name"),
-					"amount": entry.get("paid_amount"),
-				},
-				linked_payments,
+def run_auto_reconcile(
+	bank_account: str,
+	from_date: str | datetime.date = None,
+	to_date: str | datetime.date = None,
+	filter_by_reference_date: str | bool = False,
+	from_reference_date: str | datetime.date = None,
+	to_reference_date: str | datetime.date = None,
+):
+	"""
+	Auto reconcile vouchers with matching reference numbers.
+
+	Commits after every chunk of transactions and publishes the progress. An
+	unfinished (cancelled or failed) run with the same filters is resumed after
+	its last completed chunk. A failing transaction is rolled back, logged and
+	skipped. Throws if the Bank Account is already being auto reconciled.
+	"""
+	with auto_reconcile_lock(bank_account):
+		frappe.flags.auto_reconcile_vouchers = True
+		reconciled, partially_reconciled = set(), set()
+
+		progress_key = get_auto_reconcile_cache_key(bank_account, "progress")
+		filters = [
+			str(value or "")
+			for value in (
+				from_date,
+				to_date,
+				cint(filter_by_reference_date),
+				from_reference_date,
+				to_reference_date,
 			)
+		]
+		progress = frappe.cache.get_value(progress_key)
+		if not progress or progress["filters"] != filters:
+			progress = {
+				"filters": filters,
+				"last_transaction": None,
+				"processed": 0,
+				"reconciled": 0,
+				"partially_reconciled": 0,
+				"failed": 0,
+			}
+		progress.setdefault("failed", 0)
+
+		bank_transactions = get_bank_transactions(
+			bank_account, from_date, to_date, order_by="date asc, name asc"
+		)
+		if progress["last_transaction"]:
+			last_date, last_name = progress["last_transaction"]
+			bank_transactions = [
+				transaction
+				for transaction in bank_transactions
+				if (getdate(transaction.date), transaction.name) > (getdate(last_date), last_name)
+			]
+
+		total = progress["processed"] + len(bank_transactions)
+		cancelled = False
+		try:
+			for start in range(0, len(bank_transactions), AUTO_RECONCILE_CHUNK_SIZE):
+				if frappe.cache.get_value(get_auto_reconcile_cache_key(bank_account, "cancel")):
+					cancelled = True
+					break
+
+				chunk = bank_transactions[start : start + AUTO_RECONCILE_CHUNK_SIZE]
+				for transaction in chunk:
+					unallocated_before = transaction.unallocated_amount
+					frappe.db.savepoint("auto_reconcile_transaction")
+					try:
+						transaction = auto_reconcile_transaction(
+							transaction.name,
+							from_date,
+							to_date,
+							filter_by_reference_date,
+							from_reference_date,
+							to_reference_date,
+						)
+					except Exception:
+						frappe.db.rollback(save_point="auto_reconcile_transaction")
+						frappe.clear_last_message()
+						frappe.log_error(
+							title=_("Auto Reconciliation Error"),
+							reference_doctype="Bank Transaction",
+							reference_name=transaction.name,
+						)
+						progress["failed"] += 1
+						continue
+
+					if not transaction:
+						continue
+
+					if transaction.status == "Reconciled":
+						reconciled.add(transaction.name)
+						progress["reconciled"] += 1
+					elif flt(unallocated_before) != flt(transaction.unallocated_amount):
+						partially_reconciled.add(transaction.name)  # Partially reconciled
+						progress["partially_reconciled"] += 1
+
+				progress["last_transaction"] = [str(chunk[-1].date), chunk[-1].name]
+				progress["processed"] += len(chunk)
+
+				if not frappe.flags.in_test:
+					frappe.db.commit()
+
+				frappe.cache.set_value(progress_key, progress, expires_in_sec=7 * 86400)
+				publish_auto_reconcile_progress(bank_account, progress, total, "Running")
+		finally:
+			frappe.flags.auto_reconcile_vouchers = False
+
+		if cancelled:
+			publish_auto_reconcile_progress(bank_account, progress, total, "Cancelled")
+			return reconciled, partially_reconciled
+
+		frappe.cache.delete_value(progress_key)
+		publish_auto_reconcile_progress(bank_account, progress, total, "Completed")
+		return reconciled, partially_reconciled
+
+
+def auto_reconcile_transaction(
+	bank_transaction_name: str,
+	from_date: str | datetime.date = None,
+	to_date: str | datetime.date = None,
+	filter_by_reference_date: str | bool = False,
+	from_reference_date: str | datetime.date = None,
+	to_reference_date: str | datetime.date = None,
+) -> "BankTransaction | None":
+	"""Reconcile a bank transaction with its matching vouchers, if there are any."""
+	linked_payments = get_linked_payments(
+		bank_transaction_name,
+		["payment_entry", "journal_entry"],
+		from_date,
+		to_date,
+		filter_by_reference_date,
+		from_reference_date,
+		to_reference_date,
+	)
+
+	if not linked_payments:
+		return None
+
+	vouchers = list(
+		map(
+			lambda entry: {
+				"payment_doctype": entry.get("doctype"),
+				"payment_name": entry.get("name"),
+				"amount": entry.get("paid_amount"),
+			},
+			linked_payments,
+		)
+	)
+	return reconcile_transaction(bank_transaction_name, vouchers)
+
+
+def publish_auto_reconcile_progress(
+	bank_account: str, progress: dict, total: int, status: str
+) -> None:
+	data = {
+		"bank_account": bank_account,
+		"status": status,
+		"processed": progress["processed"],
+		"total": total,
+		"reconciled": progress["reconciled"],
+		"partially_reconciled": progress["partially_reconciled"],
+		"failed": progress["failed"],
+	}
+	if status == "Completed":
+		data["message"], data["indicator"] = get_auto_reconcile_message(
+			progress["reconciled"], progress["partially_reconciled"], progress["failed"]
 		)
 
-		unallocated_before = transaction.unallocated_amount
-		transaction = bulk_reconcile_vouchers(transaction.name, json.dumps(vouchers))
+	frappe.publish_realtime(
+		"banking_auto_reconcile_progress", data, user=frappe.session.user
+	)
 
-		if transaction.status == "Reconciled":
-			reconciled.add(transaction.name)
-		elif flt(unallocated_before) != flt(transaction.unallocated_amount):
-			partially_reconciled.add(transaction.name)  # Partially reconciled
 
+def get_auto_reconcile_message(reconciled: int, partially_reconciled: int, failed: int = 0):
 	alert_message, indicator = "", "blue"
-	if not partially_reconciled and not reconciled:
+	if not partially_reconciled and not reconciled and not failed:
 		alert_message = _("No matches occurred via Auto Reconciliation")
 
 	if reconciled:
 		alert_message += _("{0} {1} {2}").format(
-			len(reconciled),
-			_("Transactions") if len(reconciled) > 1 else _("Transaction"),
+			reconciled,
+			_("Transactions") if reconciled > 1 else _("Transaction"),
 			frappe.bold(_("Reconciled")),
 		)
 		alert_message += "<br>"
@@ -385,20 +740,24 @@ def auto_reconcile_vouchers(
 
 	if partially_reconciled:
 		alert_message += _("{0} {1} {2}").format(
-			len(partially_reconciled),
-			_("Transactions") if len(partially_reconciled) > 1 else _("Transaction"),
+			partially_reconciled,
+			_("Transactions") if partially_reconciled > 1 else _("Transaction"),
 			frappe.bold(_("Partially Reconciled")),
 		)
+		alert_message += "<br>"
 		indicator = "green"
 
-	frappe.msgprint(
-		title=_("Auto Reconciliation Complete"), msg=alert_message, indicator=indicator
-	)
-	frappe.flags.auto_reconcile_vouchers = False
-	return reconciled, partially_reconciled
+	if failed:
+		alert_message += _("{0} {1} could not be reconciled, see the Error Log").format(
+			failed, _("Transactions") if failed > 1 else _("Transaction")
+		)
+		indicator = "orange"
+
+	return alert_message, indicator
 
 
 @frappe.whitelist()
+@profile("get_linked_payments")
 def get_linked_payments(
 	bank_transaction_name: str,
 	document_types: str | list,
@@ -407,18 +766,28 @@ def get_linked_payments(
 	filter_by_reference_date: str | bool = False,
 	from_reference_date: str | datetime.date = None,
 	to_reference_date: str | datetime.date = None,
+	start: int = 0,
+	page_length: int | None = None,
 ) -> list:
-	"""Get all matching payments for a bank transaction"""
+	"""
+	Get the matching payments for a bank transaction, best match first.
+	Returns all of them, or the page of `page_length` vouchers from `start`.
+	"""
 	transaction = frappe.get_doc("Bank Transaction", bank_transaction_name)
 	transaction.check_permission("read")
+	set_account(transaction.bank_account)
 
-	gl_account, company = frappe.db.get_value(
-		"Bank Account", transaction.bank_account, ["account", "company"]
-	)
+	bank_account = get_cached_values("Bank Account", transaction.bank_account)
+	gl_account, company = bank_account.account, bank_account.company
 
 	if isinstance(document_types, str):
 		document_types = json.loads(document_types)
 
+	if not (from_date or to_date) and (tolerance := get_date_tolerance()):
+		# search the vouchers that can be ranked by date proximity
+		from_date = add_business_days(getdate(transaction.date), -tolerance)
+		to_date = add_business_days(getdate(transaction.date), tolerance)
+
 	matching = check_matching(
 		gl_account,
 		company,
@@ -429,10 +798,13 @@ def get_linked_payments(
 		sbool(filter_by_reference_date),
 		from_reference_date,
 		to_reference_date,
+		cint(start),
+		cint(page_length),
 	)
 	return subtract_allocations(gl_account, matching)
 
 
+@profile("subtract_allocations")
 def subtract_allocations(gl_account, vouchers):
 	"Look up & subtract any existing Bank Transaction allocations"
 	copied = []
@@ -445,12 +817,18 @@ def subtract_allocations(gl_account, vouchers):
 				break
 
 		if amount:
-			voucher["paid_amount"] -= amount
+			# allocations are in the currency of the bank account
+			if voucher.get("converted_amount") is not None:
+				voucher["paid_amount"] -= amount / voucher["exchange_rate"]
+				voucher["converted_amount"] -= amount
+			else:
+				voucher["paid_amount"] -= amount
 
 		copied.append(voucher)
 	return copied
 
 
+@profile("check_matching")
 def check_matching(
 	bank_account: str,
 	company: str,
@@ -461,17 +839,9 @@ def check_matching(
 	filter_by_reference_date: bool = False,
 	from_reference_date: str | datetime.date = None,
 	to_reference_date: str | datetime.date = None,
+	start: int = 0,
+	page_length: int | None = None,
 ):
-	common_filters = frappe._dict(
-		amount=transaction.unallocated_amount,
-		payment_type=("Receive" if transaction.deposit > 0.0 else "Pay"),
-		reference_no=transaction.reference_number,
-		party_type=transaction.party_type,
-		party=transaction.party,
-		bank_account=bank_account,
-		date=transaction.date,
-	)
-
 	# combine all types of vouchers
 	queries = get_queries(
 		bank_account,
@@ -483,31 +853,143 @@ def check_matching(
 		filter_by_reference_date,
 		from_reference_date,
 		to_reference_date,
-		common_filters,
+		get_common_filters(bank_account, transaction),
 	)
 
-	matching_vouchers = []
-	for query in queries:
-		matching_vouchers.extend(query.run(as_dict=True))
-
+	# every page ranks all candidates, so pages neither overlap nor skip vouchers
+	matching_vouchers = list(chain.from_iterable(run_query(query) for query in queries))
 	if not matching_vouchers:
 		return []
 
-	if transaction.description:
+	scorer = MatchScorer(matching_vouchers)
+
+	if "cross_currency" in document_types:
+		matching_vouchers = add_converted_amounts(
+			matching_vouchers,
+			get_cached_values("Account", bank_account).account_currency,
+			transaction.unallocated_amount,
+			get_exchange_rate_tolerance(),
+			exact_match="exact_match" in document_types,
+		)
+
+	add_date_proximity(matching_vouchers, transaction.date, get_date_tolerance())
+
+	# similar bank transactions were reconciled with the same party
+	if matched_parties := get_matched_parties(transaction):
 		for voucher in matching_vouchers:
-			if "name_in_desc_match" in voucher:
-				# already covered in DB query
-				continue
+			if (voucher.get("party_type"), voucher.get("party")) in matched_parties:
+				voucher["history_match"] = 1
+
+	scorer.score(matching_vouchers, transaction.description, get_rank_weights())
+	return get_ranked_page(matching_vouchers, start, page_length)
+
+
+def get_common_filters(bank_account: str, transaction: "BankTransaction") -> frappe._dict:
+	party_type, party = get_party(transaction)
+	return frappe._dict(
+		amount=transaction.unallocated_amount,
+		payment_type=("Receive" if transaction.deposit > 0.0 else "Pay"),
+		reference_no=transaction.reference_number,
+		party_type=party_type,
+		party=party,
+		bank_account=bank_account,
+		date=transaction.date,
+	)
+
+
+def get_party(transaction: "BankTransaction") -> tuple[str, str] | tuple[None, None]:
+	"""
+	Return the party of the bank transaction. If it has none, suggest one by
+	the counterparty's IBAN or, failing that, by the similarity of its name.
+	"""
+	if transaction.party_type and transaction.party:
+		return transaction.party_type, transaction.party
+
+	return (
+		resolve_party(transaction.bank_party_iban)
+		or find_party(transaction.bank_party_name)
+		or (None, None)
+	)
+
+
+@frappe.whitelist()
+def suggest_party(bank_transaction_name: str) -> dict | None:
+	"""Return the suggested party for a bank transaction without one."""
+	transaction = frappe.get_doc("Bank Transaction", bank_transaction_name)
+	transaction.check_permission("read")
+
+	party_type, party = get_party(transaction)
+	if not party:
+		return None
 
-			# higher rank if voucher name is in bank transaction
-			reference_no = voucher["reference_no"]
-			if reference_no and (reference_no.strip() in transaction.description):
-				voucher["rank"] += 1
-				voucher["name_in_desc_match"] = 1
+	return {"party_type": party_type, "party": party}
 
-	return sorted(matching_vouchers, key=lambda x: x["rank"], reverse=True)
 
+def explain_matching_queries(
+	bank_transaction_name: str, document_types: list | None = None
+) -> list[dict]:
+	"""
+	Run EXPLAIN for the matching queries of a bank transaction.
+	Returns one row per table and query, `full_scan` is set for table scans.
+	"""
+	transaction = frappe.get_doc("Bank Transaction", bank_transaction_name)
+	bank_account = get_cached_values("Bank Account", transaction.bank_account)
+	document_types = document_types or [
+		"payment_entry",
+		"journal_entry",
+		"sales_invoice",
+		"purchase_invoice",
+		"expense_claim",
+		"unpaid_invoices",
+		"bank_transaction",
+	]
+	queries = get_queries(
+		bank_account.account,
+		bank_account.company,
+		transaction,
+		document_types,
+		# same default date range as the reconciliation tool
+		from_date=add_months(transaction.date, -1),
+		to_date=transaction.date,
+		common_filters=get_common_filters(bank_account.account, transaction),
+	)
 
+	result = []
+	for query in queries:
+		if isinstance(query, CompiledQuery):
+			name, sql, values = query.key[1], query.sql, query.values
+		else:
+			# added by another app via the `get_matching_queries` hook
+			name, sql, values = type(query).__name__, query.get_sql(), None
+
+		plan = frappe.db.sql(f"EXPLAIN {sql}", values, as_dict=True)
+		if frappe.db.db_type == "postgres":
+			for row in plan:
+				line = row.get("QUERY PLAN") or ""
+				if "Scan on" in line:
+					result.append(
+						{
+							"query": name,
+							"table": line.split(" on ")[1].split()[0],
+							"access": line.strip(),
+							"full_scan": "Seq Scan" in line,
+						}
+					)
+		else:
+			for row in plan:
+				result.append(
+					{
+						"query": name,
+						"table": row.table,
+						"access": f"{row.type} ({row.key or 'no index'}, ~{row.rows} rows)",
+						"full_scan": row.type == "ALL",
+					}
+				)
+
+	return result
+
+
+@profile("get_queries")
 def get_queries(
 	bank_account: str,
 	company: str,
@@ -566,42 +1048,88 @@ def get_matching_queries(
 		common_filters = frappe._dict()
 
 	queries = []
-	currency = get_account_currency(bank_account)
+	currency = get_cached_values("Account", bank_account).account_currency
 	is_withdrawal = transaction.withdrawal > 0.0
 	is_deposit = transaction.deposit > 0.0
 
 	common_filters.exact_party_match = "exact_party_match" in (document_types or [])
 	common_filters.description = transaction.description
 
+	# Match amounts within the tolerance of the Bank Account, e.g. for bank fees or
+	# early payment discounts, with a range predicate instead of equality
+	amount_tolerance = get_amount_tolerance(transaction.bank_account, common_filters.amount)
+	if amount_tolerance:
+		common_filters.min_amount = flt(common_filters.amount) - amount_tolerance
+		common_filters.max_amount = flt(common_filters.amount) + amount_tolerance
+
+	# The queries are rendered once per structure (see `compile_query`),
+	# values that change between transactions are bound when running them
+	values = dict(
+		common_filters,
+		from_date=from_date,
+		to_date=to_date,
+		from_reference_date=from_reference_date,
+		to_reference_date=to_reference_date,
+		transaction_name=transaction.name,
+	)
+	parameters = frappe._dict(
+		common_filters,
+		**{
+			key: get_query_parameter(key)
+			for key in ("amount", "party_type", "party", "bank_account", "date")
+		},
+	)
+	has_reference_no = is_reference_provided(common_filters.reference_no)
+	if has_reference_no:
+		parameters.reference_no = get_query_parameter("reference_no")
+	if common_filters.description:
+		parameters.description = get_query_parameter("description")
+	if amount_tolerance:
+		parameters.amount_range = (
+			get_query_parameter("min_amount"),
+			get_query_parameter("max_amount"),
+		)
+
+	date_parameters = (
+		get_query_parameter("from_date"),
+		get_query_parameter("to_date"),
+		cint(filter_by_reference_date),
+		get_query_parameter("from_reference_date"),
+		get_query_parameter("to_reference_date"),
+	)
+	structure = (
+		exact_match,
+		common_filters.payment_type,
+		common_filters.exact_party_match,
+		True if has_reference_no else common_filters.reference_no,
+		bool(common_filters.description),
+		bool(frappe.flags.auto_reconcile_vouchers),
+		bool(amount_tolerance),
+	)
+
 	if "payment_entry" in document_types:
 		frappe.has_permission("Payment Entry", throw=True)
-		query = get_pe_matching_query(
-			exact_match,
-			common_filters,
-			account_from_to,
-			from_date,
-			to_date,
-			filter_by_reference_date,
-			from_reference_date,
-			to_reference_date,
+		query = compile_query(
+			("payment_entry", account_from_to, cint(filter_by_reference_date), *structure),
+			lambda: get_pe_matching_query(
+				exact_match, parameters, account_from_to, *date_parameters
+			),
+			values,
 		)
 		queries.append(query)
 
 	if "journal_entry" in document_types:
 		frappe.has_permission("Journal Entry", throw=True)
-		query = get_je_matching_query(
-			exact_match,
-			common_filters,
-			from_date,
-			to_date,
-			filter_by_reference_date,
-			from_reference_date,
-			to_reference_date,
+		query = compile_query(
+			("journal_entry", cint(filter_by_reference_date), *structure),
+			lambda: get_je_matching_query(exact_match, parameters, *date_parameters),
+			values,
 		)
 		queries.append(query)
 
 	# -- Invoices --
 	include_unpaid = "unpaid_invoices" in document_types
+	cross_currency = "cross_currency" in document_types
 	invoice_dt = "sales_invoice" if is_deposit else "purchase_invoice"
 	invoice_queries_map = get_invoice_function_map(document_types, is_deposit)
 	reference_field_map = get_reference_field_map()
@@ -609,7 +1137,7 @@ def get_matching_queries(
 	kwargs = frappe._dict(
 		exact_match=exact_match,
 		currency=currency,
-		common_filters=common_filters,
+		common_filters=parameters,
 	)
 	if include_unpaid:
 		kwargs.company = company
@@ -618,27 +1146,67 @@ def get_matching_queries(
 			kwargs.reference_field = reference_field_map.get(doctype, "name")
 			if doctype in ["sales_invoice", "purchase_invoice"]:
 				kwargs.include_only_returns = doctype != invoice_dt
+				kwargs.cross_currency = cross_currency
 			elif kwargs.include_only_returns is not None:
-				# Remove the key when doctype == "expense_claim"
+				# Remove the keys when doctype == "expense_claim"
 				del kwargs.include_only_returns
-
-			queries.append(fn(**kwargs))
+				del kwargs.cross_currency
+
+			query = compile_query(
+				(
+					fn.__name__,
+					currency,
+					company,
+					kwargs.reference_field,
+					kwargs.include_only_returns,
+					kwargs.cross_currency,
+					*structure,
+				),
+				lambda: fn(**kwargs),
+				values,
+			)
+			if query:
+				queries.append(query)
 	elif fn := invoice_queries_map.get(invoice_dt):
 		frappe.has_permission(frappe.unscrub(invoice_dt), throw=True)
 		kwargs.reference_field = reference_field_map.get(invoice_dt, "name")
-		queries.append(fn(**kwargs))
+		kwargs.cross_currency = cross_currency
+		query = compile_query(
+			(fn.__name__, currency, kwargs.reference_field, cross_currency, *structure),
+			lambda: fn(**kwargs),
+			values,
+		)
+		queries.append(query)
 
 	if "loan_disbursement" in document_types and is_withdrawal:
 		frappe.has_permission("Loan Disbursement", throw=True)
-		queries.append(get_ld_matching_query(exact_match, common_filters))
+		queries.append(
+			compile_query(
+				("loan_disbursement", *structure),
+				lambda: get_ld_matching_query(exact_match, parameters),
+				values,
+			)
+		)
 
 	if "loan_repayment" in document_types and is_deposit:
 		frappe.has_permission("Loan Repayment", throw=True)
-		queries.append(get_lr_matching_query(exact_match, common_filters))
+		queries.append(
+			compile_query(
+				("loan_repayment", *structure),
+				lambda: get_lr_matching_query(exact_match, parameters),
+				values,
+			)
+		)
 
 	if "bank_transaction" in document_types:
 		frappe.has_permission("Bank Transaction", throw=True)
-		query = get_bt_matching_query(exact_match, common_filters, transaction.name)
+		query = compile_query(
+			("bank_transaction", *structure),
+			lambda: get_bt_matching_query(
+				exact_match, parameters, get_query_parameter("transaction_name")
+			),
+			values,
+		)
 		queries.append(query)
 
 	return queries
@@ -661,9 +1229,13 @@ def get_bt_matching_query(
 		.else_(0)
 	)
 
-	amount_rank = amount_rank_condition(amount_field, common_filters.amount)
+	amount_rank = amount_rank_condition(
+		amount_field, common_filters.amount, common_filters.amount_range
+	)
 	amount_filter = (
-		amount_field == common_filters.amount if exact_match else amount_field > 0.0
+		amount_match_condition(amount_field, common_filters.amount, common_filters.amount_range)
+		if exact_match
+		else amount_field > 0.0
 	)
 
 	party_filter = (
@@ -699,6 +1271,7 @@ def get_bt_matching_query(
 		.where(amount_filter)
 		.where(bt.docstatus == 1)
 		.orderby(rank_expression, order=Order.desc)
+		.orderby(bt.name)
 		.limit(MAX_QUERY_RESULTS)
 	)
 
@@ -749,11 +1322,18 @@ def get_ld_matching_query(exact_match: bool, common_filters: frappe._dict):
 		.where(loan_disbursement.clearance_date.isnull())
 		.where(loan_disbursement.disbursement_account == common_filters.bank_account)
 		.orderby(rank_expression, order=Order.desc)
+		.orderby(loan_disbursement.name)
 		.limit(MAX_QUERY_RESULTS)
 	)
 
 	if exact_match:
-		query.where(loan_disbursement.disbursed_amount == common_filters.amount)
+		query.where(
+			amount_match_condition(
+				loan_disbursement.disbursed_amount,
+				common_filters.amount,
+				common_filters.amount_range,
+			)
+		)
 	else:
 		query.where(loan_disbursement.disbursed_amount > 0.0)
 
@@ -801,6 +1381,7 @@ def get_lr_matching_query(exact_match: bool, common_filters: frappe._dict):
 		.where(loan_repayment.clearance_date.isnull())
 		.where(loan_repayment.payment_account == common_filters.bank_account)
 		.orderby(rank_expression, order=Order.desc)
+		.orderby(loan_repayment.name)
 		.limit(MAX_QUERY_RESULTS)
 	)
 
@@ -808,7 +1389,11 @@ def get_lr_matching_query(exact_match: bool, common_filters: frappe._dict):
 		query = query.where((loan_repayment.repay_from_salary == 0))
 
 	if exact_match:
-		query.where(loan_repayment.amount_paid == common_filters.amount)
+		query.where(
+			amount_match_condition(
+				loan_repayment.amount_paid, common_filters.amount, common_filters.amount_range
+			)
+		)
 	else:
 		query.where(loan_repayment.amount_paid > 0.0)
 
@@ -832,9 +1417,13 @@ def get_pe_matching_query(
 
 	ref_rank = ref_equality_condition(pe.reference_no, common_filters.reference_no)
 
-	amount_rank = amount_rank_condition(pe.paid_amount, common_filters.amount)
+	amount_rank = amount_rank_condition(
+		pe.paid_amount, common_filters.amount, common_filters.amount_range
+	)
 	amount_filter = (
-		pe.paid_amount == common_filters.amount if exact_match else pe.paid_amount > 0.0
+		amount_match_condition(pe.paid_amount, common_filters.amount, common_filters.amount_range)
+		if exact_match
+		else pe.paid_amount > 0.0
 	)
 
 	party_filter = (
@@ -879,6 +1468,7 @@ def get_pe_matching_query(
 		.where(amount_filter)
 		.where(filter_by_date)
 		.orderby(rank_expression, order=Order.desc)
+		.orderby(pe.name)
 		.limit(MAX_QUERY_RESULTS)
 	)
 
@@ -910,9 +1500,13 @@ def get_je_matching_query(
 	amount_field = getattr(jea, f"{cr_or_dr}_in_account_currency")
 
 	ref_rank = ref_equality_condition(je.cheque_no, common_filters.reference_no)
-	amount_rank = amount_rank_condition(amount_field, common_filters.amount)
+	amount_rank = amount_rank_condition(
+		amount_field, common_filters.amount, common_filters.amount_range
+	)
 	amount_filter = (
-		amount_field == common_filters.amount if exact_match else amount_field > 0.0
+		amount_match_condition(amount_field, common_filters.amount, common_filters.amount_range)
+		if exact_match
+		else amount_field > 0.0
 	)
 
 	filter_by_date = je.posting_date.between(from_date, to_date)
@@ -951,6 +1545,7 @@ def get_je_matching_query(
 		.where(je.docstatus == 1)
 		.where(filter_by_date)
 		.orderby(rank_expression, order=Order.desc)
+		.orderby(je.name)
 		.limit(MAX_QUERY_RESULTS)
 	)
 
@@ -965,6 +1560,7 @@ def get_si_matching_query(
 	currency: str,
 	common_filters: frappe._dict,
 	reference_field: str = "name",
+	cross_currency: bool = False,
 ):
 	"""
 	Get matching sales invoices when they are also used as payment entries (POS).
@@ -973,10 +1569,17 @@ def get_si_matching_query(
 	sip = frappe.qb.DocType("Sales Invoice Payment").as_("sip")
 	description = common_filters.description
 
-	amount_rank = amount_rank_condition(sip.amount, common_filters.amount)
+	amount_rank = amount_rank_condition(
+		sip.amount, common_filters.amount, common_filters.amount_range
+	)
 	amount_filter = (
-		sip.amount == common_filters.amount if exact_match else sip.amount != 0.0
+		amount_match_condition(sip.amount, common_filters.amount, common_filters.amount_range)
+		if exact_match
+		else sip.amount != 0.0
 	)
+	if cross_currency and exact_match:
+		# amounts in other currencies are compared after conversion
+		amount_filter |= si.currency != currency
 
 	party_filter = si.customer == common_filters.party
 	party_rank = frappe.qb.terms.Case().when(party_filter, 1).else_(0)
@@ -1032,11 +1635,14 @@ def get_si_matching_query(
 		.where(sip.clearance_date.isnull())
 		.where(sip.account == common_filters.bank_account)
 		.where(amount_filter)
-		.where(si.currency == currency)
 		.orderby(rank_expression, order=Order.desc)
+		.orderby(si.name)
 		.limit(MAX_QUERY_RESULTS)
 	)
 
+	if not cross_currency:
+		query = query.where(si.currency == currency)
+
 	if common_filters.exact_party_match:
 		query = query.where(party_filter)
 
@@ -1050,6 +1656,7 @@ def get_unpaid_si_matching_query(
 	company: str,
 	include_only_returns: bool = False,
 	reference_field: str = "name",
+	cross_currency: bool = False,
 ):
 	sales_invoice = frappe.qb.DocType("Sales Invoice")
 	description = common_filters.description
@@ -1058,7 +1665,7 @@ def get_unpaid_si_matching_query(
 	party_rank = frappe.qb.terms.Case().when(party_filter, 1).else_(0)
 
 	amount_rank = amount_rank_condition(
-		sales_invoice.outstanding_amount, common_filters.amount
+		sales_invoice.outstanding_amount, common_filters.amount, common_filters.amount_range
 	)
 
 	# Check reference field equality with common_filters.reference_no
@@ -1094,7 +1701,8 @@ def get_unpaid_si_matching_query(
 			ConstantColumn("Customer").as_("party_type"),
 			sales_invoice.customer_name.as_("party_name"),
 			sales_invoice.posting_date,
-			sales_invoice.currency,
+			# the outstanding amount is in the currency of the party account
+			sales_invoice.party_account_currency.as_("currency"),
 			party_rank.as_("party_match"),
 			amount_rank.as_("amount_match"),
 			name_match.as_("name_in_desc_match"),
@@ -1104,15 +1712,23 @@ def get_unpaid_si_matching_query(
 		.where(sales_invoice.docstatus == 1)
 		.where(sales_invoice.company == company)  # because we do not have bank account check
 		.where(sales_invoice.outstanding_amount != 0.0)
-		.where(sales_invoice.currency == currency)
 		.orderby(rank_expression, order=Order.desc)
+		.orderby(sales_invoice.name)
 		.limit(MAX_QUERY_RESULTS)
 	)
 
 	if include_only_returns:
 		query = query.where(sales_invoice.is_return == 1)
 	if exact_match:
-		query = query.where(sales_invoice.outstanding_amount == common_filters.amount)
+		exact_amount = amount_match_condition(
+			sales_invoice.outstanding_amount, common_filters.amount, common_filters.amount_range
+		)
+		if cross_currency:
+			# amounts in other currencies are compared after conversion
+			exact_amount |= sales_invoice.party_account_currency != currency
+		query = query.where(exact_amount)
+	if not cross_currency:
+		query = query.where(sales_invoice.currency == currency)
 	if common_filters.exact_party_match:
 		query = query.where(party_filter)
 
@@ -1124,6 +1740,7 @@ def get_pi_matching_query(
 	currency: str,
 	common_filters: frappe._dict,
 	reference_field: str = "name",
+	cross_currency: bool = False,
 ):
 	"""
 	Get matching purchase invoice query when they are also used as payment entries (is_paid)
@@ -1132,13 +1749,18 @@ def get_pi_matching_query(
 	description = common_filters.description
 
 	amount_rank = amount_rank_condition(
-		purchase_invoice.paid_amount, common_filters.amount
+		purchase_invoice.paid_amount, common_filters.amount, common_filters.amount_range
 	)
 	amount_filter = (
-		(purchase_invoice.paid_amount == common_filters.amount)
+		amount_match_condition(
+			purchase_invoice.paid_amount, common_filters.amount, common_filters.amount_range
+		)
 		if exact_match
 		else purchase_invoice.paid_amount != 0.0
 	)
+	if cross_currency and exact_match:
+		# amounts in other currencies are compared after conversion
+		amount_filter |= purchase_invoice.currency != currency
 
 	party_filter = purchase_invoice.supplier == common_filters.party
 	party_rank = frappe.qb.terms.Case().when(party_filter, 1).else_(0)
@@ -1198,11 +1820,14 @@ def get_pi_matching_query(
 		.where(purchase_invoice.clearance_date.isnull())
 		.where(purchase_invoice.cash_bank_account == common_filters.bank_account)
 		.where(amount_filter)
-		.where(purchase_invoice.currency == currency)
 		.orderby(rank_expression, order=Order.desc)
+		.orderby(purchase_invoice.name)
 		.limit(MAX_QUERY_RESULTS)
 	)
 
+	if not cross_currency:
+		query = query.where(purchase_invoice.currency == currency)
+
 	if common_filters.exact_party_match:
 		query = query.where(party_filter)
 
@@ -1216,6 +1841,7 @@ def get_unpaid_pi_matching_query(
 	company: str,
 	include_only_returns: bool = False,
 	reference_field: str = "name",
+	cross_currency: bool = False,
 ):
 	purchase_invoice = frappe.qb.DocType("Purchase Invoice")
 	description = common_filters.description
@@ -1224,7 +1850,7 @@ def get_unpaid_pi_matching_query(
 	party_match = frappe.qb.terms.Case().when(party_filter, 1).else_(0)
 
 	amount_rank = amount_rank_condition(
-		purchase_invoice.outstanding_amount, common_filters.amount
+		purchase_invoice.outstanding_amount, common_filters.amount, common_filters.amount_range
 	)
 
 	# Check reference field equality with common_filters.reference_no
@@ -1262,7 +1888,8 @@ def get_unpaid_pi_matching_query(
 			ConstantColumn("Supplier").as_("party_type"),
 			purchase_invoice.supplier_name.as_("party_name"),
 			purchase_invoice.posting_date,
-			purchase_invoice.currency,
+			# the outstanding amount is in the currency of the party account
+			purchase_invoice.party_account_currency.as_("currency"),
 			party_match.as_("party_match"),
 			amount_rank.as_("amount_match"),
 			name_match.as_("name_in_desc_match"),
@@ -1273,15 +1900,23 @@ def get_unpaid_pi_matching_query(
 		.where(purchase_invoice.company == company)
 		.where(purchase_invoice.outstanding_amount != 0.0)
 		.where(purchase_invoice.is_paid == 0)
-		.where(purchase_invoice.currency == currency)
 		.orderby(rank_expression, order=Order.desc)
+		.orderby(purchase_invoice.name)
 		.limit(MAX_QUERY_RESULTS)
 	)
 
 	if include_only_returns:
 		query = query.where(purchase_invoice.is_return == 1)
 	if exact_match:
-		query = query.where(purchase_invoice.outstanding_amount == common_filters.amount)
+		exact_amount = amount_match_condition(
+			purchase_invoice.outstanding_amount, common_filters.amount, common_filters.amount_range
+		)
+		if cross_currency:
+			# amounts in other currencies are compared after conversion
+			exact_amount |= purchase_invoice.party_account_currency != currency
+		query = query.where(exact_amount)
+	if not cross_currency:
+		query = query.where(purchase_invoice.currency == currency)
 	if common_filters.exact_party_match:
 		query = query.where(party_filter)
 
@@ -1310,7 +1945,9 @@ def get_unpaid_ec_matching_query(
 		- expense_claim.total_amount_reimbursed
 		- expense_claim.total_advance_amount
 	)
-	amount_rank = amount_rank_condition(outstanding_amount, common_filters.amount)
+	amount_rank = amount_rank_condition(
+		outstanding_amount, common_filters.amount, common_filters.amount_range
+	)
 
 	# Check reference field equality with common_filters.reference_no
 	reference_field_is_set = reference_field and reference_field != "name"
@@ -1358,11 +1995,14 @@ def get_unpaid_ec_matching_query(
 		.where(outstanding_amount > 0.0)
 		.where(expense_claim.status == "Unpaid")
 		.orderby(rank_expression, order=Order.desc)
+		.orderby(expense_claim.name)
 		.limit(MAX_QUERY_RESULTS)
 	)
 
 	if exact_match:
-		query = query.where(outstanding_amount == common_filters.amount)
+		query = query.where(
+			amount_match_condition(outstanding_amount, common_filters.amount, common_filters.amount_range)
+		)
 	if common_filters.exact_party_match:
 		query = query.where(party_filter)
 
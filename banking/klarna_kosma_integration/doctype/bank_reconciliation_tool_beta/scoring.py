@@ -0,0 +1,114 @@
+# Copyright (c) 2024, ALYF GmbH and contributors
+# For license information, please see license.txt
+"""Second matching stage: rank the candidate vouchers returned by the queries.
+
+The queries return one column per matching component (see the NOTE in utils.py).
+Components that are cheaper or only possible in Python (date proximity, match
+history, converted amounts) are set on the vouchers afterwards. `MatchScorer`
+then computes the rank of all candidates as the weighted sum of the components,
+with the weights from Banking Settings. The vouchers are then sorted by rank,
+see `get_ranked_page`.
+
+The weights do not reach the queries: each query selects its candidates by the
+unweighted sum of the components and returns at most `MAX_QUERY_RESULTS` of
+them. The weights only reorder these candidates.
+"""
+import numpy as np
+
+import frappe
+from frappe.utils import flt
+
+# {component: label in Banking Rank Weight}
+RANK_COMPONENTS = {
+	"amount_match": "Amount",
+	"unallocated_amount_match": "Unallocated Amount",
+	"party_match": "Party",
+	"date_match": "Date",
+	"date_proximity": "Date Proximity",
+	"reference_number_match": "Reference Number",
+	"name_in_desc_match": "Name in Description",
+	"ref_in_desc_match": "Reference in Description",
+	"history_match": "Match History",
+}
+
+
+def get_rank_weights() -> dict[str, float]:
+	"""Return the weight of every rank component, 1 unless configured otherwise."""
+	weights = dict.fromkeys(RANK_COMPONENTS, 1.0)
+	components = {label: component for component, label in RANK_COMPONENTS.items()}
+	for row in frappe.get_cached_doc("Banking Settings").get("rank_weights") or []:
+		if row.component in components:
+			weights[components[row.component]] = flt(row.weight)
+
+	return weights
+
+
+class MatchScorer:
+	"""Rank candidate vouchers by the weighted sum of their matching components."""
+
+	def __init__(self, vouchers: list[dict]) -> None:
+		# The part of the query's rank that is not made up of known components,
+		# e.g. the constant 1 or terms of queries added by other apps
+		self.base_rank = {
+			id(voucher): flt(voucher.get("rank"))
+			- sum(flt(voucher.get(component)) for component in RANK_COMPONENTS)
+			for voucher in vouchers
+		}
+
+	def score(
+		self, vouchers: list[dict], description: str | None, weights: dict[str, float]
+	) -> None:
+		"""Set the rank of the vouchers."""
+		if not vouchers:
+			return
+
+		if description:
+			self.set_name_in_description(vouchers, description)
+
+		# reading the components from the dicts is a Python loop, the weighting isn't
+		components = list(weights)
+		matrix = np.array(
+			[
+				[self.base_rank.get(id(voucher), 1.0)]
+				+ [flt(voucher.get(component)) for component in components]
+				for voucher in vouchers
+			],
+			dtype=float,
+		)
+		rank = matrix @ np.array([1.0] + [weights[component] for component in components])
+
+		for voucher, voucher_rank in zip(vouchers, rank.round(2).tolist()):
+			voucher["rank"] = voucher_rank
+
+	@staticmethod
+	def set_name_in_description(vouchers: list[dict], description: str) -> None:
+		"""Set `name_in_desc_match` for vouchers whose query does not check it."""
+		candidates = [voucher for voucher in vouchers if "name_in_desc_match" not in voucher]
+		if not candidates:
+			return
+
+		references = np.array(
+			[(voucher.get("reference_no") or "").strip() for voucher in candidates], dtype=str
+		)
+		found = (np.char.find(description, references) >= 0) & (references != "")
+		for voucher, is_found in zip(candidates, found.tolist()):
+			if is_found:
+				voucher["name_in_desc_match"] = 1
+
+
+def get_ranked_page(
+	vouchers: list[dict], start: int = 0, page_length: int | None = None
+) -> list[dict]:
+	"""
+	Return the vouchers best match first, all of them or the page of `page_length` from `start`.
+
+	Vouchers with the same rank keep their order, i.e. the order of the queries and,
+	within a query, the order by name.
+	"""
+	ranked = sorted(vouchers, key=get_sort_key)
+	stop = start + page_length if page_length else None
+	return ranked[start:stop]
+
+
+def get_sort_key(voucher: dict) -> float:
+	return -voucher["rank"]
@@ -1,6 +1,7 @@
 # Copyright (c) 2023, ALYF GmbH and Contributors
 # See license.txt
 import json
+from unittest.mock import patch
 
 import frappe
 from frappe.custom.doctype.custom_field.custom_field import create_custom_field
@@ -21,12 +22,30 @@ from erpnext.accounts.doctype.sales_invoice.test_sales_invoice import (
 )
 
 from banking.klarna_kosma_integration.doctype.bank_reconciliation_tool_beta.bank_reconciliation_tool_beta import (
+	auto_reconcile_lock,
 	auto_reconcile_vouchers,
+	bulk_reconcile_transactions,
 	bulk_reconcile_vouchers,
+	cancel_auto_reconcile,
 	create_journal_entry_bts,
 	create_payment_entry_bts,
+	get_auto_reconcile_cache_key,
 	get_linked_payments,
+	get_write_off_proposal,
+	reconcile_transaction,
+	start_auto_reconcile,
 )
+from banking.klarna_kosma_integration.doctype.bank_reconciliation_tool_beta.scoring import (
+	RANK_COMPONENTS,
+	MatchScorer,
+	get_ranked_page,
+)
+from banking.klarna_kosma_integration.doctype.bank_reconciliation_tool_beta.utils import (
+	add_converted_amounts,
+	add_date_proximity,
+	clear_reference_field_map,
+)
+from banking.metadata_cache import get_cache
 
 from hrms.hr.doctype.expense_claim.test_expense_claim import make_expense_claim
 
@@ -54,6 +73,10 @@ class TestBankReconciliationToolBeta(AccountsTestMixin, FrappeTestCase):
 		"""Runs after each test."""
 		# Make sure invoices are rolled back to not affect invoice count assertions
 		frappe.db.rollback(save_point="bank_reco_beta_before_tests")
+		# Banking Settings are rolled back as well, rebuild the map from the db
+		clear_reference_field_map()
+		# Bank Account changes are rolled back without clearing the cached values
+		get_cache().clear()
 
 	def test_unpaid_invoices_more_than_transaction(self):
 		"""
@@ -255,6 +278,96 @@ class TestBankReconciliationToolBeta(AccountsTestMixin, FrappeTestCase):
 		self.assertEqual(bt2.payment_entries[0].payment_entry, pe.name)
 		self.assertEqual(bt2.status, "Reconciled")
 
+	def test_bulk_reconcile_transactions(self):
+		"""
+		Test if many transactions are reconciled in one call and failures are reported.
+		"""
+		pe = create_payment_entry(
+			payment_type="Receive",
+			party_type="Customer",
+			party=self.customer,
+			paid_from="Debtors - _TC",
+			paid_to=self.gl_account,
+			paid_amount=200,
+			save=1,
+			submit=1,
+		)
+		bt1 = create_bank_transaction(deposit=100, bank_account=self.bank_account)
+		bt2 = create_bank_transaction(deposit=150, bank_account=self.bank_account)
+		vouchers = [{"payment_doctype": "Payment Entry", "payment_name": pe.name}]
+
+		result = bulk_reconcile_transactions(
+			json.dumps(
+				[
+					{"bank_transaction_name": bt1.name, "vouchers": vouchers},
+					{"bank_transaction_name": "_Test Missing Transaction", "vouchers": vouchers},
+					{"bank_transaction_name": bt2.name, "vouchers": vouchers},
+				]
+			),
+			chunk_size=100,
+		)
+
+		self.assertEqual(result["reconciled"], [bt1.name])
+		self.assertEqual(result["partially_reconciled"], [bt2.name])
+		self.assertEqual(len(result["errors"]), 1)
+		self.assertEqual(
+			result["errors"][0]["bank_transaction_name"], "_Test Missing Transaction"
+		)
+
+		bt2.reload()
+		self.assertEqual(bt2.payment_entries[0].allocated_amount, 100)
+		self.assertEqual(bt2.unallocated_amount, 50)
+
+	def test_bulk_reconcile_repeated_transaction(self):
+		"""Test if a transaction passed twice is compared with its amount after the first pass."""
+		pe = create_payment_entry(
+			payment_type="Receive",
+			party_type="Customer",
+			party=self.customer,
+			paid_from="Debtors - _TC",
+			paid_to=self.gl_account,
+			paid_amount=100,
+			save=1,
+			submit=1,
+		)
+		bt = create_bank_transaction(deposit=200, bank_account=self.bank_account)
+		row = {
+			"bank_transaction_name": bt.name,
+			"vouchers": [{"payment_doctype": "Payment Entry", "payment_name": pe.name}],
+		}
+
+		result = bulk_reconcile_transactions(json.dumps([row, row]))
+
+		# the second pass adds nothing
+		self.assertEqual(result["partially_reconciled"], [bt.name])
+		self.assertFalse(result["errors"])
+
+	def test_duplicate_vouchers_are_added_once(self):
+		"""Test if a voucher passed twice is only allocated once."""
+		pe = create_payment_entry(
+			payment_type="Receive",
+			party_type="Customer",
+			party=self.customer,
+			paid_from="Debtors - _TC",
+			paid_to=self.gl_account,
+			paid_amount=100,
+			save=1,
+			submit=1,
+		)
+		bt = create_bank_transaction(deposit=200, bank_account=self.bank_account)
+		voucher = {"payment_doctype": "Payment Entry", "payment_name": pe.name}
+
+		bulk_reconcile_vouchers(bt.name, json.dumps([voucher, voucher]))
+		bt.reload()
+		self.assertEqual(len(bt.payment_entries), 1)
+		self.assertEqual(bt.unallocated_amount, 100)
+
+		bt.append(
+			"payment_entries",
+			{"payment_document": "Payment Entry", "payment_entry": pe.name},
+		)
+		self.assertRaises(frappe.ValidationError, bt.validate_duplicate_references)
+
 	def test_pe_against_transaction(self):
 		bt = create_bank_transaction(
 			deposit=100, reference_no="abcdef", bank_account=self.bank_account
@@ -492,6 +605,94 @@ class TestBankReconciliationToolBeta(AccountsTestMixin, FrappeTestCase):
 		self.assertEqual(bt.status, "Unreconciled")
 		self.assertEqual(bt.unallocated_amount, 50)
 
+	def test_cancelled_auto_reconciliation(self):
+		"""Test if a cancelled auto reconciliation does not reconcile."""
+		bt = create_bank_transaction(
+			deposit=100, reference_no="Test002", bank_account=self.bank_account
+		)
+		pe = create_payment_entry(
+			payment_type="Receive",
+			party_type="Customer",
+			party=self.customer,
+			paid_from="Debtors - _TC",
+			paid_to=self.gl_account,
+			paid_amount=100,
+			save=1,
+		)
+		pe.reference_no = "Test002"
+		pe.submit()
+
+		kwargs = dict(
+			bank_account=self.bank_account,
+			from_date=add_days(getdate(), -1),
+			to_date=add_days(getdate(), 1),
+		)
+		cancel_auto_reconcile(self.bank_account)
+		auto_reconcile_vouchers(**kwargs)
+		bt.reload()
+		self.assertEqual(bt.status, "Unreconciled")
+
+		frappe.cache.delete_value(
+			get_auto_reconcile_cache_key(self.bank_account, "cancel")
+		)
+		reconciled, _ = auto_reconcile_vouchers(**kwargs)
+		bt.reload()
+		self.assertEqual(reconciled, {bt.name})
+		self.assertEqual(bt.status, "Reconciled")
+
+	def test_auto_reconciliation_lock(self):
+		"""Test if a Bank Account is not auto reconciled twice at the same time."""
+		with auto_reconcile_lock(self.bank_account):
+			self.assertRaises(
+				frappe.ValidationError, auto_reconcile_vouchers, bank_account=self.bank_account
+			)
+			self.assertFalse(start_auto_reconcile(self.bank_account))
+
+		# the lock is released
+		auto_reconcile_vouchers(bank_account=self.bank_account)
+
+	def test_failing_auto_reconciliation(self):
+		"""Test if a failing transaction does not stop the auto reconciliation."""
+		transactions = []
+		for reference_no in ("Test-Fail", "Test-Ok"):
+			transactions.append(
+				create_bank_transaction(
+					deposit=100, reference_no=reference_no, bank_account=self.bank_account
+				)
+			)
+			pe = create_payment_entry(
+				payment_type="Receive",
+				party_type="Customer",
+				party=self.customer,
+				paid_from="Debtors - _TC",
+				paid_to=self.gl_account,
+				paid_amount=100,
+				save=1,
+			)
+			pe.reference_no = reference_no
+			pe.submit()
+
+		failing, succeeding = transactions
+
+		def reconcile(bank_transaction_name, vouchers, *args, **kwargs):
+			if bank_transaction_name == failing.name:
+				frappe.throw("Reconciliation failed")
+			return reconcile_transaction(bank_transaction_name, vouchers, *args, **kwargs)
+
+		with patch(
+			"banking.klarna_kosma_integration.doctype.bank_reconciliation_tool_beta.bank_reconciliation_tool_beta.reconcile_transaction",
+			side_effect=reconcile,
+		):
+			reconciled, _ = auto_reconcile_vouchers(
+				bank_account=self.bank_account,
+				from_date=add_days(getdate(), -1),
+				to_date=add_days(getdate(), 1),
+			)
+
+		failing.reload()
+		self.assertEqual(reconciled, {succeeding.name})
+		self.assertEqual(failing.status, "Unreconciled")
+
 	def test_multi_party_reconciliation(self):
 		bt = create_bank_transaction(
 			deposit=150,
@@ -664,6 +865,241 @@ class TestBankReconciliationToolBeta(AccountsTestMixin, FrappeTestCase):
 		self.assertEqual(first_match["amount_match"], 1)
 		self.assertEqual(first_match["ref_in_desc_match"], 0)
 
+	def test_date_proximity(self):
+		"""Test if vouchers are scored by business days between voucher and bank date."""
+		monday = getdate("2024-12-16")
+		vouchers = [
+			{"rank": 1, "date_match": 0, "posting_date": getdate("2024-12-13")},  # Friday
+			{"rank": 2, "date_match": 1, "posting_date": monday},
+			{"rank": 1, "date_match": 0, "posting_date": getdate("2024-12-18")},
+			{"rank": 1, "date_match": 0, "posting_date": getdate("2024-12-30")},
+			{"rank": 1, "reference_date": getdate("2024-12-17")},  # no date rank in query
+		]
+		add_date_proximity(vouchers, monday, tolerance=5)
+
+		self.assertEqual(vouchers[0]["date_proximity"], 0.83)
+		self.assertNotIn("date_proximity", vouchers[1])
+		self.assertEqual(vouchers[2]["date_proximity"], 0.67)
+		self.assertNotIn("date_proximity", vouchers[3])
+		self.assertNotIn("date_proximity", vouchers[4])
+
+	def test_converted_amounts(self):
+		"""Test if vouchers in other currencies are matched by their converted amount."""
+		frappe.get_doc(
+			{
+				"doctype": "Currency Exchange",
+				"date": "2024-01-15",
+				"from_currency": "USD",
+				"to_currency": "INR",
+				"exchange_rate": 80,
+				"for_buying": 1,
+				"for_selling": 1,
+			}
+		).insert()
+		frappe.local.banking_exchange_rates = {}
+
+		vouchers = [
+			{"rank": 2, "amount_match": 1, "currency": "INR", "paid_amount": 800},
+			{
+				"rank": 1,
+				"amount_match": 0,
+				"currency": "USD",
+				"paid_amount": 10.1,
+				"posting_date": getdate("2024-01-17"),  # uses the last known rate
+			},
+			{
+				"rank": 2,
+				"amount_match": 1,
+				"currency": "USD",
+				"paid_amount": 800,
+				"posting_date": getdate("2024-01-17"),
+			},
+		]
+		vouchers = add_converted_amounts(vouchers, "INR", 800, tolerance=2)
+
+		self.assertEqual(len(vouchers), 3)
+		self.assertNotIn("converted_amount", vouchers[0])
+		self.assertEqual(vouchers[1]["converted_amount"], 808)
+		self.assertEqual(vouchers[1]["amount_match"], 1)
+		self.assertEqual(vouchers[2]["amount_match"], 0)
+
+		vouchers = add_converted_amounts(vouchers, "INR", 800, tolerance=2, exact_match=True)
+		self.assertEqual(len(vouchers), 2)
+
+	def test_converted_amounts_fallback(self):
+		"""Test if vouchers without a rate shortly before their date use the fallback rate."""
+		for date, rate in (("2024-01-01", 79), ("2024-01-15", 80)):
+			frappe.get_doc(
+				{
+					"doctype": "Currency Exchange",
+					"date": date,
+					"from_currency": "USD",
+					"to_currency": "INR",
+					"exchange_rate": rate,
+					"for_buying": 1,
+					"for_selling": 1,
+				}
+			).insert()
+		frappe.local.banking_exchange_rates = {}
+
+		vouchers = [
+			{"currency": "USD", "paid_amount": 10, "posting_date": getdate("2024-01-10")},
+			{"currency": "USD", "paid_amount": 10, "posting_date": getdate("2024-01-17")},
+		]
+		vouchers = add_converted_amounts(vouchers, "INR", 790, tolerance=0, exact_match=True)
+
+		self.assertEqual(len(vouchers), 1)
+		self.assertEqual(vouchers[0]["exchange_rate"], 79)
+		self.assertEqual(vouchers[0]["converted_amount"], 790)
+
+	def test_amount_tolerance(self):
+		"""Test if vouchers within the amount tolerance of the bank account match."""
+		set_amount_tolerance(self.bank_account, "Absolute", 5)
+		bt = create_bank_transaction(date=getdate(), deposit=97, bank_account=self.bank_account)
+		si = create_sales_invoice(
+			rate=100,
+			warehouse="Finished Goods - _TC",
+			customer=self.customer,
+			cost_center="Main - _TC",
+			item="Reco Item",
+		)
+		si2 = create_sales_invoice(
+			rate=110,
+			warehouse="Finished Goods - _TC",
+			customer=self.customer,
+			cost_center="Main - _TC",
+			item="Reco Item",
+		)
+
+		matched_vouchers = get_linked_payments(
+			bank_transaction_name=bt.name,
+			document_types=["sales_invoice", "unpaid_invoices", "exact_match"],
+			from_date=add_days(getdate(), -1),
+			to_date=add_days(getdate(), 1),
+		)
+		matched_vouchers = {voucher["name"]: voucher for voucher in matched_vouchers}
+
+		self.assertIn(si.name, matched_vouchers)
+		self.assertEqual(matched_vouchers[si.name]["amount_match"], 1)
+		self.assertNotIn(si2.name, matched_vouchers)
+
+	def test_write_off_difference(self):
+		"""Test if the difference within the amount tolerance is written off."""
+		set_amount_tolerance(self.bank_account, "Percentage", 5, "Write Off - _TC")
+		bt = create_bank_transaction(deposit=97, bank_account=self.bank_account)
+		si = create_sales_invoice(
+			rate=100,
+			warehouse="Finished Goods - _TC",
+			customer=self.customer,
+			cost_center="Main - _TC",
+			item="Reco Item",
+		)
+		si2 = create_sales_invoice(
+			rate=110,
+			warehouse="Finished Goods - _TC",
+			customer=self.customer,
+			cost_center="Main - _TC",
+			item="Reco Item",
+		)
+
+		# 13 is more than 5% of 97
+		self.assertIsNone(
+			get_write_off_proposal(
+				bt.name, [{"payment_doctype": "Sales Invoice", "payment_name": si2.name}]
+			)
+		)
+
+		vouchers = [{"payment_doctype": "Sales Invoice", "payment_name": si.name}]
+		write_off = get_write_off_proposal(bt.name, vouchers)
+		self.assertEqual(write_off["amount"], 3)
+		self.assertEqual(write_off["account"], "Write Off - _TC")
+
+		bulk_reconcile_vouchers(bt.name, json.dumps(vouchers), write_off_difference=True)
+
+		bt.reload()
+		si.reload()
+		self.assertEqual(bt.status, "Reconciled")
+		self.assertEqual(si.outstanding_amount, 0)
+
+		pe = frappe.get_doc("Payment Entry", bt.payment_entries[0].payment_entry)
+		self.assertEqual(pe.paid_amount, 97)
+		self.assertEqual(pe.deductions[0].account, "Write Off - _TC")
+		self.assertEqual(pe.deductions[0].amount, 3)
+
+	def test_match_scorer(self):
+		"""Test if the rank is the weighted sum of the matching components."""
+		vouchers = [
+			{"rank": 3, "amount_match": 1, "party_match": 1, "reference_no": "ACC-PAY-1"},
+			{"rank": 2, "amount_match": 1, "party_match": 0, "reference_no": "ACC-PAY-2"},
+			{"rank": 2, "amount_match": 0, "party_match": 1, "reference_no": None},
+		]
+		scorer = MatchScorer(vouchers)
+		vouchers[1]["date_proximity"] = 0.5  # set after the queries
+
+		weights = dict.fromkeys(RANK_COMPONENTS, 1.0)
+		scorer.score(vouchers, "Payment for ACC-PAY-2", weights)
+		ranked = get_ranked_page(vouchers)
+
+		# unchanged weights reproduce the rank of the queries plus the new components
+		self.assertEqual([voucher["rank"] for voucher in ranked], [3.5, 3, 2])
+		self.assertEqual(ranked[0]["reference_no"], "ACC-PAY-2")
+		self.assertEqual(ranked[0]["name_in_desc_match"], 1)
+		self.assertNotIn("name_in_desc_match", ranked[1])
+
+		weights["party_match"] = 3
+		scorer.score(vouchers, "Payment for ACC-PAY-2", weights)
+		ranked = get_ranked_page(vouchers)
+		self.assertEqual([voucher["rank"] for voucher in ranked], [5, 4, 3.5])
+		self.assertIsNone(ranked[1]["reference_no"])
+
+	def test_ranked_page(self):
+		"""Test if the ranked vouchers of several queries are sorted and paginated."""
+		vouchers = [
+			{"name": "PE-1", "rank": 3},
+			{"name": "PE-2", "rank": 1.5},
+			{"name": "SI-1", "rank": 2},
+			{"name": "SI-2", "rank": 4},
+			{"name": "JE-1", "rank": 3},
+		]
+
+		def get_page(start=0, page_length=None):
+			return [voucher["name"] for voucher in get_ranked_page(vouchers, start, page_length)]
+
+		# same rank: in the order of the queries
+		self.assertEqual(get_page(), ["SI-2", "PE-1", "JE-1", "SI-1", "PE-2"])
+		self.assertEqual(get_page(0, 2), ["SI-2", "PE-1"])
+		self.assertEqual(get_page(2, 2), ["JE-1", "SI-1"])
+		self.assertEqual(get_page(4, 2), ["PE-2"])
+
+	def test_paginated_matching(self):
+		"""Test if the pages of matching vouchers add up to the full list."""
+		bt = create_bank_transaction(date=getdate(), deposit=100, bank_account=self.bank_account)
+		for rate in (100, 100, 90, 110):
+			create_sales_invoice(
+				rate=rate,
+				warehouse="Finished Goods - _TC",
+				customer=self.customer,
+				cost_center="Main - _TC",
+				item="Reco Item",
+			)
+
+		def get_names(start=0, page_length=None):
+			return [
+				voucher["name"]
+				for voucher in get_linked_payments(
+					bank_transaction_name=bt.name,
+					document_types=["sales_invoice", "unpaid_invoices"],
+					from_date=add_days(getdate(), -1),
+					to_date=add_days(getdate(), 1),
+					start=start,
+					page_length=page_length,
+				)
+			]
+
+		names = get_names()
+		self.assertGreaterEqual(len(names), 4)
+		self.assertEqual(get_names(0, 2) + get_names(2, 2) + get_names(4, len(names)), names)
+
 
 def get_pe_references(vouchers: list):
 	return frappe.get_all(
@@ -674,6 +1110,21 @@ def get_pe_references(vouchers: list):
 	)
 
 
+def set_amount_tolerance(
+	bank_account: str, tolerance_type: str, tolerance: float, write_off_account: str = None
+) -> None:
+	frappe.db.set_value(
+		"Bank Account",
+		bank_account,
+		{
+			"amount_tolerance_type": tolerance_type,
+			"amount_tolerance": tolerance,
+			"write_off_account": write_off_account,
+		},
+	)
+	get_cache().pop(("Bank Account", bank_account), None)
+
+
 def create_bank_transaction(
 	date: str = None,
 	deposit: float = None,
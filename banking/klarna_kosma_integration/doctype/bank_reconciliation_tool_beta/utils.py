@@ -1,39 +1,101 @@
+import datetime
+import re
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from typing import Callable
+
 import frappe
 from frappe import _
+from frappe.utils import cint, flt, getdate
 
 from pypika.queries import Table
-from pypika.terms import Case, Field
+from pypika.terms import Case, Criterion, Field, Parameter
 from frappe.query_builder.functions import CustomFunction, Cast
 
+from banking.exchange_rates import get_exchange_rate_table
+from banking.metadata_cache import get_cached_values
+
 Instr = CustomFunction("INSTR", ["a", "b"])
 RegExpReplace = CustomFunction("REGEXP_REPLACE", ["a", "b", "c"])
 
+# Rendered matching queries by site and query structure, see `compile_query`.
+# The least recently used ones are dropped, e.g. on multi-tenant benches.
+QUERY_TEMPLATES = OrderedDict()
+MAX_QUERY_TEMPLATES = 500
+PARAMETER_MARKER = "__banking_param_{0}__"
+PARAMETER_PATTERN = re.compile(r"__banking_param_(\w+?)__")
+
 # NOTE:
 # Ranking min: 1 (nothing matches), max: 7 (everything matches)
 
 # Types of matches:
-# amount_match: if amount in voucher EQ amount in bank statement
-# party_match: if party in voucher EQ party in bank statement
+# amount_match: if amount in voucher EQ amount in bank statement (or within the
+#   amount tolerance of the Bank Account, see `get_amount_tolerance`)
+# party_match: if party in voucher EQ party in bank statement (or the one
+#   suggested by the counterparty's IBAN or name, see `get_party`)
 # date_match: if date in voucher EQ date in bank statement
+# amount_match of vouchers in other currencies: if the converted amount is within the
+#   exchange rate tolerance of the amount in bank statement (see `add_converted_amounts`)
+# date_proximity: 0 to 1, the closer the date in voucher is to the date in bank statement
+#   (within the date tolerance in Banking Settings, see `add_date_proximity`)
+# history_match: if similar bank transactions were reconciled with the party in voucher
 # reference_number_match: if ref in voucher EQ ref in bank statement
 # name_in_desc_match: if name in voucher IN bank statement description
 # ref_in_desc_match: if ref in voucher IN bank statement description
+#
+# The final rank is the weighted sum of these, see scoring.py
 
 
-def amount_rank_condition(amount: Field, bank_amount: float) -> Case:
+def amount_rank_condition(
+	amount: Field, bank_amount: float, amount_range: tuple | None = None
+) -> Case:
 	"""Get the rank query for amount matching."""
-	return frappe.qb.terms.Case().when(amount == bank_amount, 1).else_(0)
+	return (
+		frappe.qb.terms.Case()
+		.when(amount_match_condition(amount, bank_amount, amount_range), 1)
+		.else_(0)
+	)
+
+
+def amount_match_condition(
+	amount: Field, bank_amount: float, amount_range: tuple | None = None
+) -> Criterion:
+	"""
+	Get the condition for an amount match: equality, or a range predicate
+	if the Bank Account has an amount tolerance (`amount_range` is (min, max)).
+	"""
+	if amount_range:
+		return amount.between(*amount_range)
+
+	return amount == bank_amount
+
+
+def get_amount_tolerance(bank_account: str, amount: float) -> float:
+	"""Return the absolute amount tolerance of a Bank Account for `amount`."""
+	values = get_cached_values("Bank Account", bank_account)
+	if values.amount_tolerance_type == "Percentage":
+		return abs(flt(amount)) * flt(values.amount_tolerance) / 100
+
+	return abs(flt(values.amount_tolerance))
 
 
 def ref_equality_condition(reference_no: Field, bank_reference_no: str) -> Case:
 	"""Get the rank query for reference number matching."""
-	if not bank_reference_no or bank_reference_no == "NOTPROVIDED":
+	if not is_reference_provided(bank_reference_no):
 		# If bank reference number is not provided, then it is not a match
 		return Cast(0, "int")
 
 	return frappe.qb.terms.Case().when(reference_no == bank_reference_no, 1).else_(0)
 
 
+def is_reference_provided(bank_reference_no) -> bool:
+	"""Banks send an empty reference or "NOTPROVIDED" if there is none."""
+	if isinstance(bank_reference_no, Parameter):
+		return True
+
+	return bool(bank_reference_no) and bank_reference_no != "NOTPROVIDED"
+
+
 def get_description_match_condition(
 	description: str, table: Table, column_name: str = "name"
 ) -> Case:
@@ -74,37 +136,214 @@ def get_description_match_condition(
 		)
 
 
-def get_reference_field_map() -> dict:
-	"""Get the reference field map for the document types from Banking Settings.
-	Returns: {"sales_invoice": "custom_field_name", ...}
+def add_business_days(date: datetime.date, days: int) -> datetime.date:
+	"""Add (or subtract) a number of business days, skipping weekends."""
+	step = 1 if days >= 0 else -1
+	days = abs(days)
+	while days:
+		date += datetime.timedelta(days=step)
+		if date.weekday() < 5:
+			days -= 1
+
+	return date
+
+
+def get_date_tolerance() -> int:
+	"""Return the date tolerance in business days from Banking Settings."""
+	return cint(frappe.db.get_single_value("Banking Settings", "date_tolerance"))
+
+
+def get_business_days_between(start: datetime.date, end: datetime.date) -> int:
+	"""Return the number of business days from `start` to `end`, in either direction."""
+	if start > end:
+		start, end = end, start
+
+	weeks, days = divmod((end - start).days, 7)
+	business_days = weeks * 5
+	for offset in range(1, days + 1):
+		if (start + datetime.timedelta(days=offset)).weekday() < 5:
+			business_days += 1
+
+	return business_days
+
+
+def add_date_proximity(vouchers: list[dict], date: datetime.date, tolerance: int) -> None:
+	"""Score vouchers by how close their date is to the bank date.
+
+	The score is 1 for the same business day and decreases to 0 beyond
+	`tolerance` business days. Only vouchers of queries with a `date_match`
+	column are ranked, exact matches are already ranked by the query.
+	The candidates are sorted by date once, the ones within the window are
+	found by bisection.
 	"""
+	if tolerance <= 0:
+		return
 
-	def _validate_and_get_field(row: dict) -> str:
-		is_docfield = frappe.db.exists(
-			"DocField", {"fieldname": row.field_name, "parent": row.document_type}
+	candidates = sorted(
+		(
+			(getdate(voucher.get("reference_date") or voucher.get("posting_date")), idx)
+			for idx, voucher in enumerate(vouchers)
+			if "date_match" in voucher
+			and not voucher["date_match"]
+			and (voucher.get("reference_date") or voucher.get("posting_date"))
 		)
-		is_custom = frappe.db.exists(
-			"Custom Field", {"fieldname": row.field_name, "dt": row.document_type}
+	)
+	dates = [candidate[0] for candidate in candidates]
+	date = getdate(date)
+	start = bisect_left(dates, add_business_days(date, -tolerance))
+	end = bisect_right(dates, add_business_days(date, tolerance))
+
+	for voucher_date, idx in candidates[start:end]:
+		score = round(1 - get_business_days_between(voucher_date, date) / (tolerance + 1), 2)
+		vouchers[idx]["date_proximity"] = score
+
+
+def get_exchange_rate_tolerance() -> float:
+	"""Return the tolerance for converted amounts in percent from Banking Settings."""
+	return flt(frappe.db.get_single_value("Banking Settings", "exchange_rate_tolerance"))
+
+
+def add_converted_amounts(
+	vouchers: list[dict],
+	currency: str,
+	amount: float,
+	tolerance: float,
+	exact_match: bool = False,
+) -> list[dict]:
+	"""Convert the amounts of vouchers in other currencies and match them by the converted amount.
+
+	The rates of all currencies in the vouchers' date range are loaded at once,
+	see `get_exchange_rate_table`. With `exact_match`, vouchers in other
+	currencies whose converted amount is not within `tolerance` percent are removed.
+	"""
+	foreign = [
+		voucher
+		for voucher in vouchers
+		if voucher.get("currency") and voucher["currency"] != currency
+	]
+	if not foreign:
+		return vouchers
+
+	dates = [getdate(voucher.get("posting_date")) for voucher in foreign]
+	table = get_exchange_rate_table(
+		currency, {voucher["currency"] for voucher in foreign}, min(dates), max(dates)
+	)
+	rates = [
+		flt(table.get_rate(voucher["currency"], date)) for voucher, date in zip(foreign, dates)
+	]
+	max_difference = abs(flt(amount)) * flt(tolerance) / 100
+
+	unmatched = set()
+	for voucher, rate in zip(foreign, rates):
+		amount_match = 0
+		if rate:
+			voucher["exchange_rate"] = rate
+			voucher["converted_amount"] = flt(flt(voucher["paid_amount"]) * rate, 2)
+			amount_match = cint(abs(voucher["converted_amount"] - flt(amount)) <= max_difference)
+
+		voucher["amount_match"] = amount_match
+		if exact_match and not amount_match:
+			unmatched.add(id(voucher))
+
+	return [voucher for voucher in vouchers if id(voucher) not in unmatched]
+
+
+class CompiledQuery:
+	"""A rendered matching query and its values. Runs like a query builder query."""
+
+	def __init__(self, key: tuple, sql: str, values: dict) -> None:
+		self.key = key
+		self.sql = sql
+		self.values = values
+
+	def run(self, as_dict: bool = False):
+		return frappe.db.sql(self.sql, self.values, as_dict=as_dict)
+
+
+def get_query_parameter(name: str) -> Parameter:
+	"""Placeholder for a value that is bound when running a compiled query."""
+	return Parameter(PARAMETER_MARKER.format(name))
+
+
+def compile_query(key: tuple, build: Callable, values: dict) -> CompiledQuery | None:
+	"""Render the query returned by `build` once per site and structural `key`.
+
+	`build` must use `get_query_parameter` for every value that changes between
+	transactions and is part of `values`. Everything else must be in `key`.
+	"""
+	key = (frappe.local.site, *key)
+	if key in QUERY_TEMPLATES:
+		QUERY_TEMPLATES.move_to_end(key)
+	else:
+		query = build()
+		# Escape literal "%" before the placeholders are inserted
+		QUERY_TEMPLATES[key] = (
+			PARAMETER_PATTERN.sub(r"%(\1)s", query.get_sql().replace("%", "%%"))
+			if query
+			else None
 		)
-		if not (is_docfield or is_custom):
-			frappe.throw(
-				title=_("Invalid Field"),
-				msg=_(
-					"Field {} does not exist in {}. Please check the configuration in Banking Settings."
-				).format(frappe.bold(row.field_name), frappe.bold(row.document_type)),
-			)
+		if len(QUERY_TEMPLATES) > MAX_QUERY_TEMPLATES:
+			QUERY_TEMPLATES.popitem(last=False)
+
+	sql = QUERY_TEMPLATES[key]
+	if sql is None:
+		return None
+
+	return CompiledQuery(key, sql, values)
+
 
-		return row.field_name
+REFERENCE_FIELD_MAP_CACHE_KEY = "banking_reference_field_map"
 
-	reference_fields = frappe.get_all(
-		"Banking Reference Mapping",
-		filters={
-			"parent": "Banking Settings",
-		},
-		fields=["document_type", "field_name"],
+
+def get_reference_field_map() -> dict:
+	"""Get the reference field map for the document types from Banking Settings.
+	Returns: {"sales_invoice": "custom_field_name", ...}
+
+	The map is validated when Banking Settings are saved. It is cached on the
+	first read after it was cleared (see `clear_reference_field_map`).
+	"""
+	return frappe.cache.get_value(
+		REFERENCE_FIELD_MAP_CACHE_KEY, generator=build_reference_field_map
 	)
 
+
+def build_reference_field_map(reference_fields: list | None = None) -> dict:
+	"""Validate the reference fields and return them by scrubbed document type."""
+	if reference_fields is None:
+		reference_fields = frappe.get_all(
+			"Banking Reference Mapping",
+			filters={
+				"parent": "Banking Settings",
+			},
+			fields=["document_type", "field_name"],
+		)
+
 	return {
-		frappe.scrub(row.document_type): _validate_and_get_field(row)
+		frappe.scrub(row.document_type): validate_reference_field(
+			row.document_type, row.field_name
+		)
 		for row in reference_fields
 	}
+
+
+def validate_reference_field(document_type: str, field_name: str) -> str:
+	is_docfield = frappe.db.exists(
+		"DocField", {"fieldname": field_name, "parent": document_type}
+	)
+	is_custom = frappe.db.exists(
+		"Custom Field", {"fieldname": field_name, "dt": document_type}
+	)
+	if not (is_docfield or is_custom):
+		frappe.throw(
+			title=_("Invalid Field"),
+			msg=_(
+				"Field {} does not exist in {}. Please check the configuration in Banking Settings."
+			).format(frappe.bold(field_name), frappe.bold(document_type)),
+		)
+
+	return field_name
+
+
+def clear_reference_field_map(doc=None, event=None) -> None:
+	"""Clear the cached reference field map, e.g. after a Custom Field or DocType changed."""
+	frappe.cache.delete_value(REFERENCE_FIELD_MAP_CACHE_KEY)
@@ -30,6 +30,10 @@ frappe.ui.form.on('Banking Settings', {
 				frm.trigger("get_subscription");
 			}
 
+			frm.add_custom_button(__("Sync Status"), () => {
+				frm.events.show_sync_status(frm);
+			});
+
 			frm.add_custom_button(__("Open Billing Portal"), async () => {
 				const url = await frm.call({
 					method: "get_customer_portal_url",
@@ -54,6 +58,10 @@ frappe.ui.form.on('Banking Settings', {
 		frm.doc.reference_fields.map((field) => {
 			set_field_options(frm, field.doctype, field.name);
 		});
+
+		if (frm.doc.enable_profiling) {
+			frm.trigger("show_profiling_stats");
+		}
 	},
 
 	refresh_banks: (frm) => {
@@ -173,6 +181,113 @@ frappe.ui.form.on('Banking Settings', {
 		dialog.show();
 	},
 
+	show_sync_status: async (frm) => {
+		const data = await frm.call({
+			method: "get_sync_status",
+			freeze: true,
+		});
+
+		const rows = (data.message || []).map((row) => `
+			<tr>
+				<td>${__(row.doctype)}</td>
+				<td>${frappe.utils.escape_html(row.name)}</td>
+				<td>${__(row.state)}</td>
+				<td>${row.last_status ? __(row.last_status) : "-"}</td>
+				<td>${row.last_finished ? frappe.datetime.comment_when(row.last_finished) : "-"}</td>
+			</tr>
+		`).join("");
+
+		const dialog = new frappe.ui.Dialog({
+			title: __("Sync Status"),
+			size: "large",
+			fields: [{ fieldtype: "HTML", fieldname: "status" }],
+		});
+		dialog.get_field("status").$wrapper.html(`
+			<table class="table table-bordered">
+				<thead>
+					<tr>
+						<th>${__("Type")}</th>
+						<th>${__("Name")}</th>
+						<th>${__("State")}</th>
+						<th>${__("Last Sync")}</th>
+						<th>${__("Finished")}</th>
+					</tr>
+				</thead>
+				<tbody>
+					${rows || `<tr><td colspan="5" class="text-muted">${__("No synced accounts")}</td></tr>`}
+				</tbody>
+			</table>
+		`);
+		dialog.show();
+	},
+
+	show_profiling_stats: async (frm) => {
+		const data = await frm.call({ method: "get_profiling_stats" });
+		const stats = data.message || { stages: [], slow_queries: [] };
+
+		const stage_rows = stats.stages.map((row) => `
+			<tr>
+				<td>${row.bank_account ? frappe.utils.escape_html(row.bank_account) : "-"}</td>
+				<td>${frappe.utils.escape_html(row.stage)}</td>
+				<td class="text-right">${row.calls}</td>
+				<td class="text-right">${format_number(row.avg_time)}</td>
+				<td class="text-right">${format_number(row.total_time)}</td>
+				<td class="text-right">${format_number(row.avg_statements)}</td>
+				<td class="text-right">${format_number(row.avg_rows)}</td>
+			</tr>
+		`).join("");
+
+		const slow_query_rows = stats.slow_queries.map((row) => `
+			<tr>
+				<td>${frappe.datetime.comment_when(row.timestamp)}</td>
+				<td>${row.bank_account ? frappe.utils.escape_html(row.bank_account) : "-"}</td>
+				<td>${row.stage ? frappe.utils.escape_html(row.stage) : "-"}</td>
+				<td class="text-right">${format_number(row.duration)}</td>
+				<td><code>${frappe.utils.escape_html(row.query)}</code></td>
+			</tr>
+		`).join("");
+
+		const $wrapper = frm.get_field("profiling_stats").$wrapper;
+		$wrapper.html(`
+			<table class="table table-bordered small">
+				<thead>
+					<tr>
+						<th>${__("Bank Account")}</th>
+						<th>${__("Step")}</th>
+						<th class="text-right">${__("Calls")}</th>
+						<th class="text-right">${__("Avg. Time (ms)")}</th>
+						<th class="text-right">${__("Total Time (ms)")}</th>
+						<th class="text-right">${__("Avg. SQL Statements")}</th>
+						<th class="text-right">${__("Avg. Rows")}</th>
+					</tr>
+				</thead>
+				<tbody>
+					${stage_rows || `<tr><td colspan="7" class="text-muted">${__("Nothing recorded yet")}</td></tr>`}
+				</tbody>
+			</table>
+			<p class="bold">${__("Slow SQL Statements")}</p>
+			<table class="table table-bordered small">
+				<thead>
+					<tr>
+						<th>${__("Time")}</th>
+						<th>${__("Bank Account")}</th>
+						<th>${__("Step")}</th>
+						<th class="text-right">${__("Duration (ms)")}</th>
+						<th>${__("SQL")}</th>
+					</tr>
+				</thead>
+				<tbody>
+					${slow_query_rows || `<tr><td colspan="5" class="text-muted">${__("Nothing recorded yet")}</td></tr>`}
+				</tbody>
+			</table>
+			<button class="btn btn-xs btn-default btn-reset-profiling">${__("Reset")}</button>
+		`);
+		$wrapper.find(".btn-reset-profiling").on("click", async () => {
+			await frm.call({ method: "reset_profiling_stats" });
+			frm.trigger("show_profiling_stats");
+		});
+	},
+
 	get_subscription: async (frm) => {
 		const data = await frm.call({
 			method: "fetch_subscription_data",
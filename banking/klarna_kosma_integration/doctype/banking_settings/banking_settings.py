@@ -9,7 +9,12 @@ import frappe
 from frappe import _
 from frappe.model.document import Document
 
+from banking.jobs import enqueue_sync, get_sync_state
 from banking.klarna_kosma_integration.admin import Admin
+from banking.klarna_kosma_integration.doctype.bank_reconciliation_tool_beta.utils import (
+	build_reference_field_map,
+	clear_reference_field_map,
+)
 from banking.klarna_kosma_integration.exception_handler import BankingError
 from banking.klarna_kosma_integration.utils import (
 	create_bank_account,
@@ -17,12 +22,25 @@ from banking.klarna_kosma_integration.utils import (
 	update_bank_account,
 	update_bank,
 )
+from banking.profiling import clear_profile_stats, get_profile_stats
+
+# Upper bound for background jobs refreshing Bank Consents at the same time
+MAX_PARALLEL_CONSENT_REFRESHES = 4
 
 
 class BankingSettings(Document):
 	def before_validate(self):
 		self.update_fintech_license()
 
+	def validate(self):
+		build_reference_field_map(self.reference_fields)
+
+	def on_update(self):
+		# The map is rebuilt on the next read. Clear it again after the commit,
+		# in case it was read in the meantime.
+		clear_reference_field_map()
+		frappe.db.after_commit.add(clear_reference_field_map)
+
 	def update_fintech_license(self):
 		if not self.enabled:
 			return self.reset_fintech_license()
@@ -97,13 +115,27 @@ def sync_transactions(account: str, session_id_short: Optional[str] = None) -> N
 			title=_("Kosma Error"),
 		)
 
-	frappe.enqueue(
+	# Flow syncs share the job ID of the account, so that they never run
+	# alongside a regular sync of the same account
+	enqueued = enqueue_sync(
 		"banking.klarna_kosma_integration.admin.sync_kosma_transactions",
+		"Bank Account",
+		account,
+		now=frappe.conf.developer_mode,
 		account=account,
 		session_id_short=session_id_short,
-		now=frappe.conf.developer_mode,
 	)
 
+	if not enqueued:
+		frappe.msgprint(
+			_("A Transaction Sync for Bank Account {0} is already queued or running.").format(
+				frappe.bold(account)
+			),
+			alert=True,
+			indicator="orange",
+		)
+		return
+
 	frappe.msgprint(
 		_(
 			"Background Transaction Sync is in progress. Please check the Bank Transaction List for updates."
@@ -131,40 +163,90 @@ def sync_all_accounts_and_transactions():
 
 
 def daily_sync_kosma():
-	accounts_list = []
+	"""
+	Refresh the accounts of all Bank Consents in background jobs.
 
-	for bank, company in frappe.get_all(
-		"Bank Consent", fields=["bank", "company"], as_list=True
-	):
-		accounts = get_bank_accounts_to_sync(bank, company)
+	Consents are spread over at most `MAX_PARALLEL_CONSENT_REFRESHES` jobs, so that
+	only a bounded number of requests hit the admin backend at the same time.
+	"""
+	consents = frappe.get_all("Bank Consent", fields=["bank", "company"], as_list=True)
+	if not consents:
+		return
+
+	batch_count = min(MAX_PARALLEL_CONSENT_REFRESHES, len(consents))
+	for i in range(batch_count):
+		frappe.enqueue(
+			"banking.klarna_kosma_integration.doctype.banking_settings.banking_settings.refresh_consents",
+			queue="long",
+			consents=consents[i::batch_count],
+		)
+
+
+def refresh_consents(consents: list) -> None:
+	"""Refresh each consent's accounts and enqueue their transactions sync right away."""
+	for bank, company in consents:
+		try:
+			refresh_consent_accounts(bank, company)
+		except Exception:
+			frappe.db.rollback()
+			frappe.log_error(title=_("Banking Error"), message=frappe.get_traceback())
+
+
+def refresh_consent_accounts(bank: str, company: str) -> None:
+	"""
+	Update the Bank Accounts linked to a consent and enqueue their transactions sync.
+	"""
+	accounts = get_bank_accounts_to_sync(bank, company)
+	bank_accounts = []
+
+	if accounts:
+		iban_map = get_bank_accounts_by_iban(
+			[account.get("iban") for account in accounts if account.get("iban")]
+		)
 		for account in accounts:
-			bank_account = frappe.db.exists("Bank Account", {"iban": account.get("iban")})
+			bank_account = iban_map.get(account.get("iban"))
 			if not bank_account:
 				continue
 
 			update_bank_account(account, bank_account)
-			accounts_list.append(bank_account)
-
-		if not accounts:
-			accounts_list.extend(
-				frappe.get_all(
-					"Bank Account",
-					filters={
-						"bank": bank,
-						"company": company,
-						"kosma_account_id": ["is", "set"],
-					},
-					pluck="name",
-				)
-			)
-
-	for bank_account in accounts_list:
+			bank_accounts.append(bank_account)
+	else:
+		bank_accounts = frappe.get_all(
+			"Bank Account",
+			filters={
+				"bank": bank,
+				"company": company,
+				"kosma_account_id": ["is", "set"],
+			},
+			pluck="name",
+		)
+
+	# The sync jobs must see the updated Kosma Account IDs
+	frappe.db.commit()
+
+	for bank_account in bank_accounts:
 		sync_transactions(account=bank_account)
 
 
-def daily_sync_ebics():
-	from banking.ebics.utils import sync_ebics_transactions
+def get_bank_accounts_by_iban(ibans: list) -> dict:
+	"""Return a mapping of IBAN to (first) Bank Account name, resolved in one query."""
+	if not ibans:
+		return {}
+
+	iban_map = {}
+	for name, iban in frappe.get_all(
+		"Bank Account",
+		filters={"iban": ("in", ibans)},
+		fields=["name", "iban"],
+		order_by="creation asc",
+		as_list=True,
+	):
+		iban_map.setdefault(iban, name)
+
+	return iban_map
 
+
+def daily_sync_ebics():
 	for ebics_user in frappe.get_all(
 		"EBICS User",
 		filters={
@@ -175,8 +257,10 @@ def daily_sync_ebics():
 		},
 		pluck="name",
 	):
-		frappe.enqueue(
-			sync_ebics_transactions,
+		enqueue_sync(
+			"banking.ebics.utils.sync_ebics_transactions",
+			"EBICS User",
+			ebics_user,
 			ebics_user=ebics_user,
 		)
 
@@ -191,6 +275,42 @@ def get_bank_accounts_to_sync(bank: str, company: str) -> list:
 		return []
 
 
+@frappe.whitelist()
+def get_sync_status() -> list:
+	"""
+	Returns the state of the transaction sync jobs per Bank Account and EBICS User.
+	"""
+	frappe.only_for("System Manager")
+
+	status = [
+		get_sync_state("Bank Account", account)
+		for account in frappe.get_all(
+			"Bank Account", filters={"kosma_account_id": ("is", "set")}, pluck="name"
+		)
+	]
+	status.extend(
+		get_sync_state("EBICS User", ebics_user)
+		for ebics_user in frappe.get_all("EBICS User", pluck="name")
+	)
+	return status
+
+
+@frappe.whitelist()
+def get_profiling_stats() -> dict:
+	"""
+	Returns the time, SQL statements and rows per reconciliation step and Bank Account,
+	and samples of slow SQL statements.
+	"""
+	frappe.only_for("System Manager")
+	return get_profile_stats()
+
+
+@frappe.whitelist()
+def reset_profiling_stats() -> None:
+	frappe.only_for("System Manager")
+	clear_profile_stats()
+
+
 @frappe.whitelist()
 def fetch_subscription_data() -> Dict:
 	"""
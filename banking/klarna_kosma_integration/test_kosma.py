@@ -1,4 +1,6 @@
 import json
+from unittest.mock import patch
+
 import frappe
 
 from frappe.client import get_count
@@ -233,6 +235,28 @@ class TestKosma(FrappeTestCase):
 		# check if consent start date is start of fiscal year
 		self.assertEqual(getdate(start_date), current_fiscal_year.year_start_date)
 
+	def test_paginated_consent_sync(self):
+		"""Test if all pages are synced with rotating consent tokens (fake admin app)."""
+		from banking.demo_responses.benchmark_sync import benchmark_consent_sync
+		from banking.demo_responses.fake_admin_server import FakeAdminConfig
+
+		config = FakeAdminConfig(
+			transactions_per_account=25, page_size=10, validate_tokens=True
+		)
+		frappe.db.savepoint(save_point="banking_consent_sync_before_test")
+		try:
+			# the sync commits every page, keep everything in the test's transaction
+			with patch.object(frappe.db, "commit"):
+				result = benchmark_consent_sync(
+					config, "Bolt Trades", accounts=1, cleanup=False, commit=False
+				)
+		finally:
+			frappe.db.rollback(save_point="banking_consent_sync_before_test")
+
+		self.assertEqual(result["requests"], 3)
+		self.assertEqual(result["transactions_fetched"], 25)
+		self.assertEqual(result["transactions_inserted"], 25)
+
 
 def get_formatted_consent():
 	return {
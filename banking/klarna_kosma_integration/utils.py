@@ -17,6 +17,9 @@ from frappe.utils import (
 	nowdate,
 )
 
+from banking.fingerprint import DuplicateFilter, get_transaction_fingerprint
+from banking.party_index import set_party
+
 if TYPE_CHECKING:
 	from frappe.model.document import Document
 
@@ -85,19 +88,27 @@ def get_consent_data(bank_name: str, company: str):
 	return bank_consent.consent_id, bank_consent.get_password("consent_token")
 
 
-def exchange_consent_token(response: Dict, bank: str, company: str) -> str:
+def exchange_consent_token(response: Dict) -> Optional[str]:
+	"""Return the rotated consent token from an admin response, if any.
+
+	The token is not stored here. Use `persist_consent_token` once the data
+	fetched with it has been written, so that both are committed together.
+	"""
 	if (not response) or (not isinstance(response, dict)):
-		return
+		return None
+
+	return response.get("consent_token")
 
-	new_consent_token = response.get("consent_token")
 
-	if new_consent_token:
-		bank_consent = frappe.get_doc("Bank Consent", {"bank": bank, "company": company})
-		bank_consent.consent_token = new_consent_token
-		bank_consent.save()
-		frappe.db.commit()
+def persist_consent_token(bank: str, company: str, consent_token: str) -> None:
+	"""Store the consent token with a single update of the encrypted value."""
+	from frappe.utils.password import set_encrypted_password
 
-	return new_consent_token
+	if not consent_token:
+		return
+
+	consent_name = frappe.db.get_value("Bank Consent", {"bank": bank, "company": company})
+	set_encrypted_password("Bank Consent", consent_name, consent_token, "consent_token")
 
 
 def create_session_doc(session_data: Dict, flow_data: Dict) -> "Document":
@@ -240,12 +251,21 @@ def create_bank_transactions(
 ) -> None:
 	last_sync_date = None
 	try:
-		for transaction in reversed(transactions):
-			transaction_created = new_bank_transaction(account, transaction)
+		bank_transactions = [
+			(transaction, bank_transaction)
+			for transaction in reversed(transactions)
+			if (bank_transaction := make_bank_transaction(account, transaction))
+		]
+		duplicates = DuplicateFilter(account, [row[1] for row in bank_transactions])
+
+		for transaction, bank_transaction in bank_transactions:
+			if duplicates.is_duplicate(bank_transaction):
+				continue
 
-			if not transaction_created or via_flow_api:
+			insert_bank_transaction(bank_transaction)
+
+			if via_flow_api:
 				# Don't set last integration date if via Flow API (one time action with arbitrary time period)
-				# or if transaction was not inserted
 				continue
 
 			last_sync_date = transaction.get("value_date") or transaction.get("date")
@@ -259,6 +279,18 @@ def create_bank_transactions(
 
 
 def new_bank_transaction(account: str, transaction: Dict) -> bool:
+	bank_transaction = make_bank_transaction(account, transaction)
+	if not bank_transaction or DuplicateFilter(account, [bank_transaction]).is_duplicate(
+		bank_transaction
+	):
+		return False
+
+	insert_bank_transaction(bank_transaction)
+	return True
+
+
+def make_bank_transaction(account: str, transaction: Dict) -> Optional["Document"]:
+	"""Return a new, unsaved Bank Transaction for a Kosma transaction."""
 	amount_data = transaction.get("amount", {})
 	amount = (
 		amount_data.get("amount", 0) / 100
@@ -273,12 +305,11 @@ def new_bank_transaction(account: str, transaction: Dict) -> bool:
 	if not transaction_id and transaction.get("state") == "PENDING":
 		# Dont insert pending transactions. transaction_id is absent only for Pending state
 		# Ref: https://docs.openbanking.klarna.com/xs2a/objects/transaction.html
-		return False
-
-	if frappe.db.exists("Bank Transaction", {"transaction_id": transaction_id}):
-		return False
+		return None
 
-	new_transaction = frappe.get_doc(
+	counter_party = transaction.get("counter_party", {})
+	end_to_end_reference = transaction.get("bank_references", {}).get("end_to_end")
+	bank_transaction = frappe.get_doc(
 		{
 			"doctype": "Bank Transaction",
 			"date": getdate(transaction.get("value_date") or transaction.get("date")),
@@ -287,18 +318,22 @@ def new_bank_transaction(account: str, transaction: Dict) -> bool:
 			"withdrawal": debit,
 			"currency": amount_data.get("currency"),
 			"transaction_id": transaction_id,
-			"reference_number": transaction.get("bank_references", {}).get("end_to_end"),
+			"reference_number": end_to_end_reference,
 			"description": transaction.get("reference"),
-			"bank_party_name": transaction.get("counter_party", {}).get("holder_name"),
-			"bank_party_iban": transaction.get("counter_party", {}).get("iban"),
-			"bank_party_account_number": transaction.get("counter_party", {}).get(
-				"account_number"
-			),
+			"bank_party_name": counter_party.get("holder_name"),
+			"bank_party_iban": counter_party.get("iban"),
+			"bank_party_account_number": counter_party.get("account_number"),
 		}
 	)
-	new_transaction.insert()
-	new_transaction.submit()
-	return True
+	# same values as for existing transactions, see `set_bank_transaction_fingerprints`
+	bank_transaction.fingerprint = get_transaction_fingerprint(bank_transaction)
+	return bank_transaction
+
+
+def insert_bank_transaction(bank_transaction: "Document") -> None:
+	set_party(bank_transaction)
+	bank_transaction.insert()
+	bank_transaction.submit()
 
 
 def get_from_to_date(from_date: Optional[str] = None, to_date: Optional[str] = None):
@@ -0,0 +1,66 @@
+# Copyright (c) 2024, ALYF GmbH and contributors
+# For license information, please see license.txt
+"""Request- and job-scoped cache of master data used while reconciling.
+
+Values live in `frappe.local`, which is reset for every request and background
+job. Updating one of the cached records clears its entry (see `doc_events` in
+hooks.py), so a job that changes master data never reads a stale value.
+"""
+import frappe
+from frappe.utils import getdate
+
+CACHED_FIELDS = {
+	"Bank Account": [
+		"account",
+		"company",
+		"amount_tolerance_type",
+		"amount_tolerance",
+		"write_off_account",
+	],
+	"Account": ["company", "account_currency", "account_type"],
+	"Currency": ["symbol"],
+}
+PERIOD_CLOSING = "Period Closing Voucher"
+
+
+def get_cache() -> dict:
+	if not hasattr(frappe.local, "banking_metadata_cache"):
+		frappe.local.banking_metadata_cache = {}
+	return frappe.local.banking_metadata_cache
+
+
+def get_cached_values(doctype: str, name: str) -> frappe._dict:
+	"""Return the cached fields of a Bank Account, Account or Currency."""
+	cache = get_cache()
+	key = (doctype, name)
+	if key not in cache:
+		cache[key] = frappe.db.get_value(
+			doctype, name, CACHED_FIELDS[doctype], as_dict=True
+		) or frappe._dict()
+
+	return cache[key]
+
+
+def get_latest_period_closing_date(company: str):
+	cache = get_cache()
+	key = (PERIOD_CLOSING, company)
+	if key not in cache:
+		period_end_date = frappe.db.get_value(
+			PERIOD_CLOSING,
+			{"company": company, "docstatus": 1},
+			"period_end_date",
+			order_by="period_end_date desc",
+		)
+		cache[key] = getdate(period_end_date) if period_end_date else None
+
+	return cache[key]
+
+
+def clear_cache(doc, event=None):
+	"""Drop the cached entry of the updated document."""
+	if doc.doctype == PERIOD_CLOSING:
+		key = (PERIOD_CLOSING, doc.company)
+	else:
+		key = (doc.doctype, doc.name)
+
+	get_cache().pop(key, None)
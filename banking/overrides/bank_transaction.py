@@ -1,7 +1,7 @@
 import frappe
 from frappe import _
-from frappe.core.utils import find
 from frappe.model.document import Document
+from frappe.model.meta import get_field_precision
 from frappe.utils import flt, getdate
 
 from erpnext import get_default_cost_center
@@ -11,42 +11,79 @@ from erpnext.accounts.doctype.payment_entry.payment_entry import (
 )
 from erpnext.accounts.doctype.bank_transaction.bank_transaction import BankTransaction
 
+from banking.klarna_kosma_integration.doctype.bank_reconciliation_tool_beta.utils import (
+	get_amount_tolerance,
+)
+from banking.metadata_cache import get_cached_values, get_latest_period_closing_date
+from banking.profiling import profile, set_account
+
 from typing import Callable
 
 DOCTYPE, DOCNAME, AMOUNT, PARTY = 0, 1, 2, 3
+# Unpaid vouchers whose difference to the bank amount can be written off
+WRITE_OFF_DOCTYPES = ("Sales Invoice", "Purchase Invoice")
 
 
 class CustomBankTransaction(BankTransaction):
-	def add_payment_entries(self, vouchers: list, reconcile_multi_party: bool = False):
-		"Add the vouchers with zero allocation. Save() will perform the allocations and clearance"
+	# (payment_document, payment_entry) of all payment_entries rows, built lazily
+	_payment_entry_index = None
+
+	def append(self, key, value=None):
+		row = super().append(key, value)
+		if key == "payment_entries" and self._payment_entry_index is not None:
+			self._payment_entry_index.add((row.payment_document, row.payment_entry))
+		return row
+
+	def remove(self, doc):
+		super().remove(doc)
+		if doc.parentfield == "payment_entries":
+			self._payment_entry_index = None
+
+	def set(self, key, value, *args, **kwargs):
+		if key == "payment_entries":
+			self._payment_entry_index = None
+		return super().set(key, value, *args, **kwargs)
+
+	def get_payment_entry_index(self) -> set[tuple[str, str]]:
+		if self._payment_entry_index is None:
+			self._payment_entry_index = {
+				(row.payment_document, row.payment_entry) for row in self.payment_entries
+			}
+		return self._payment_entry_index
+
+	@profile("Bank Transaction.add_payment_entries")
+	def add_payment_entries(
+		self,
+		vouchers: list,
+		reconcile_multi_party: bool = False,
+		write_off: frappe._dict | None = None,
+	):
+		"""
+		Add the vouchers with zero allocation. The caller must allocate and save
+		the Bank Transaction once (see `reconcile_transaction`).
+
+		:param write_off: difference to unpaid invoices to write off, see `get_write_off`
+		"""
+		set_account(self.bank_account)
 		if self.unallocated_amount <= 0.0:
 			frappe.throw(
 				frappe._("Bank Transaction {0} is already fully reconciled").format(self.name)
 			)
 
-		pe_length_before = len(self.payment_entries)
 		unpaid_docs = ["Sales Invoice", "Purchase Invoice", "Expense Claim"]
 
 		# Vouchers can either all be paid or all be unpaid
 		if any(voucher["payment_doctype"] in unpaid_docs for voucher in vouchers):
-			self.reconcile_invoices(vouchers, reconcile_multi_party)
+			self.reconcile_invoices(vouchers, reconcile_multi_party, write_off)
 		else:
 			self.reconcile_paid_vouchers(vouchers)
 
-		if len(self.payment_entries) != pe_length_before:
-			self.save()  # runs on_update_after_submit
-
 	def validate_period_closing(self):
 		"""
 		Check if the Bank Transaction date is after the latest period closing date.
 		We cannot make PEs against this transaction's date (before period closing date).
 		"""
-		latest_period_close_date = frappe.db.get_value(
-			"Period Closing Voucher",
-			{"company": self.company, "docstatus": 1},
-			"period_end_date",
-			order_by="period_end_date desc",
-		)
+		latest_period_close_date = get_latest_period_closing_date(self.company)
 		if latest_period_close_date and getdate(self.date) <= getdate(
 			latest_period_close_date
 		):
@@ -72,6 +109,7 @@ class CustomBankTransaction(BankTransaction):
 		# Check if the invoice is unpaid
 		return flt(frappe.db.get_value(payment_doctype, payment_name, "outstanding_amount"))
 
+	@profile("Bank Transaction.reconcile_paid_vouchers")
 	def reconcile_paid_vouchers(self, vouchers):
 		"""Reconcile paid vouchers with the Bank Transaction."""
 		for voucher in vouchers:
@@ -81,15 +119,30 @@ class CustomBankTransaction(BankTransaction):
 
 			self.add_to_payment_entry(voucher["payment_doctype"], voucher["payment_name"])
 
-	def reconcile_invoices(self, vouchers: list, reconcile_multi_party: bool = False):
+	@profile("Bank Transaction.reconcile_invoices")
+	def reconcile_invoices(
+		self,
+		vouchers: list,
+		reconcile_multi_party: bool = False,
+		write_off: frappe._dict | None = None,
+	):
 		"""Reconcile unpaid invoices with the Bank Transaction."""
+		vouchers = [
+			voucher
+			for voucher in vouchers
+			if not self.is_duplicate_reference(
+				voucher["payment_doctype"], voucher["payment_name"]
+			)
+		]
+		invoice_data = get_invoice_data(
+			[(voucher["payment_doctype"], voucher["payment_name"]) for voucher in vouchers]
+		)
+
 		invoices_to_bill = []
 		for voucher in vouchers:
 			voucher_type, voucher_name = voucher["payment_doctype"], voucher["payment_name"]
-			if self.is_duplicate_reference(voucher_type, voucher_name):
-				continue
-
-			outstanding_amount = get_outstanding_amount(voucher_type, voucher_name)
+			invoice = invoice_data.get((voucher_type, voucher_name))
+			outstanding_amount = invoice.outstanding_amount if invoice else 0.0
 			if (
 				voucher_type
 				not in (
@@ -110,22 +163,30 @@ class CustomBankTransaction(BankTransaction):
 		if invoices_to_bill:
 			self.validate_period_closing()
 			if reconcile_multi_party:
-				payment_name = self.make_jv_against_invoices(invoices_to_bill)
+				payment_name = self.make_jv_against_invoices(
+					invoices_to_bill, invoice_data, write_off
+				)
 			else:
-				payment_name = self.make_pe_against_invoices(invoices_to_bill)
+				payment_name = self.make_pe_against_invoices(
+					invoices_to_bill, invoice_data, write_off
+				)
 
 			self.add_to_payment_entry(
 				"Journal Entry" if reconcile_multi_party else "Payment Entry", payment_name
 			)
 
-	def make_jv_against_invoices(self, invoices_to_bill: list) -> str:
+	@profile("Bank Transaction.make_jv_against_invoices")
+	def make_jv_against_invoices(
+		self,
+		invoices_to_bill: list,
+		invoice_data: dict | None = None,
+		write_off: frappe._dict | None = None,
+	) -> str:
 		"""Make Journal Entry against multiple invoices."""
 
 		def _attach_invoice(row: dict, journal_entry: "Document") -> None:
-			second_account = get_debtor_creditor_account(row)
-			second_account_currency = frappe.db.get_value(
-				"Account", second_account, "account_currency"
-			)
+			second_account = accounts.get((row.voucher_type, row.voucher_no))
+			second_account_currency = account_currencies.get(second_account)
 			if second_account_currency != company_currency:
 				frappe.throw(
 					_(
@@ -140,7 +201,7 @@ class CustomBankTransaction(BankTransaction):
 					"debit_in_account_currency": row.allocated_amount if self.withdrawal > 0 else 0.0,
 					"party_type": row.get("party_type"),
 					"party": row.get("party"),
-					"cost_center": get_default_cost_center(company),
+					"cost_center": cost_center,
 					"reference_type": row.voucher_type,
 					"reference_name": row.voucher_no,
 				},
@@ -148,10 +209,13 @@ class CustomBankTransaction(BankTransaction):
 
 		self.validate_invoices_to_bill(invoices_to_bill, allow_multi_party=True)
 
-		company_account = frappe.get_value("Bank Account", self.bank_account, "account")
-		company, company_currency = frappe.get_value(
-			"Account", company_account, ["company", "account_currency"]
+		company_account = get_cached_values("Bank Account", self.bank_account).account
+		company_account_data = get_cached_values("Account", company_account)
+		company, company_currency = (
+			company_account_data.company,
+			company_account_data.account_currency,
 		)
+		cost_center = get_default_cost_center(company)
 
 		journal_entry = frappe.new_doc("Journal Entry")
 		journal_entry.voucher_type = "Bank Entry"
@@ -162,11 +226,34 @@ class CustomBankTransaction(BankTransaction):
 		journal_entry.title = self.name
 
 		invoices = split_invoices_based_on_payment_terms(
-			self.prepare_invoices_to_split(invoices_to_bill), self.company
+			self.prepare_invoices_to_split(invoices_to_bill, invoice_data), self.company
+		)
+		accounts = get_debtor_creditor_accounts(invoices)
+		account_currencies = dict(
+			frappe.get_all(
+				"Account",
+				filters={"name": ("in", set(accounts.values()))},
+				fields=["name", "account_currency"],
+				as_list=True,
+			)
+		)
+		write_off_amount = write_off.amount if write_off else 0.0
+		self.adjust_and_allocate_invoices(
+			invoices, journal_entry, action=_attach_invoice, write_off_amount=write_off_amount
 		)
-		self.adjust_and_allocate_invoices(invoices, journal_entry, action=_attach_invoice)
 
-		total_allocated_amount = sum(row.allocated_amount for row in invoices)
+		total_allocated_amount = sum(row.allocated_amount for row in invoices) - write_off_amount
+		if write_off_amount:
+			journal_entry.append(
+				"accounts",
+				{
+					"account": write_off.account,
+					"credit_in_account_currency": write_off_amount if self.withdrawal > 0 else 0.0,
+					"debit_in_account_currency": write_off_amount if self.deposit > 0 else 0.0,
+					"cost_center": write_off.cost_center or cost_center,
+				},
+			)
+
 		journal_entry.append(
 			"accounts",
 			{
@@ -176,14 +263,20 @@ class CustomBankTransaction(BankTransaction):
 					total_allocated_amount if self.withdrawal > 0 else 0.0
 				),
 				"debit_in_account_currency": total_allocated_amount if self.deposit > 0 else 0.0,
-				"cost_center": get_default_cost_center(company),
+				"cost_center": cost_center,
 			},
 		)
 
 		journal_entry.submit()
 		return journal_entry.name
 
-	def make_pe_against_invoices(self, invoices_to_bill: list) -> str:
+	@profile("Bank Transaction.make_pe_against_invoices")
+	def make_pe_against_invoices(
+		self,
+		invoices_to_bill: list,
+		invoice_data: dict | None = None,
+		write_off: frappe._dict | None = None,
+	) -> str:
 		"""Make Payment Entry against multiple invoices."""
 
 		def _attach_invoice(row: dict, payment_entry: "Document") -> None:
@@ -193,7 +286,7 @@ class CustomBankTransaction(BankTransaction):
 
 		self.validate_invoices_to_bill(invoices_to_bill)
 
-		bank_account = frappe.db.get_value("Bank Account", self.bank_account, "account")
+		bank_account = get_cached_values("Bank Account", self.bank_account).account
 		first_invoice = invoices_to_bill[0]
 		if first_invoice[DOCTYPE] == "Expense Claim":
 			from hrms.overrides.employee_payment_entry import get_payment_entry_for_employee
@@ -222,52 +315,66 @@ class CustomBankTransaction(BankTransaction):
 		# clear references to allocate invoices correctly with splits
 		payment_entry.references = []
 		invoices = split_invoices_based_on_payment_terms(
-			self.prepare_invoices_to_split(invoices_to_bill), self.company
+			self.prepare_invoices_to_split(invoices_to_bill, invoice_data), self.company
+		)
+		write_off_amount = write_off.amount if write_off else 0.0
+		self.adjust_and_allocate_invoices(
+			invoices, payment_entry, action=_attach_invoice, write_off_amount=write_off_amount
 		)
-		self.adjust_and_allocate_invoices(invoices, payment_entry, action=_attach_invoice)
 
 		payment_entry.paid_amount = abs(
 			sum(row.allocated_amount for row in payment_entry.references)
 		)  # should not be negative
+		if write_off_amount:
+			# the party paid less than allocated, e.g. because of bank fees or a discount
+			payment_entry.paid_amount -= write_off_amount
+			payment_entry.append(
+				"deductions",
+				{
+					"account": write_off.account,
+					"cost_center": write_off.cost_center,
+					"amount": write_off_amount
+					if payment_entry.payment_type == "Receive"
+					else -write_off_amount,
+				},
+			)
 		payment_entry.submit()
 		return payment_entry.name
 
-	def prepare_invoices_to_split(self, invoices):
+	def prepare_invoices_to_split(self, invoices, invoice_data: dict | None = None):
+		if invoice_data is None:
+			invoice_data = get_invoice_data(
+				[(invoice[DOCTYPE], invoice[DOCNAME]) for invoice in invoices]
+			)
+
 		invoices_to_split = []
 		for invoice in invoices:
-			is_expense_claim = invoice[DOCTYPE] == "Expense Claim"
-			total_field = "grand_total" if is_expense_claim else "base_grand_total"
-			due_date_field = "posting_date" if is_expense_claim else "due_date"
-
-			invoice_data = frappe.db.get_value(
-				invoice[DOCTYPE],
-				invoice[DOCNAME],
-				[
-					"name as voucher_no",
-					"posting_date",
-					f"{total_field} as invoice_amount",
-					f"{due_date_field} as due_date",
-				],
-				as_dict=True,
+			data = invoice_data[(invoice[DOCTYPE], invoice[DOCNAME])]
+			row = frappe._dict(
+				voucher_no=data.name,
+				posting_date=data.posting_date,
+				invoice_amount=data.invoice_amount,
+				due_date=data.due_date,
 			)
-			invoice_data["outstanding_amount"] = invoice[AMOUNT]
-			invoice_data["voucher_type"] = invoice[DOCTYPE]
-			invoice_data["party"] = invoice[PARTY]
-			invoice_data["party_type"] = (
+			row["outstanding_amount"] = invoice[AMOUNT]
+			row["voucher_type"] = invoice[DOCTYPE]
+			row["party"] = invoice[PARTY]
+			row["party_type"] = (
 				"Customer"
 				if invoice[DOCTYPE] == "Sales Invoice"
 				else "Supplier"
 				if invoice[DOCTYPE] == "Purchase Invoice"
 				else "Employee"
 			)
-			invoices_to_split.append(invoice_data)
+			invoices_to_split.append(row)
 
 		return invoices_to_split
 
-	def get_positive_and_negative_sums(self, invoices):
+	def get_positive_and_negative_sums(self, invoices, write_off_amount: float = 0.0):
 		"""
 		Calculate a permissible positive and negative upper limit sum for the allocation.
-		This will ensure that the allocated positive and negative amounts add up to the unallocated amount.
+		This will ensure that the allocated positive and negative amounts add up to the unallocated amount
+		plus the amount to write off.
 		"""
 		sum_positive = (
 			sum(
@@ -288,7 +395,7 @@ class CustomBankTransaction(BankTransaction):
 		self.validate_sums(sum_positive, sum_negative, invoices)
 
 		# Adjust the positive sum (trim it) if overallocated
-		allocation = self.unallocated_amount - (sum_positive - sum_negative)
+		allocation = self.unallocated_amount + write_off_amount - (sum_positive - sum_negative)
 		if allocation < 0:
 			sum_positive += allocation
 
@@ -299,13 +406,16 @@ class CustomBankTransaction(BankTransaction):
 		invoices: list,
 		payment_voucher: "Document",
 		action: Callable[[dict, Document], None],
+		write_off_amount: float = 0.0,
 	) -> None:
 		"""
 		Adjust and allocate the invoicees to the payment voucher based on
-		the unallocated amount.
+		the unallocated amount (plus the amount to write off).
 		The `payment_voucher` object is mutated by param:action.
 		"""
-		sum_postive, sum_negative = self.get_positive_and_negative_sums(invoices)
+		sum_postive, sum_negative = self.get_positive_and_negative_sums(
+			invoices, write_off_amount
+		)
 		for row in invoices:
 			if row.outstanding_amount > 0:
 				if sum_postive <= 0:
@@ -362,49 +472,170 @@ class CustomBankTransaction(BankTransaction):
 				frappe._("Cannot make Reconciliation Payment Entry against multiple parties")
 			)
 
+	def get_write_off(self, vouchers: list) -> frappe._dict | None:
+		"""
+		Return the difference to write off if the unpaid invoices exceed the
+		unallocated amount by no more than the amount tolerance of the Bank Account.
+		"""
+		bank_account = get_cached_values("Bank Account", self.bank_account)
+		invoices = [
+			(voucher["payment_doctype"], voucher["payment_name"])
+			for voucher in vouchers
+			if not self.is_duplicate_reference(voucher["payment_doctype"], voucher["payment_name"])
+		]
+		if (
+			not bank_account.write_off_account
+			or not invoices
+			or any(doctype not in WRITE_OFF_DOCTYPES for doctype, _name in invoices)
+		):
+			return None
+
+		invoice_data = get_invoice_data(invoices)
+		if len(invoice_data) != len(set(invoices)) or any(
+			invoice.currency != self.currency for invoice in invoice_data.values()
+		):
+			return None
+
+		outstanding_amount = sum(invoice.outstanding_amount for invoice in invoice_data.values())
+		difference = flt(
+			outstanding_amount - self.unallocated_amount, self.precision("unallocated_amount")
+		)
+		if difference <= 0 or difference > get_amount_tolerance(
+			self.bank_account, self.unallocated_amount
+		):
+			return None
+
+		return frappe._dict(
+			amount=difference,
+			account=bank_account.write_off_account,
+			cost_center=get_default_cost_center(self.company),
+		)
+
 	def is_duplicate_reference(self, voucher_type, voucher_name):
 		"""Check if the reference is already added to the Bank Transaction."""
-		return find(
-			self.payment_entries,
-			lambda x: x.payment_document == voucher_type and x.payment_entry == voucher_name,
-		)
+		return (voucher_type, voucher_name) in self.get_payment_entry_index()
+
+	def validate_duplicate_references(self):
+		"""Make sure the same voucher is not allocated twice within the same Bank Transaction"""
+		# every row adds its reference to the index, duplicates don't grow it
+		if len(self.get_payment_entry_index()) == len(self.payment_entries):
+			return
+
+		references = set()
+		for row in self.payment_entries:
+			reference = (row.payment_document, row.payment_entry)
+			if reference in references:
+				frappe.throw(
+					_("{0} {1} is allocated twice in this Bank Transaction").format(
+						row.payment_document, row.payment_entry
+					)
+				)
+			references.add(reference)
 
 
 def get_outstanding_amount(payment_doctype, payment_name) -> float:
-	if payment_doctype not in ("Sales Invoice", "Purchase Invoice", "Expense Claim"):
-		return 0.0
-
-	if payment_doctype == "Expense Claim":
-		ec = frappe.get_doc(payment_doctype, payment_name)
-		return flt(
-			ec.total_sanctioned_amount - ec.total_amount_reimbursed,
-			ec.precision("total_sanctioned_amount"),
-		)
+	invoice = get_invoice_data([(payment_doctype, payment_name)]).get(
+		(payment_doctype, payment_name)
+	)
+	return invoice.outstanding_amount if invoice else 0.0
+
+
+def get_invoice_data(vouchers: list[tuple[str, str]]) -> dict[tuple[str, str], dict]:
+	"""
+	Return outstanding amount, total, posting and due date of unpaid vouchers.
+	Runs one query per doctype. Keyed by (doctype, name).
+	"""
+	names_by_doctype = {}
+	for doctype, name in vouchers:
+		if doctype in ("Sales Invoice", "Purchase Invoice", "Expense Claim"):
+			names_by_doctype.setdefault(doctype, set()).add(name)
+
+	invoice_data = {}
+	for doctype, names in names_by_doctype.items():
+		if doctype == "Expense Claim":
+			fields = [
+				"name",
+				"posting_date",
+				"grand_total as invoice_amount",
+				"posting_date as due_date",
+				"total_sanctioned_amount",
+				"total_amount_reimbursed",
+			]
+			precision_field = "total_sanctioned_amount"
+		else:
+			fields = [
+				"name",
+				"posting_date",
+				"base_grand_total as invoice_amount",
+				"due_date",
+				"outstanding_amount",
+				"currency",
+			]
+			precision_field = "outstanding_amount"
+
+		df = frappe.get_meta(doctype).get_field(precision_field)
+		precisions = {}
+		for row in frappe.get_all(doctype, filters={"name": ("in", names)}, fields=fields):
+			currency = row.get("currency")
+			if currency not in precisions:
+				precisions[currency] = get_field_precision(df, currency=currency)
+
+			if doctype == "Expense Claim":
+				row.outstanding_amount = row.pop("total_sanctioned_amount") - row.pop(
+					"total_amount_reimbursed"
+				)
+
+			row.outstanding_amount = flt(row.outstanding_amount, precisions[currency])
+			invoice_data[(doctype, row.name)] = row
 
-	invoice = frappe.get_doc(payment_doctype, payment_name)
-	return flt(invoice.outstanding_amount, invoice.precision("outstanding_amount"))
+	return invoice_data
 
 
 def get_debtor_creditor_account(invoice: dict) -> str | None:
 	"""Get the debtor or creditor (intermediate) account based on the invoice type."""
-	if invoice.get("voucher_type") == "Sales Invoice":
-		account_field = "debit_to"
-	elif invoice.get("voucher_type") == "Purchase Invoice":
-		account_field = "credit_to"
-	else:
-		account_field = "payable_account"
-	return frappe.db.get_value(
-		invoice.get("voucher_type"), invoice.get("voucher_no"), account_field
+	return get_debtor_creditor_accounts([invoice]).get(
+		(invoice.get("voucher_type"), invoice.get("voucher_no"))
 	)
 
 
+def get_debtor_creditor_accounts(invoices: list[dict]) -> dict[tuple[str, str], str]:
+	"""
+	Get the debtor or creditor (intermediate) accounts of invoices, with one query per doctype.
+	Keyed by (voucher_type, voucher_no).
+	"""
+	names_by_doctype = {}
+	for invoice in invoices:
+		names_by_doctype.setdefault(invoice.get("voucher_type"), set()).add(
+			invoice.get("voucher_no")
+		)
+
+	accounts = {}
+	for doctype, names in names_by_doctype.items():
+		if doctype == "Sales Invoice":
+			account_field = "debit_to"
+		elif doctype == "Purchase Invoice":
+			account_field = "credit_to"
+		else:
+			account_field = "payable_account"
+
+		for name, account in frappe.get_all(
+			doctype,
+			filters={"name": ("in", names)},
+			fields=["name", account_field],
+			as_list=True,
+		):
+			accounts[(doctype, name)] = account
+
+	return accounts
+
+
 def on_update_after_submit(doc, event):
 	"""Validate if the Bank Transaction is over-allocated."""
 	to_allocate = flt(doc.withdrawal or doc.deposit)
 	for entry in doc.payment_entries:
 		to_allocate -= flt(entry.allocated_amount)
 		if round(to_allocate, 2) < 0.0:
-			symbol = frappe.db.get_value("Currency", doc.currency, "symbol")
+			symbol = get_cached_values("Currency", doc.currency).symbol
 			frappe.throw(
 				msg=_("The Bank Transaction is over-allocated by {0} at row {1}.").format(
 					frappe.bold(f"{symbol} {str(abs(to_allocate))}"), frappe.bold(entry.idx)
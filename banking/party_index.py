@@ -0,0 +1,190 @@
+# Copyright (c) 2024, ALYF GmbH and contributors
+# For license information, please see license.txt
+"""Index of counterparty IBANs to the Customer or Supplier they belong to.
+
+The index is built from the Bank Accounts of customers and suppliers and from
+past reconciliations. It is kept in a Redis hash with one field per IBAN, so
+that all workers share it and reconciliations add to it in O(1), and in
+`frappe.local`, so that resolving the parties of a whole batch of imported
+transactions does not need any query once it has been loaded.
+"""
+import pickle
+
+import frappe
+
+PARTY_INDEX_CACHE_KEY = "banking_party_index"
+# Marks a built index, which can be empty
+BUILT_FIELD = "__built__"
+PARTY_TYPES = ("Customer", "Supplier")
+AMBIGUOUS = ()
+
+
+def normalize_iban(iban: str | None) -> str | None:
+	return "".join(iban.split()).upper() if iban else None
+
+
+def get_party_index() -> dict:
+	"""Return {IBAN: (party_type, party)}. Ambiguous IBANs map to an empty tuple."""
+	if not hasattr(frappe.local, "banking_party_index"):
+		index = {
+			field.decode(): value
+			for field, value in frappe.cache.hgetall(PARTY_INDEX_CACHE_KEY).items()
+		}
+		if index.pop(BUILT_FIELD, None) is None:
+			index = build_party_index()
+			store_party_index(index)
+
+		frappe.local.banking_party_index = index
+	return frappe.local.banking_party_index
+
+
+def store_party_index(index: dict) -> None:
+	"""Replace the index in Redis by a hash with one field per IBAN."""
+	key = frappe.cache.make_key(PARTY_INDEX_CACHE_KEY)
+	mapping = {iban: pickle.dumps(party) for iban, party in index.items()}
+	mapping[BUILT_FIELD] = pickle.dumps(True)
+
+	pipeline = frappe.cache.pipeline()
+	pipeline.delete(key)
+	pipeline.hset(key, mapping=mapping)
+	pipeline.execute()
+
+
+def build_party_index() -> dict:
+	learned = {}
+	for iban, party_type, party in get_reconciled_parties():
+		iban = normalize_iban(iban)
+		if iban:
+			# later reconciliations win over earlier ones
+			learned[iban] = (party_type, party)
+
+	index = {}
+	for iban, party_type, party in frappe.get_all(
+		"Bank Account",
+		filters={
+			"party_type": ("in", PARTY_TYPES),
+			"party": ("is", "set"),
+			"iban": ("is", "set"),
+			"disabled": 0,
+		},
+		fields=["iban", "party_type", "party"],
+		as_list=True,
+	):
+		iban = normalize_iban(iban)
+		if index.get(iban, (party_type, party)) != (party_type, party):
+			# the same IBAN is shared by several parties, don't guess
+			index[iban] = AMBIGUOUS
+		else:
+			index[iban] = (party_type, party)
+
+	# Bank Accounts are maintained by the user, they take precedence
+	return learned | index
+
+
+def get_reconciled_parties() -> list[tuple[str, str, str]]:
+	"""Return (IBAN, party_type, party) of reconciled Bank Transactions, oldest first.
+
+	The party is either set on the Bank Transaction itself or on a Payment Entry
+	it was reconciled with.
+	"""
+	bt = frappe.qb.DocType("Bank Transaction")
+	btp = frappe.qb.DocType("Bank Transaction Payments")
+	pe = frappe.qb.DocType("Payment Entry")
+
+	from_transactions = (
+		frappe.qb.from_(bt)
+		.select(bt.bank_party_iban, bt.party_type, bt.party, bt.date)
+		.where(bt.docstatus == 1)
+		.where(bt.bank_party_iban.isnotnull())
+		.where(bt.party_type.isin(PARTY_TYPES))
+		.where(bt.party.isnotnull())
+	)
+	from_payments = (
+		frappe.qb.from_(bt)
+		.join(btp)
+		.on(btp.parent == bt.name)
+		.join(pe)
+		.on((btp.payment_document == "Payment Entry") & (btp.payment_entry == pe.name))
+		.select(bt.bank_party_iban, pe.party_type, pe.party, bt.date)
+		.where(bt.docstatus == 1)
+		.where(bt.bank_party_iban.isnotnull())
+		.where(pe.docstatus == 1)
+		.where(pe.party_type.isin(PARTY_TYPES))
+	)
+
+	rows = from_payments.run() + from_transactions.run()
+	rows = sorted(rows, key=lambda row: row[3])
+	return [row[:3] for row in rows]
+
+
+def resolve_party(iban: str | None) -> tuple[str, str] | None:
+	"""Return (party_type, party) for the IBAN, if it is known and unambiguous."""
+	iban = normalize_iban(iban)
+	if not iban:
+		return None
+
+	return get_party_index().get(iban) or None
+
+
+def set_party(doc) -> None:
+	"""Set the party of a new Bank Transaction from its counterparty IBAN."""
+	if doc.party_type and doc.party:
+		return
+
+	party = resolve_party(doc.bank_party_iban)
+	if party:
+		doc.party_type, doc.party = party
+
+
+def learn_party(doc, event=None) -> None:
+	"""Remember the party of a reconciled Bank Transaction for future imports."""
+	iban = normalize_iban(doc.bank_party_iban)
+	if not iban or frappe.cache.hexists(PARTY_INDEX_CACHE_KEY, iban):
+		return
+
+	if doc.party_type in PARTY_TYPES and doc.party:
+		party = (doc.party_type, doc.party)
+	else:
+		payment_entries = [
+			row.payment_entry
+			for row in doc.payment_entries
+			if row.payment_document == "Payment Entry"
+		]
+		if not payment_entries:
+			return
+
+		parties = set(
+			tuple(row)
+			for row in frappe.get_all(
+				"Payment Entry",
+				filters={
+					"name": ("in", payment_entries),
+					"party_type": ("in", PARTY_TYPES),
+				},
+				fields=["party_type", "party"],
+				as_list=True,
+			)
+		)
+		if len(parties) != 1:
+			return
+
+		party = parties.pop()
+
+	# Only add the IBAN to an index that has been built. Don't overwrite
+	# another request's party or one from a Bank Account.
+	if frappe.cache.hexists(PARTY_INDEX_CACHE_KEY, BUILT_FIELD) and frappe.cache.hsetnx(
+		frappe.cache.make_key(PARTY_INDEX_CACHE_KEY), iban, pickle.dumps(party)
+	):
+		index = getattr(frappe.local, "banking_party_index", None)
+		if index is not None:
+			index[iban] = party
+
+
+def clear_party_index(doc=None, event=None) -> None:
+	"""Drop the index after a Bank Account was changed. It is rebuilt on next use."""
+	if doc and doc.doctype == "Bank Account" and doc.is_company_account:
+		return
+
+	frappe.cache.delete_value(PARTY_INDEX_CACHE_KEY)
+	if hasattr(frappe.local, "banking_party_index"):
+		del frappe.local.banking_party_index
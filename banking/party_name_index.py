@@ -0,0 +1,288 @@
+# Copyright (c) 2024, ALYF GmbH and contributors
+# For license information, please see license.txt
+"""Fuzzy lookup of Customers, Suppliers and Employees by name.
+
+Bank statements spell the counterparty like "ACME GMBH & CO KG", while the
+Customer is called "Acme". Names are normalized (lowercase, without accents,
+punctuation and legal forms) and split into trigrams. The trigram index is kept
+in memory per site and worker. Changes to parties are applied incrementally:
+after the commit, the worker handling the change updates its index and appends
+the change to a list in Redis, other workers replay that list on their next
+lookup. Once the list gets long, it is started over and all workers rebuild
+their index.
+"""
+import json
+import math
+import re
+import unicodedata
+from collections import Counter, defaultdict
+
+import frappe
+
+PARTY_NAME_FIELDS = {
+	"Customer": "customer_name",
+	"Supplier": "supplier_name",
+	"Employee": "employee_name",
+}
+NAME_SIMILARITY_THRESHOLD = 0.6
+PARTY_CHANGES_CACHE_KEY = "banking_party_name_changes"
+
+PARTY_CHANGES_GENERATION_CACHE_KEY = "banking_party_name_changes_generation"
+# The list of changes is started over after this many changes
+MAX_PARTY_CHANGES = 10000
+
+LEGAL_FORMS = {
+	"ag",
+	"and",
+	"bv",
+	"co",
+	"corp",
+	"ev",
+	"gbr",
+	"gmbh",
+	"haftungsbeschrankt",
+	"inc",
+	"kg",
+	"kgaa",
+	"llc",
+	"ltd",
+	"limited",
+	"mbh",
+	"nv",
+	"ohg",
+	"plc",
+	"sa",
+	"sarl",
+	"se",
+	"ug",
+	"und",
+}
+NON_ALPHANUMERIC = re.compile(r"[^a-z0-9]+")
+
+# {site: PartyNameIndex}
+INDEXES = {}
+
+
+def normalize_name(name: str | None) -> str:
+	"""Return the lowercase words of a name, without accents and legal forms."""
+	if not name:
+		return ""
+
+	name = unicodedata.normalize("NFKD", name.lower().replace("ß", "ss"))
+	name = "".join(char for char in name if not unicodedata.combining(char))
+	words = NON_ALPHANUMERIC.sub(" ", name).split()
+	return " ".join(word for word in words if word not in LEGAL_FORMS)
+
+
+def get_trigrams(name: str | None) -> frozenset:
+	"""Return the trigrams of the normalized words, padded like PostgreSQL's pg_trgm."""
+	trigrams = set()
+	for word in normalize_name(name).split():
+		word = f"  {word} "
+		trigrams.update(word[i : i + 3] for i in range(len(word) - 2))
+
+	return frozenset(trigrams)
+
+
+class PartyNameIndex:
+	"""Inverted trigram index over party names."""
+
+	def __init__(self) -> None:
+		self.parties = {}  # {(party_type, party): trigrams}
+		self.postings = defaultdict(set)  # {trigram: {(party_type, party), ...}}
+		self.generation = 0
+		self.applied_changes = 0
+
+	def __len__(self) -> int:
+		return len(self.parties)
+
+	def add(self, party_type: str, party: str, title: str | None) -> None:
+		key = (party_type, party)
+		self.remove(party_type, party)
+		trigrams = get_trigrams(title or party)
+		if not trigrams:
+			return
+
+		self.parties[key] = trigrams
+		for trigram in trigrams:
+			self.postings[trigram].add(key)
+
+	def remove(self, party_type: str, party: str) -> None:
+		key = (party_type, party)
+		for trigram in self.parties.pop(key, ()):
+			postings = self.postings[trigram]
+			postings.discard(key)
+			if not postings:
+				del self.postings[trigram]
+
+	def search(
+		self,
+		name: str,
+		threshold: float = NAME_SIMILARITY_THRESHOLD,
+		party_types: tuple | None = None,
+		limit: int = 5,
+	) -> list[tuple[float, str, str]]:
+		"""Return [(similarity, party_type, party), ...] with the best match first.
+
+		Similarity is the Sørensen–Dice coefficient of the trigram sets.
+		"""
+		trigrams = get_trigrams(name)
+		if not trigrams:
+			return []
+
+		# A candidate needs this many shared trigrams to possibly reach the threshold,
+		# so it must share at least one of the `prefix_length` rarest trigrams.
+		# Only their postings are counted, frequent trigrams are expensive to count.
+		min_common = math.ceil(threshold * len(trigrams) / 2)
+		prefix_length = max(len(trigrams) - min_common + 1, 1)
+		rarest = sorted(trigrams, key=lambda trigram: len(self.postings.get(trigram, ())))
+		common = Counter()
+		for trigram in rarest[:prefix_length]:
+			common.update(self.postings.get(trigram, ()))
+
+		not_counted = len(trigrams) - prefix_length
+		result = []
+		for key, count in common.items():
+			if count + not_counted < min_common or (party_types and key[0] not in party_types):
+				continue
+
+			party_trigrams = self.parties[key]
+			shared = len(trigrams & party_trigrams)
+			similarity = 2 * shared / (len(trigrams) + len(party_trigrams))
+			if similarity >= threshold:
+				result.append((similarity, *key))
+
+		result.sort(reverse=True)
+		return result[:limit]
+
+	def apply_change(self, change: list) -> None:
+		action, party_type, party, title, old_party = change
+		if old_party:
+			self.remove(party_type, old_party)
+
+		if action == "remove":
+			self.remove(party_type, party)
+		else:
+			self.add(party_type, party, title)
+
+
+def get_party_name_index() -> PartyNameIndex:
+	"""Return this worker's index, up to date with the changes made by other workers."""
+	index = INDEXES.get(frappe.local.site)
+	if getattr(frappe.local, "banking_party_name_index_synced", False) and index:
+		return index
+
+	generation, changes = get_changes_state()
+	if not index or index.generation != generation or changes < index.applied_changes:
+		# first use, the list of changes was started over or the cache was cleared
+		index = build_party_name_index()
+		index.generation, index.applied_changes = generation, changes
+	elif changes > index.applied_changes:
+		for change in frappe.cache.lrange(
+			PARTY_CHANGES_CACHE_KEY, index.applied_changes, changes - 1
+		):
+			index.apply_change(json.loads(change))
+		index.applied_changes = changes
+
+	INDEXES[frappe.local.site] = index
+	frappe.local.banking_party_name_index_synced = True
+	return index
+
+
+def get_changes_state() -> tuple[int, int]:
+	"""Return the generation and length of the list of changes."""
+	pipeline = frappe.cache.pipeline()
+	pipeline.get(frappe.cache.make_key(PARTY_CHANGES_GENERATION_CACHE_KEY))
+	pipeline.llen(frappe.cache.make_key(PARTY_CHANGES_CACHE_KEY))
+	generation, changes = pipeline.execute()
+	return int(generation or 0), changes
+
+
+def build_party_name_index() -> PartyNameIndex:
+	index = PartyNameIndex()
+	for party_type, title_field in PARTY_NAME_FIELDS.items():
+		for party, title in frappe.get_all(
+			party_type,
+			filters=get_active_filters(party_type),
+			fields=["name", title_field],
+			as_list=True,
+		):
+			index.add(party_type, party, title)
+
+	return index
+
+
+def get_active_filters(party_type: str) -> dict:
+	return {"status": "Active"} if party_type == "Employee" else {"disabled": 0}
+
+
+def is_active(doc) -> bool:
+	if doc.doctype == "Employee":
+		return doc.status == "Active"
+
+	return not doc.disabled
+
+
+def find_party(
+	name: str | None,
+	threshold: float = NAME_SIMILARITY_THRESHOLD,
+	party_types: tuple | None = None,
+) -> tuple[str, str] | None:
+	"""Return (party_type, party) of the party whose name is most similar to `name`."""
+	if not name:
+		return None
+
+	matches = get_party_name_index().search(name, threshold, party_types, limit=2)
+	if not matches or (len(matches) > 1 and matches[0][0] == matches[1][0]):
+		# nothing similar enough, or a tie we can't decide
+		return None
+
+	return matches[0][1:]
+
+
+def publish_change(
+	action: str, party_type: str, party: str, title: str = None, old_party: str = None
+) -> None:
+	change = [action, party_type, party, title, old_party]
+	site = frappe.local.site
+
+	def publish():
+		if index := INDEXES.get(site):
+			index.apply_change(change)
+
+		key = frappe.cache.make_key(PARTY_CHANGES_CACHE_KEY)
+		(changes,) = frappe.cache.pipeline().rpush(key, json.dumps(change)).execute()
+		if changes > MAX_PARTY_CHANGES:
+			# start over, all workers rebuild their index from the database
+			pipeline = frappe.cache.pipeline()
+			pipeline.incr(frappe.cache.make_key(PARTY_CHANGES_GENERATION_CACHE_KEY))
+			pipeline.delete(key)
+			pipeline.execute()
+
+	frappe.db.after_commit.add(publish)
+
+
+def on_update(doc, event=None) -> None:
+	title = doc.get(PARTY_NAME_FIELDS[doc.doctype])
+	doc_before_save = doc.get_doc_before_save()
+	if (
+		doc_before_save
+		and doc_before_save.get(PARTY_NAME_FIELDS[doc.doctype]) == title
+		and is_active(doc_before_save) == is_active(doc)
+	):
+		return
+
+	publish_change("add" if is_active(doc) else "remove", doc.doctype, doc.name, title)
+
+
+def after_rename(doc, event, old: str, new: str, merge: bool = False) -> None:
+	if merge:
+		publish_change("remove", doc.doctype, old)
+	else:
+		publish_change(
+			"add", doc.doctype, new, doc.get(PARTY_NAME_FIELDS[doc.doctype]), old_party=old
+		)
+
+
+def on_trash(doc, event=None) -> None:
+	publish_change("remove", doc.doctype, doc.name)
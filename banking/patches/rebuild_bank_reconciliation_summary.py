@@ -0,0 +1,7 @@
+from banking.klarna_kosma_integration.doctype.bank_reconciliation_summary.bank_reconciliation_summary import (
+	rebuild_summary,
+)
+
+
+def execute():
+	rebuild_summary()
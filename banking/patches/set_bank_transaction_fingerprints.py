@@ -0,0 +1,29 @@
+import frappe
+
+from banking.fingerprint import get_transaction_fingerprint
+
+
+def execute():
+	"""Set the fingerprint of existing Bank Transactions, so that they are not imported again."""
+	transactions = frappe.get_all(
+		"Bank Transaction",
+		filters={"fingerprint": ("is", "not set"), "bank_account": ("is", "set")},
+		fields=[
+			"name",
+			"bank_account",
+			"date",
+			"deposit",
+			"withdrawal",
+			"bank_party_iban",
+			"reference_number",
+		],
+	)
+	frappe.db.bulk_update(
+		"Bank Transaction",
+		{
+			transaction.name: {"fingerprint": get_transaction_fingerprint(transaction)}
+			for transaction in transactions
+			if transaction.date
+		},
+		update_modified=False,
+	)
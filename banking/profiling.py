@@ -0,0 +1,207 @@
+# Copyright (c) 2024, ALYF GmbH and contributors
+# For license information, please see license.txt
+"""Opt-in profiling of the bank reconciliation endpoints.
+
+If "Enable Profiling" is set in Banking Settings, every stage decorated with
+`profile` records its wall time and number of SQL statements, the matching
+queries record the rows they return (see `run_query`), and statements slower
+than the threshold are sampled. The numbers of a request are collected in
+`frappe.local` and added to Redis per Bank Account once the outermost stage
+has finished, so that profiling costs one Redis round trip per request.
+"""
+import json
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+import frappe
+from frappe.utils import flt, now_datetime
+
+PROFILE_CACHE_KEY = "banking_profile"
+PROFILE_ACCOUNTS_CACHE_KEY = "banking_profile_accounts"
+SLOW_QUERIES_CACHE_KEY = "banking_profile_slow_queries"
+MAX_SLOW_QUERIES = 50
+MAX_QUERY_LENGTH = 1000
+STAT_FIELDS = ("calls", "time", "statements", "rows")
+
+
+def is_enabled() -> bool:
+	if not hasattr(frappe.local, "banking_profiling_enabled"):
+		frappe.local.banking_profiling_enabled = bool(
+			frappe.db.get_single_value("Banking Settings", "enable_profiling")
+		)
+
+	return frappe.local.banking_profiling_enabled
+
+
+def profile(stage: str):
+	"""Record the wall time and SQL statements of the decorated function as `stage`."""
+
+	def decorator(fn):
+		@wraps(fn)
+		def wrapper(*args, **kwargs):
+			if not is_enabled():
+				return fn(*args, **kwargs)
+
+			with profile_stage(stage):
+				return fn(*args, **kwargs)
+
+		return wrapper
+
+	return decorator
+
+
+@contextmanager
+def profile_stage(stage: str):
+	"""Record a stage. Yields its stats, e.g. to add the returned rows."""
+	state = get_state()
+	stats = state.stages.setdefault(stage, dict.fromkeys(STAT_FIELDS, 0))
+	statements_before = state.statements
+	start = time.perf_counter()
+	state.stack.append(stage)
+	try:
+		yield stats
+	finally:
+		state.stack.pop()
+		stats["calls"] += 1
+		stats["time"] += (time.perf_counter() - start) * 1000
+		stats["statements"] += state.statements - statements_before
+
+		if not state.stack:
+			finish_profile(state)
+
+
+def run_query(query) -> list[dict]:
+	"""Run a matching query and record its time and rows as a stage of its own."""
+	if not is_enabled():
+		return query.run(as_dict=True)
+
+	# queries compiled by this app are named by the first part of their key
+	name = query.key[1] if hasattr(query, "key") else type(query).__name__
+	with profile_stage(f"query: {name}") as stats:
+		rows = query.run(as_dict=True)
+		stats["rows"] += len(rows)
+
+	return rows
+
+
+def set_account(bank_account: str | None) -> None:
+	"""Aggregate the stats of the current request under this Bank Account."""
+	if state := getattr(frappe.local, "banking_profile", None):
+		state.bank_account = bank_account
+
+
+def get_state() -> frappe._dict:
+	"""Return the profile of this request, counting SQL statements from now on."""
+	state = getattr(frappe.local, "banking_profile", None)
+	if state:
+		return state
+
+	state = frappe._dict(
+		stages={},
+		stack=[],
+		statements=0,
+		slow_queries=[],
+		bank_account=None,
+		threshold=flt(frappe.db.get_single_value("Banking Settings", "slow_query_threshold")),
+		sql=frappe.db.sql,
+	)
+
+	def sql(query, *args, **kwargs):
+		start = time.perf_counter()
+		try:
+			return state.sql(query, *args, **kwargs)
+		finally:
+			duration = (time.perf_counter() - start) * 1000
+			state.statements += 1
+			if state.threshold and duration >= state.threshold:
+				state.slow_queries.append(
+					{
+						"stage": state.stack[-1] if state.stack else None,
+						"duration": round(duration, 1),
+						"query": str(query)[:MAX_QUERY_LENGTH],
+						"timestamp": str(now_datetime()),
+					}
+				)
+
+	frappe.db.sql = sql
+	frappe.local.banking_profile = state
+	return state
+
+
+def finish_profile(state: frappe._dict) -> None:
+	"""Stop counting SQL statements and add the stats of this request to Redis."""
+	frappe.db.sql = state.sql
+	del frappe.local.banking_profile
+
+	bank_account = state.bank_account or ""
+	pipeline = frappe.cache.pipeline()
+	key = get_profile_key(bank_account)
+	for stage, stats in state.stages.items():
+		for field, value in stats.items():
+			if value:
+				pipeline.hincrbyfloat(key, f"{stage}|{field}", value)
+
+	pipeline.sadd(frappe.cache.make_key(PROFILE_ACCOUNTS_CACHE_KEY), bank_account)
+
+	if state.slow_queries:
+		slow_queries_key = frappe.cache.make_key(SLOW_QUERIES_CACHE_KEY)
+		for sample in state.slow_queries:
+			sample["bank_account"] = state.bank_account
+			pipeline.lpush(slow_queries_key, json.dumps(sample))
+		pipeline.ltrim(slow_queries_key, 0, MAX_SLOW_QUERIES - 1)
+
+	pipeline.execute()
+
+
+def get_profile_key(bank_account: str) -> str:
+	return frappe.cache.make_key(f"{PROFILE_CACHE_KEY}|{bank_account}")
+
+
+def get_profile_stats() -> dict:
+	"""Return the aggregated stats per Bank Account and stage, slowest first, and the slow queries."""
+	bank_accounts = sorted(
+		account.decode() for account in frappe.cache.smembers(PROFILE_ACCOUNTS_CACHE_KEY)
+	)
+	pipeline = frappe.cache.pipeline()
+	for bank_account in bank_accounts:
+		pipeline.hgetall(get_profile_key(bank_account))
+	pipeline.lrange(frappe.cache.make_key(SLOW_QUERIES_CACHE_KEY), 0, -1)
+	*profiles, slow_queries = pipeline.execute()
+
+	stages = []
+	for bank_account, profile in zip(bank_accounts, profiles):
+		by_stage = {}
+		for field, value in profile.items():
+			stage, field = field.decode().rsplit("|", 1)
+			by_stage.setdefault(stage, dict.fromkeys(STAT_FIELDS, 0))[field] = flt(value)
+
+		for stage, stats in by_stage.items():
+			calls = stats["calls"] or 1
+			stages.append(
+				{
+					"bank_account": bank_account or None,
+					"stage": stage,
+					"calls": int(stats["calls"]),
+					"total_time": flt(stats["time"], 1),
+					"avg_time": flt(stats["time"] / calls, 1),
+					"avg_statements": flt(stats["statements"] / calls, 1),
+					"avg_rows": flt(stats["rows"] / calls, 1),
+				}
+			)
+
+	stages.sort(key=lambda row: row["total_time"], reverse=True)
+	return {
+		"stages": stages,
+		"slow_queries": [json.loads(sample) for sample in slow_queries],
+	}
+
+
+def clear_profile_stats() -> None:
+	bank_accounts = frappe.cache.smembers(PROFILE_ACCOUNTS_CACHE_KEY)
+	pipeline = frappe.cache.pipeline()
+	for bank_account in bank_accounts:
+		pipeline.delete(get_profile_key(bank_account.decode()))
+	pipeline.delete(frappe.cache.make_key(PROFILE_ACCOUNTS_CACHE_KEY))
+	pipeline.delete(frappe.cache.make_key(SLOW_QUERIES_CACHE_KEY))
+	pipeline.execute()
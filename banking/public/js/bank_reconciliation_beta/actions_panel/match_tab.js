@@ -3,6 +3,8 @@ frappe.provide("erpnext.accounts.bank_reconciliation");
 erpnext.accounts.bank_reconciliation.MatchTab = class MatchTab {
 	constructor(opts) {
 		$.extend(this, opts);
+		// Number of vouchers loaded at once, more are loaded with "Show More"
+		this.page_length = 20;
 		this.make();
 	}
 
@@ -39,6 +41,7 @@ erpnext.accounts.bank_reconciliation.MatchTab = class MatchTab {
 		let document_types = Object.keys(filter_fields).filter(field => filter_fields[field] === 1);
 
 		this.update_filters_in_state(document_types);
+		this.document_types = document_types;
 
 		let vouchers = await this.get_matching_vouchers(document_types);
 		this.set_table_data(vouchers);
@@ -60,7 +63,23 @@ erpnext.accounts.bank_reconciliation.MatchTab = class MatchTab {
 		})
 	}
 
-	async get_matching_vouchers(document_types) {
+	async show_more_vouchers() {
+		this.actions_table.freeze();
+		let vouchers = await this.get_matching_vouchers(this.document_types, this.loaded_vouchers);
+		this.actions_table.appendRows(this.get_table_rows(vouchers));
+		this.set_loaded_vouchers(this.loaded_vouchers + vouchers.length, vouchers.length);
+		this.actions_table.unfreeze();
+	}
+
+	set_loaded_vouchers(count, last_page_count) {
+		this.loaded_vouchers = count;
+		// A short page is the last one
+		this.match_field_group.set_df_property(
+			"show_more", "hidden", last_page_count < this.page_length ? 1 : 0
+		);
+	}
+
+	async get_matching_vouchers(document_types, start = 0) {
 		let vouchers = await frappe.call({
 			method:
 				"banking.klarna_kosma_integration.doctype.bank_reconciliation_tool_beta.bank_reconciliation_tool_beta.get_linked_payments",
@@ -71,7 +90,9 @@ erpnext.accounts.bank_reconciliation.MatchTab = class MatchTab {
 				to_date: this.doc.bank_statement_to_date,
 				filter_by_reference_date: this.doc.filter_by_reference_date,
 				from_reference_date: this.doc.from_reference_date,
-				to_reference_date: this.doc.to_reference_date
+				to_reference_date: this.doc.to_reference_date,
+				start: start,
+				page_length: this.page_length,
 			},
 		}).then(result => result.message);
 		return vouchers || [];
@@ -104,7 +125,12 @@ erpnext.accounts.bank_reconciliation.MatchTab = class MatchTab {
 
 	set_table_data(vouchers) {
 		this.summary_data = {};
-		let table_data = vouchers.map((row) => {
+		this.actions_table.refresh(this.get_table_rows(vouchers), this.get_data_table_columns());
+		this.set_loaded_vouchers(vouchers.length, vouchers.length);
+	}
+
+	get_table_rows(vouchers) {
+		return vouchers.map((row) => {
 			return [
 				{
 					content: row.reference_date || row.posting_date, // Reference Date
@@ -114,9 +140,13 @@ erpnext.accounts.bank_reconciliation.MatchTab = class MatchTab {
 					}
 				},
 				{
-					content: row.paid_amount,
+					// Vouchers in other currencies are allocated with their converted amount
+					content: row.converted_amount ?? row.paid_amount,
 					format: (value) => {
-						let formatted_value = format_currency(value, row.currency);
+						let formatted_value = format_currency(row.paid_amount, row.currency);
+						if (row.converted_amount != null) {
+							formatted_value += ` (${format_currency(value, this.transaction.currency)})`;
+						}
 						let match_condition =  row.amount_match || row.unallocated_amount_match;
 						return match_condition ? formatted_value.bold() : formatted_value;
 					}
@@ -148,8 +178,6 @@ erpnext.accounts.bank_reconciliation.MatchTab = class MatchTab {
 				},
 			];
 		});
-
-		this.actions_table.refresh(table_data, this.get_data_table_columns());
 	}
 
 	bind_row_check_event() {
@@ -262,7 +290,33 @@ erpnext.accounts.bank_reconciliation.MatchTab = class MatchTab {
 		}
 	}
 
-	bulk_reconcile_vouchers(selected_vouchers, reconcile_multi_party) {
+	async bulk_reconcile_vouchers(selected_vouchers, reconcile_multi_party) {
+		// Propose to write off small differences, e.g. bank fees or early payment discounts
+		let write_off = await frappe.call({
+			method:
+				"banking.klarna_kosma_integration.doctype.bank_reconciliation_tool_beta.bank_reconciliation_tool_beta.get_write_off_proposal",
+			args: {
+				bank_transaction_name: this.transaction.name,
+				vouchers: selected_vouchers,
+			},
+		}).then(result => result.message);
+
+		if (!write_off) {
+			this.reconcile_vouchers(selected_vouchers, reconcile_multi_party, false);
+			return;
+		}
+
+		frappe.confirm(
+			__("Write off the difference of {0} to {1}?", [
+				format_currency(write_off.amount, this.transaction.currency),
+				write_off.account.bold(),
+			]),
+			() => this.reconcile_vouchers(selected_vouchers, reconcile_multi_party, true),
+			() => this.reconcile_vouchers(selected_vouchers, reconcile_multi_party, false),
+		);
+	}
+
+	reconcile_vouchers(selected_vouchers, reconcile_multi_party, write_off_difference) {
 		let me = this;
 		frappe.call({
 			method:
@@ -271,6 +325,7 @@ erpnext.accounts.bank_reconciliation.MatchTab = class MatchTab {
 				bank_transaction_name: this.transaction.name,
 				vouchers: selected_vouchers,
 				reconcile_multi_party: reconcile_multi_party,
+				write_off_difference: write_off_difference,
 			},
 			freeze: true,
 			freeze_message: __("Reconciling ..."),
@@ -422,6 +477,16 @@ erpnext.accounts.bank_reconciliation.MatchTab = class MatchTab {
 			{
 				fieldtype: "Column Break"
 			},
+			{
+				label: __("Other Currencies"),
+				fieldname: "cross_currency",
+				fieldtype: "Check",
+				default: filters_state.cross_currency,
+				onchange: (e) => {
+					this.populate_matching_vouchers(e);
+				},
+				depends_on: "eval: doc.sales_invoice || doc.purchase_invoice",
+			},
 			{
 				fieldtype: "Section Break"
 			},
@@ -433,6 +498,15 @@ erpnext.accounts.bank_reconciliation.MatchTab = class MatchTab {
 				fieldname: "vouchers",
 				fieldtype: "HTML",
 			},
+			{
+				label: __("Show More"),
+				fieldname: "show_more",
+				fieldtype: "Button",
+				hidden: 1,
+				click: () => {
+					this.show_more_vouchers();
+				}
+			},
 			{
 				fieldtype: "Section Break",
 				fieldname: "section_break_reconcile",
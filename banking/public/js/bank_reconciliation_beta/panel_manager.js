@@ -64,7 +64,8 @@ erpnext.accounts.bank_reconciliation.PanelManager = class PanelManager {
 			bank_transaction: 0,
 			exact_match: 0,
 			exact_party_match: 0,
-			unpaid_invoices: 1
+			unpaid_invoices: 1,
+			cross_currency: 0
 		}
 	}
 
@@ -0,0 +1,125 @@
+# Copyright (c) 2024, ALYF GmbH and Contributors
+# See license.txt
+from unittest.mock import MagicMock
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import getdate, nowdate
+
+from erpnext.accounts.doctype.bank_transaction.test_bank_transaction import (
+	create_gl_account,
+)
+
+from banking.ebics.utils import _make_bank_transaction
+from banking.fingerprint import DuplicateFilter, get_fingerprint
+from banking.klarna_kosma_integration.doctype.bank_reconciliation_tool_beta.test_bank_reconciliation_tool_beta import (
+	create_bank,
+	create_bank_account,
+)
+from banking.klarna_kosma_integration.utils import create_bank_transactions
+from banking.patches.set_bank_transaction_fingerprints import execute as set_fingerprints
+
+
+class TestFingerprint(FrappeTestCase):
+	@classmethod
+	def setUpClass(cls) -> None:
+		super().setUpClass()
+		create_bank()
+		cls.gl_account = create_gl_account("_Test Bank Fingerprint")
+		cls.bank_account = create_bank_account(
+			gl_account=cls.gl_account, bank_account_name="Fingerprint Account"
+		)
+
+	def setUp(self) -> None:
+		frappe.db.savepoint(save_point="banking_fingerprint_before_tests")
+
+	def tearDown(self) -> None:
+		frappe.db.rollback(save_point="banking_fingerprint_before_tests")
+
+	def test_normalization(self):
+		self.assertEqual(
+			get_fingerprint("Account", "2024-01-31", -10, "DE02 1203 0000 0000 2020 51", None),
+			get_fingerprint(
+				"Account", getdate("2024-01-31"), -10.0, "de02120300000000202051", "NOTPROVIDED"
+			),
+		)
+		self.assertNotEqual(
+			get_fingerprint("Account", "2024-01-31", -10),
+			get_fingerprint("Account", "2024-01-31", 10),
+		)
+
+	def test_duplicates_of_other_provider_are_skipped(self):
+		create_bank_transactions(
+			self.bank_account,
+			[
+				get_kosma_transaction("provider-a-1", "E2E-1"),
+				get_kosma_transaction("provider-a-2"),
+				# identical payments on the same day are not duplicates
+				get_kosma_transaction("provider-a-3"),
+			],
+		)
+		self.assertEqual(self.get_transaction_count(), 3)
+
+		# the same transactions with the IDs of another provider
+		create_bank_transactions(
+			self.bank_account,
+			[
+				get_kosma_transaction("provider-b-1", "e2e-1"),
+				get_kosma_transaction("provider-b-2"),
+				get_kosma_transaction("provider-b-3"),
+				get_kosma_transaction("provider-b-4"),
+			],
+		)
+		self.assertEqual(self.get_transaction_count(), 4)
+
+		# a repeated sync of the other provider
+		create_bank_transactions(
+			self.bank_account,
+			[
+				get_kosma_transaction("provider-b-1", "e2e-1"),
+				get_kosma_transaction("provider-b-4"),
+			],
+		)
+		self.assertEqual(self.get_transaction_count(), 4)
+
+	def test_backfilled_transaction_is_not_imported_by_ebics(self):
+		transaction = get_kosma_transaction("provider-a-1", "E2E-1")
+		transaction["value_date"] = transaction["date"]
+		create_bank_transactions(self.bank_account, [transaction])
+
+		# a transaction imported before fingerprints existed
+		frappe.db.set_value(
+			"Bank Transaction", {"bank_account": self.bank_account}, "fingerprint", None
+		)
+		set_fingerprints()
+
+		sepa_transaction = MagicMock()
+		sepa_transaction.date = getdate(transaction["date"])
+		sepa_transaction.amount.value = -5
+		sepa_transaction.amount.currency = "INR"
+		sepa_transaction.purpose = ["Card payment"]
+		sepa_transaction.eref = "E2E-1"
+		sepa_transaction.bank_reference = "EBICS-1"
+		sepa_transaction.iban = "DE02 1203 0000 0000 2020 51"
+		sepa_transaction.name = "Corner Shop"
+		bank_transaction = _make_bank_transaction(
+			self.bank_account, "_Test Company", sepa_transaction
+		)
+
+		duplicates = DuplicateFilter(self.bank_account, [bank_transaction])
+		self.assertTrue(duplicates.is_duplicate(bank_transaction))
+
+	def get_transaction_count(self) -> int:
+		return frappe.db.count("Bank Transaction", {"bank_account": self.bank_account})
+
+
+def get_kosma_transaction(transaction_id: str, end_to_end_reference: str | None = None) -> dict:
+	return {
+		"transaction_id": transaction_id,
+		"type": "DEBIT",
+		"date": nowdate(),
+		"amount": {"amount": 500, "currency": "INR"},
+		"reference": "Card payment",
+		"bank_references": {"end_to_end": end_to_end_reference},
+		"counter_party": {"holder_name": "Corner Shop", "iban": "DE02120300000000202051"},
+	}
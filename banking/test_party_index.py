@@ -0,0 +1,112 @@
+# Copyright (c) 2024, ALYF GmbH and Contributors
+# See license.txt
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from erpnext.accounts.doctype.bank_transaction.test_bank_transaction import (
+	create_gl_account,
+)
+
+from banking.klarna_kosma_integration.doctype.bank_reconciliation_tool_beta.test_bank_reconciliation_tool_beta import (
+	create_bank,
+	create_bank_account,
+	create_customer,
+)
+from banking.klarna_kosma_integration.utils import new_bank_transaction
+from banking.party_index import clear_party_index, learn_party, resolve_party
+
+CUSTOMER_IBAN = "DE02 1203 0000 0000 2020 51"
+
+
+class TestPartyIndex(FrappeTestCase):
+	@classmethod
+	def setUpClass(cls) -> None:
+		super().setUpClass()
+		create_bank()
+		cls.gl_account = create_gl_account("_Test Bank Party Index")
+		cls.bank_account = create_bank_account(
+			gl_account=cls.gl_account, bank_account_name="Party Index Account"
+		)
+		cls.customer = create_customer(customer_name="IBAN Customer Inc.")
+
+	def setUp(self) -> None:
+		frappe.db.savepoint(save_point="banking_party_index_before_tests")
+		clear_party_index()
+
+	def tearDown(self) -> None:
+		frappe.db.rollback(save_point="banking_party_index_before_tests")
+		clear_party_index()
+
+	def test_party_is_set_on_import(self):
+		create_party_bank_account("Customer", self.customer, CUSTOMER_IBAN)
+		self.assertEqual(resolve_party("de02120300000000202051"), ("Customer", self.customer))
+
+		new_bank_transaction(
+			self.bank_account,
+			{
+				"transaction_id": "party-index-1",
+				"type": "CREDIT",
+				"date": frappe.utils.nowdate(),
+				"amount": {"amount": 10000, "currency": "INR"},
+				"counter_party": {
+					"holder_name": "IBAN Customer",
+					"iban": "DE02120300000000202051",
+				},
+			},
+		)
+		party_type, party = frappe.db.get_value(
+			"Bank Transaction", {"transaction_id": "party-index-1"}, ["party_type", "party"]
+		)
+		self.assertEqual((party_type, party), ("Customer", self.customer))
+
+	def test_ambiguous_iban(self):
+		other_customer = create_customer(customer_name="IBAN Customer GmbH")
+		create_party_bank_account("Customer", self.customer, CUSTOMER_IBAN)
+		create_party_bank_account("Customer", other_customer, CUSTOMER_IBAN, "Second")
+
+		self.assertIsNone(resolve_party(CUSTOMER_IBAN))
+
+
+	def test_learn_party(self):
+		create_party_bank_account("Customer", self.customer, CUSTOMER_IBAN)
+		other_customer = create_customer(customer_name="IBAN Customer Ltd.")
+		self.assertIsNone(resolve_party("DE89370400440532013000"))
+
+		learn_party(
+			frappe._dict(
+				bank_party_iban="DE89 3704 0044 0532 0130 00",
+				party_type="Customer",
+				party=other_customer,
+			)
+		)
+		# parties from Bank Accounts are not overwritten
+		learn_party(
+			frappe._dict(
+				bank_party_iban=CUSTOMER_IBAN, party_type="Customer", party=other_customer
+			)
+		)
+
+		# as seen by another request
+		del frappe.local.banking_party_index
+		self.assertEqual(
+			resolve_party("DE89370400440532013000"), ("Customer", other_customer)
+		)
+		self.assertEqual(resolve_party(CUSTOMER_IBAN), ("Customer", self.customer))
+
+def create_party_bank_account(
+	party_type: str, party: str, iban: str, account_name: str = "Primary"
+) -> str:
+	return (
+		frappe.get_doc(
+			{
+				"doctype": "Bank Account",
+				"account_name": f"{party} {account_name}",
+				"bank": "Citi Bank",
+				"party_type": party_type,
+				"party": party,
+				"iban": iban,
+			}
+		)
+		.insert()
+		.name
+	)
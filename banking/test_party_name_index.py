@@ -0,0 +1,55 @@
+# Copyright (c) 2024, ALYF GmbH and Contributors
+# See license.txt
+from frappe.tests.utils import FrappeTestCase
+
+from banking.party_name_index import PartyNameIndex, get_trigrams, normalize_name
+
+
+class TestPartyNameIndex(FrappeTestCase):
+	def setUp(self) -> None:
+		self.index = PartyNameIndex()
+		self.index.add("Customer", "CUST-0001", "Acme")
+		self.index.add("Customer", "CUST-0002", "Müller Bäckerei")
+		self.index.add("Supplier", "Acme Logistics", "Acme Logistics")
+		self.index.add("Employee", "HR-EMP-0001", "Jane Doe")
+
+	def test_normalize_name(self):
+		self.assertEqual(normalize_name("ACME GMBH & CO. KG"), "acme")
+		self.assertEqual(normalize_name("Müller Bäckerei"), "muller backerei")
+		self.assertEqual(get_trigrams("Acme GmbH"), get_trigrams("ACME"))
+
+	def test_search(self):
+		self.assertEqual(
+			self.index.search("ACME GMBH & CO KG")[0], (1.0, "Customer", "CUST-0001")
+		)
+		self.assertEqual(
+			self.index.search("MUELLER BAECKEREI")[0][1:], ("Customer", "CUST-0002")
+		)
+		self.assertEqual(
+			self.index.search("Acme", party_types=("Supplier",), threshold=0.5)[0][1:],
+			("Supplier", "Acme Logistics"),
+		)
+		self.assertEqual(self.index.search("Unrelated Name"), [])
+
+	def test_search_with_frequent_trigrams(self):
+		# the trigrams of "Müller" are part of many names
+		for i in range(2000):
+			self.index.add("Customer", f"CUST-1{i:04}", f"Müller Bau {i}")
+		self.index.add("Supplier", "Müller", "Müller")
+
+		self.assertEqual(self.index.search("MÜLLER")[0], (1.0, "Supplier", "Müller"))
+		self.assertEqual(
+			self.index.search("Müller Bau 1234")[0], (1.0, "Customer", "CUST-11234")
+		)
+
+	def test_incremental_changes(self):
+		# rename
+		self.index.apply_change(
+			["add", "Employee", "HR-EMP-0002", "Jane Doe", "HR-EMP-0001"]
+		)
+		self.assertEqual(self.index.search("DOE, JANE")[0][1:], ("Employee", "HR-EMP-0002"))
+		self.assertEqual(len(self.index), 4)
+
+		self.index.apply_change(["remove", "Employee", "HR-EMP-0002", None, None])
+		self.assertEqual(self.index.search("DOE, JANE"), [])
+		self.assertNotIn("doe", [trigram.strip() for trigram in self.index.postings])
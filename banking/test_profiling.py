@@ -0,0 +1,60 @@
+# Copyright (c) 2024, ALYF GmbH and Contributors
+# See license.txt
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from banking.profiling import (
+	clear_profile_stats,
+	get_profile_stats,
+	profile,
+	profile_stage,
+	set_account,
+)
+
+
+@profile("test_outer")
+def run_outer_stage():
+	set_account("_Test Profiling Account")
+	frappe.db.sql("select 1")
+	run_inner_stage()
+
+
+@profile("test_inner")
+def run_inner_stage():
+	frappe.db.sql("select 1")
+	with profile_stage("test_query") as stats:
+		stats["rows"] += 3
+
+
+class TestProfiling(FrappeTestCase):
+	def setUp(self) -> None:
+		frappe.db.savepoint(save_point="banking_profiling_before_tests")
+		frappe.db.set_single_value("Banking Settings", "enable_profiling", 1)
+		frappe.local.banking_profiling_enabled = True
+		clear_profile_stats()
+
+	def tearDown(self) -> None:
+		frappe.db.rollback(save_point="banking_profiling_before_tests")
+		del frappe.local.banking_profiling_enabled
+		clear_profile_stats()
+
+	def test_stages_are_aggregated(self):
+		sql = frappe.db.sql
+		run_outer_stage()
+		run_outer_stage()
+
+		# statements are only counted while profiling
+		self.assertEqual(frappe.db.sql, sql)
+
+		stats = {row["stage"]: row for row in get_profile_stats()["stages"]}
+		self.assertEqual(stats["test_outer"]["bank_account"], "_Test Profiling Account")
+		self.assertEqual(stats["test_outer"]["calls"], 2)
+		self.assertEqual(stats["test_outer"]["avg_statements"], 2)
+		self.assertEqual(stats["test_inner"]["avg_statements"], 1)
+		self.assertEqual(stats["test_query"]["avg_rows"], 3)
+
+	def test_disabled(self):
+		frappe.local.banking_profiling_enabled = False
+		run_outer_stage()
+
+		self.assertEqual(get_profile_stats()["stages"], [])